@@ -0,0 +1,126 @@
+"""Process-pool batch compare of the Nef files common to two directories
+
+Used by both the nef and CompareNef command line programs.
+
+  jobsArgument              argparse type for -j/--jobs N
+  parallelCompareNefFiles   compare the files of a batch in options.jobs worker processes
+
+"""
+#=========================================================================================
+# Licence, Reference and Credits
+#=========================================================================================
+__copyright__ = "Copyright (C) CCPN project (http://www.ccpn.ac.uk) 2014 - 2021"
+__credits__ = ("Ed Brooksbank, Joanna Fox, Victoria A Higman, Luca Mureddu, Eliza Płoskoń",
+               "Timothy J Ragan, Brian O Smith, Gary S Thompson & Geerten W Vuister")
+__licence__ = ("CCPN licence. See http://www.ccpn.ac.uk/v3-software/downloads/license")
+__reference__ = ("Skinner, S.P., Fogh, R.H., Boucher, W., Ragan, T.J., Mureddu, L.G., & Vuister, G.W.",
+                 "CcpNmr AnalysisAssign: a flexible platform for integrated NMR analysis",
+                 "J.Biomol.Nmr (2016), 66, 111-124, http://doi.org/10.1007/s10858-016-0060-y")
+#=========================================================================================
+# Last code modification
+#=========================================================================================
+__modifiedBy__ = "$modifiedBy: Ed Brooksbank $"
+__dateModified__ = "$dateModified: 2021-05-10 18:47:35 +0100 (Mon, May 10, 2021) $"
+__version__ = "$Revision: 3.0.4 $"
+#=========================================================================================
+# Created
+#=========================================================================================
+__author__ = "$Author: CCPN $"
+__date__ = "$Date: 2017-04-07 10:28:41 +0000 (Fri, April 07, 2017) $"
+#=========================================================================================
+# Start of code
+#=========================================================================================
+
+import io
+import os
+from contextlib import redirect_stdout
+from os.path import join
+
+from .SafeOpen import safeOpen
+
+
+def jobsArgument(value):
+    """Parse the number of processes for a batch compare, for use as an argparse type, e.g. for the --jobs argument
+    """
+    import argparse
+
+    try:
+        intValue = int(value)
+    except Exception as es:
+        raise argparse.ArgumentTypeError("{} must be an int {}".format(value, es))
+
+    if intValue < 0:
+        raise argparse.ArgumentTypeError("{} must be positive int".format(value))
+
+    return intValue
+
+
+def _compareNefFilePair(compareFunc, printFunc, inFile1, inFile2, options):
+    """Compare two Nef files in a batch worker process
+    Output is written to string buffers belonging to the worker, rather than the stdout of the batch
+
+    :return: tuple(str output from loading the files, str output from printFunc)
+    """
+    loadLog = io.StringIO()
+    with redirect_stdout(loadLog):
+        nefList = compareFunc(inFile1, inFile2, options)
+
+    compareLog = io.StringIO()
+    with redirect_stdout(compareLog):
+        printFunc(nefList, inFile1, inFile2)
+
+    return loadLog.getvalue(), compareLog.getvalue()
+
+
+def parallelCompareNefFiles(inDir1, inDir2, outDir, fileList, options, compareFunc, printFunc,
+                            replaceExisting=False, output=print):
+    """Compare the Nef files in fileList, common to the two directories, using options.jobs processes
+    Results are written to the screen or the .txt files in the order of fileList
+
+    compareFunc and printFunc are run in the worker processes, so must be picklable,
+    i.e., top-level functions or functools.partial objects of them
+
+    :param inDir1:
+    :param inDir2:
+    :param outDir:
+    :param fileList: list of file names common to inDir1 and inDir2
+    :param options: nameSpace holding the commandLineArguments
+    :param compareFunc: compareFunc(inFile1, inFile2, options) returns the compare list
+    :param printFunc: printFunc(nefList, inFile1, inFile2) prints the compare list
+    :param replaceExisting: replace existing .txt files. If False, new files are appended with "(n)"
+    :param output: function used to write to the screen when options.screen is True
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    inFiles1 = [join(inDir1, fl) for fl in fileList]
+    inFiles2 = [join(inDir2, fl) for fl in fileList]
+    count = len(fileList)
+
+    with ProcessPoolExecutor(max_workers=options.jobs) as executor:
+        results = executor.map(_compareNefFilePair, [compareFunc] * count, [printFunc] * count,
+                               inFiles1, inFiles2, [options] * count)
+
+        # executor.map returns the results in the order of fileList
+        for fl, inFile1, inFile2, (loadText, compareText) in zip(fileList, inFiles1, inFiles2, results):
+            # strip the .nef from the end
+            outFileName = join(outDir, fl[:-4] + '.txt')
+
+            if options.screen is True:
+                output('Batch processing %s > %s' % (fl, outFileName))
+                output(loadText + compareText, end='')
+
+            elif replaceExisting is False:
+                with safeOpen(outFileName, 'w') as (outLog, safeFileName):
+                    outLog.write(loadText)
+                    print('Batch processing %s > %s' % (fl, os.path.basename(safeFileName)), file=outLog)
+                    print(inFile1, file=outLog)
+                    print(inFile2, file=outLog)
+                    outLog.write(compareText)
+
+            else:
+                with open(outFileName, 'w') as outLog:
+                    outLog.write(loadText)
+                    print('Batch processing %s > %s' % (fl, outFileName), file=outLog)
+                    print(inFile1, file=outLog)
+                    print(inFile2, file=outLog)
+                    outLog.write(compareText)
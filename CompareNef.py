@@ -34,6 +34,8 @@ Command Line Usage:
     -s, --screen            Output batch processing to screen, default is to .txt files
                             may be used with -b
 
+    -j N, --jobs N          Compare the files of a batch in N parallel processes.
+
     -o, --overwrite         Overwrite existing .txt files. If false then files are
                             appended with '(n)' before the extension, where n is
                             the next available number.
@@ -42,6 +44,12 @@ Command Line Usage:
 
     -I, --ignorecase        Ignore case when comparing items.
 
+    -k, --keyalign          Align the rows of loops on the key columns defined in the
+                            Nef specification.
+
+    --keys loop:column,column
+                            Align the rows of loop on the given key columns.
+
 Details of the contents of Nef files can be found in GenericStarParser
 The general structure of a Nef file is:
 
@@ -176,6 +184,8 @@ if __name__ == '__main__' and __package__ is None:
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
 from . import GenericStarParser, StarIo
+from .LoopAlignment import loopKeysArgument, getLoopKeyColumns, alignLoopRows
+from .BatchCompare import jobsArgument, parallelCompareNefFiles
 from .SafeOpen import safeOpen
 import unittest
 from ast import literal_eval
@@ -215,12 +225,19 @@ def defineArguments():
     parser.add_argument('-b', '--block', dest='blockDirs', nargs=3, metavar=('inDir1', 'inDir2', 'outDir'), default=None,
                         help='Batch mode: compare the contents of two directories')
     parser.add_argument('-s', '--screen', dest='screen', action='store_true', default=False, help='Output batch processing to screen')
+    parser.add_argument('-j', '--jobs', dest='jobs', default=None, type=jobsArgument,
+                        help='Number of processes for batch compare')
     parser.add_argument('-o', '--overwrite', dest='overwriteExisting', action='store_true', default=False,
                         help='Overwrite existing .txt files. If false, new files are appended with "(n)"')
     parser.add_argument('-c', '--create', dest='createDirs', action='store_true', default=False,
                         help='Create directories as required')
     parser.add_argument('-I', '--ignorecase', dest='ignoreCase', action='store_true', default=False,
                         help='Ignore case when comparing items.')
+    parser.add_argument('-k', '--keyalign', dest='keyAlign', action='store_true', default=False,
+                        help='Align loop rows on the key columns of the Nef specification')
+    parser.add_argument('--keys', dest='loopKeys', nargs='*', default=None, type=loopKeysArgument,
+                        metavar='loop:column,column',
+                        help='Align the rows of loop on the given key columns')
 
     return parser
 
@@ -489,13 +506,29 @@ def compareLoops(loop1, loop2, options, cItem=None, nefList=None):
             cItem3.inWhich = 3
             nefList.append(nefItem(cItem=cItem3))
 
+        keyColumns = getLoopKeyColumns(loop1, loop2, options)
+        if keyColumns:
+            # match rows on the key columns and list the rows only present in one loop
+            rowPairs, inLeftRows, inRightRows = alignLoopRows(loop1, loop2, keyColumns, options)
+            for loop, rowList, inWhich in ((loop1, inLeftRows, 1), (loop2, inRightRows, 2)):
+                if rowList:
+                    cItem3 = copy.deepcopy(cItem)
+                    cItem3.list.append(LOOP + loop.name)
+                    cItem3.list.append([' <Row>: ' + str(rowIndex) + '  <Key>: '
+                                        + ', '.join(str(loop.data[rowIndex][col]) for col in keyColumns)
+                                        for rowIndex in rowList])
+                    cItem3.inWhich = inWhich
+                    nefList.append(nefItem(cItem=cItem3))
+        else:
+            rowPairs = [(rowIndex, rowIndex) for rowIndex in range(rowRange)]
+
         # carry on and compare the common table
 
         for compName in dSet:
-            for rowIndex in range(rowRange):
+            for rowIndex, rowIndex2 in rowPairs:
 
                 loopValue1 = loop1.data[rowIndex][compName]
-                loopValue2 = loop2.data[rowIndex][compName]
+                loopValue2 = loop2.data[rowIndex2][compName]
 
                 if not ((loopValue1 == loopValue2) or
                         ((str(loopValue1).lower() == str(loopValue2).lower()) and options.ignoreCase)):
@@ -861,6 +894,13 @@ def batchCompareNefFiles(inDir1, inDir2, outDir, options):
                     outLog.write('No common files found')
         return
 
+    jobs = getattr(options, 'jobs', None)
+    if jobs is not None and jobs > 1:
+        parallelCompareNefFiles(inDir1, inDir2, outDir, [fl for fl in inFileList if fl in outFileList], options,
+                                compareNefFiles, printCompareList,
+                                replaceExisting=options.overwriteExisting)
+        return
+
     for fl in inFileList:
         if fl in outFileList:
 
@@ -14,9 +14,17 @@ parse(text, mode) to parse a text representation to nested objects
 
 parseFile(fileName, mode) to load and parse a file
 
+iterEvents(text, mode) to iterate over parse events (startDataBlock, startSaveFrame, item,
+loopHeader, loopRow, endLoop, ...) without building the object tree
+
+parseEvents(text, handler, mode) to send the parse events to a StarEventHandler subclass instance
+
 starObject.toString() will convert any object in the object structure,
 complete with contents, to a string that can then be written to file.
 
+starObject.write(fp) writes the same text to an open file, converting loops chunkwise,
+and writeFile(starObject, fileName, atomic=False) writes it to a file
+
 
 Reading behaviour
 =================
@@ -51,6 +59,10 @@ set equal to the name of the first column. A loop is entered in its container un
 column name, so that e.g. aSaveFrame['_Loopx.loopcol1'] and aSaveFrame['_Loopx.loopcol2'] both
 exist and both correspond to the same loop object.
 
+With parse(..., columnar=True) loops are made as ColumnarLoop, which stores one list per
+column instead of one OrderedDict per row. loop.data then gives lightweight row views
+that support the same access, e.g. loop.data[0]['_Loopx.loopcol1'], using much less memory.
+
 Items are entered as a string key - string value pair.
 
 All tags are preserved 'as is' (i.e. without stripping leading '_', 'data_', or 'save_'),
@@ -136,18 +148,28 @@ __date__ = "$Date: 2017-04-07 10:28:41 +0000 (Fri, April 07, 2017) $"
 #=========================================================================================
 
 import sys
+import os
 import re
 import math
+import mmap
+import tempfile
+import hashlib
+import itertools
+import bisect
 from collections import OrderedDict
 
 
 try:
     # Python 3
     from itertools import zip_longest
+    from collections.abc import Mapping, Sequence
 except:
     # python 2.7
     from itertools import izip_longest as zip_longest
+    from collections import Mapping, Sequence
+from . import Profiling
 from .StarTokeniser import getTokenIterator
+from .StarTokeniser import getBytesTokenIterator
 
 from .StarTokeniser import TOKEN_MULTILINE
 from .StarTokeniser import TOKEN_COMMENT
@@ -179,11 +201,32 @@ _quoteStrings = ['true', 'false', 'NaN', 'Infinity', '-Infinity', '']
 _containsWhiteSpace = re.compile('\s').search
 _containsSingleEndQuote = re.compile("'\s").search
 _containsDoubleEndQuote = re.compile('"\s').search
+# Matches strings that valueToStarString does not quote, except for those in _quoteStrings
+_isPlainStarString = re.compile('(?!%s)[^\\s#]+\\Z'
+                                % '|'.join(re.escape(x) for x in _quoteStartStrings)).match
 # _floatingPointFormat = '%.3g'
 _floatingPointFormat = '%.10g'
 _defaultIndent = ' ' * 3
 _defaultSeparator = ' ' * 2
 
+# Multi-line string start, or SaveFrame, DataBlock, or global start or end, at the start of a line,
+# and any SaveFrame, DataBlock, or global names - for skipping SaveFrames
+_structurePattern = re.compile(r'^(;)|^[ \t]*(save_|data_|global_)', re.M | re.I)
+_bytesStructurePattern = re.compile(br'^(;)|^[ \t]*(save_|data_|global_)', re.M | re.I)
+_structureNamePattern = re.compile(r'save_|data_|global_', re.I)
+_bytesStructureNamePattern = re.compile(br'save_|data_|global_', re.I)
+
+# Line ends, for locating tokens in text and bytes input
+_lineEnd = re.compile('\n')
+_bytesLineEnd = re.compile(b'\n')
+
+# Maximum number of distinct values per loop column that are interned while parsing,
+# so that equal values share one object. Columns with more distinct values are only partly interned
+MAX_INTERNED_VALUES = 1000
+
+# Number of loop rows converted at a time by the write functions
+WRITE_CHUNK_ROWS = 10000
+
 # Options corresponding to the supported parser modes: 'standard', 'lenient', 'strict', and 'IUCr'
 PARSER_MODE_LENIENT = 'lenient'
 PARSER_MODE_STANDARD = 'standard'
@@ -216,7 +259,8 @@ _parserModeOptions = {
     }
 
 
-def parse(text, mode=PARSER_MODE_STANDARD):
+def parse(text, mode=PARSER_MODE_STANDARD, columnar=False, includeCategories=None, excludeCategories=None,
+          loopColumns=None):
     """Parse STAR text string 'text'.
     Standard settings allow skipping 'stop_' tags and strings starting with '[' or ']',
     but require 'save_' termination of SaveFrames and throw an error if the number of loop
@@ -225,25 +269,160 @@ def parse(text, mode=PARSER_MODE_STANDARD):
     'strict' and 'lenient' modes are available; mode='IUCr' follows the IUCr standard, which
     is like standard except that strings starting with '[' and ']' are not allowed
 
+    If columnar is True, loops are stored column-wise as ColumnarLoop, to save memory
+
+    text may also be a bytes-like object (e.g. an mmap) containing utf-8 encoded text
+
+    includeCategories, excludeCategories, and loopColumns select the SaveFrames and loop columns
+    to keep (see SaveFrameFilter); the rest are skipped while parsing
+
     See GeneralStarParser class for details and control of individual settings
     """
 
-    try:
-        options = _parserModeOptions[mode]
+    return _getParser(text, mode, includeCategories=includeCategories, excludeCategories=excludeCategories,
+                      loopColumns=loopColumns).parse(columnar=columnar)
 
-    except KeyError:
-        _modes = tuple(_parserModeOptions.keys())
-        raise ValueError( "illegal parser mode : %s  Only modes %r allowed" % (repr(mode), _modes))
 
-    return GeneralStarParser(text, **options).parse()
+def parseFile(fileName, mode=PARSER_MODE_STANDARD, columnar=False, useMmap=False, useCache=False,
+              includeCategories=None, excludeCategories=None, loopColumns=None):
+    """load generic STAR file and parse the contents
+
+    If useMmap is True the file is memory-mapped and tokenised as bytes, instead of being read
+    and decoded as a whole, so that large files do not need to fit in memory as text
+
+    If useCache is True the parsed tree is read from, or stored in, the persistent parse cache
+    (see ParseCache), keyed by the file content and the parser settings
+
+    includeCategories, excludeCategories, and loopColumns are as for parse()"""
+
+    filters = dict(includeCategories=includeCategories, excludeCategories=excludeCategories,
+                   loopColumns=loopColumns)
+
+    if useCache:
+        from . import ParseCache
 
+        saveFrameFilter = SaveFrameFilter.make(**filters)
+        return ParseCache.getParsedFile(fileName, ('GenericStarParser', mode, columnar,
+                                                   saveFrameFilter and saveFrameFilter.key()),
+                                        lambda: parseFile(fileName, mode=mode, columnar=columnar,
+                                                          useMmap=useMmap, **filters))
 
-def parseFile(fileName, mode=PARSER_MODE_STANDARD):
-    """load generic STAR file and parse the contents"""
+    if useMmap:
+        with openMmap(fileName) as data:
+            return parse(data, mode=mode, columnar=columnar, **filters)
 
     with open(fileName) as fp:
         text = fp.read()
-    return parse(text, mode=mode)
+    return parse(text, mode=mode, columnar=columnar, **filters)
+
+
+def writeFile(starObject, fileName, atomic=False, chunkSize=WRITE_CHUNK_ROWS):
+    """Write starObject (DataExtent, DataBlock, SaveFrame, or Loop) to file fileName,
+    with the same text as starObject.toString().
+
+    If atomic is True the text is written to a temporary file in the same directory,
+    which then replaces fileName, so that readers never see a partly written file"""
+
+    if not atomic:
+        with open(fileName, 'w') as fp:
+            starObject.write(fp, chunkSize=chunkSize)
+        return
+
+    fileName = str(fileName)
+    directory, baseName = os.path.split(fileName)
+    fd, tempName = tempfile.mkstemp(prefix='.%s.' % baseName, suffix='.tmp', dir=directory or None)
+    try:
+        with os.fdopen(fd, 'w') as fp:
+            starObject.write(fp, chunkSize=chunkSize)
+            fp.flush()
+            os.fsync(fp.fileno())
+        if os.path.exists(fileName):
+            # keep the permissions of the file being replaced
+            os.chmod(tempName, os.stat(fileName).st_mode & 0o7777)
+        else:
+            # mkstemp files are private - use the permissions open() would give, according to the umask
+            os.chmod(tempName, 0o666 & ~_getUmask())
+        os.replace(tempName, fileName)
+    except BaseException:
+        # remove only the file made here
+        try:
+            os.remove(tempName)
+        except OSError:
+            pass
+        raise
+
+
+def _getUmask():
+    """Current process umask"""
+    result = os.umask(0o022)
+    os.umask(result)
+    return result
+
+
+def _writeStrings(fp, strings):
+    """Write strings to open file fp, recording the 'write' phase if profiling"""
+    with Profiling.phase(Profiling.PHASE_WRITE) as parseProfile:
+        size = 0
+        for text in strings:
+            fp.write(text)
+            size += len(text)
+        if parseProfile is not None:
+            parseProfile.count(Profiling.PHASE_WRITE, characters=size)
+
+
+def openMmap(fileName):
+    """Open fileName as a read-only mmap, for use as context manager.
+    Empty files give empty bytes, as they cannot be memory-mapped"""
+    if not os.path.getsize(fileName):
+        return _EmptyData()
+    with open(fileName, 'rb') as fp:
+        return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+# Source of modification stamps for containers and loops - see Loop.modificationStamp
+_modificationStamps = itertools.count(1)
+
+
+class _EmptyData(bytes):
+    """Empty bytes, usable as context manager like mmap"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+def iterEvents(text, mode=PARSER_MODE_STANDARD, includeCategories=None, excludeCategories=None,
+               loopColumns=None):
+    """Iterator over the parse events of STAR text string 'text', without building an object tree.
+
+    Events are tuples (eventName, *arguments); see StarEventHandler for the event names and arguments.
+    Parser modes and filters are as for parse()"""
+    return _getParser(text, mode, includeCategories=includeCategories, excludeCategories=excludeCategories,
+                      loopColumns=loopColumns).iterEvents()
+
+
+def parseEvents(text, handler, mode=PARSER_MODE_STANDARD, includeCategories=None, excludeCategories=None,
+                loopColumns=None):
+    """Parse STAR text string 'text', passing each event to the matching method of handler,
+    an instance of (a subclass of) StarEventHandler. Returns handler.
+
+    Parser modes and filters are as for parse()"""
+    return _getParser(text, mode, includeCategories=includeCategories, excludeCategories=excludeCategories,
+                      loopColumns=loopColumns).parseEvents(handler)
+
+
+def _getParser(text, mode, **filters):
+    """Get GeneralStarParser for text with the settings for mode, and the SaveFrame filters"""
+    try:
+        options = _parserModeOptions[mode]
+
+    except KeyError:
+        _modes = tuple(_parserModeOptions.keys())
+        raise ValueError( "illegal parser mode : %s  Only modes %r allowed" % (repr(mode), _modes))
+
+    return GeneralStarParser(text, **dict(options, **filters))
 
 
 class UnquotedValue(str):
@@ -269,10 +448,51 @@ class StarSyntaxError(ValueError):
 
 class NamedOrderedDict(OrderedDict):
 
+    # Cached result of modificationStamp, reset when items are set or removed
+    _modificationStamp = None
+
     def __init__(self, name=None):
         super(NamedOrderedDict, self).__init__()
         self.name = name
 
+    def __setitem__(self, key, value):
+        self._modificationStamp = None
+        super(NamedOrderedDict, self).__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self._modificationStamp = None
+        super(NamedOrderedDict, self).__delitem__(key)
+
+    def pop(self, key, *args):
+        self._modificationStamp = None
+        return super(NamedOrderedDict, self).pop(key, *args)
+
+    def popitem(self, last=True):
+        self._modificationStamp = None
+        return super(NamedOrderedDict, self).popitem(last=last)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self._modificationStamp = None
+        return super(NamedOrderedDict, self).setdefault(key, default)
+
+    def clear(self):
+        self._modificationStamp = None
+        super(NamedOrderedDict, self).clear()
+
+    def move_to_end(self, key, last=True):
+        self._modificationStamp = None
+        super(NamedOrderedDict, self).move_to_end(key, last=last)
+
+    def modificationStamp(self):
+        """Number that changes whenever items are set or removed, for detecting modifications.
+
+        Only the container itself is covered - not the contents of loops or contained containers"""
+        result = self._modificationStamp
+        if result is None:
+            result = self._modificationStamp = next(_modificationStamps)
+        return result
+
     def __str__(self):
         return '%s(name=%s)' % (self.__class__.__name__, self.name)
 
@@ -285,6 +505,20 @@ class NamedOrderedDict(OrderedDict):
         else:
             self[tag] = value
 
+    def contentHash(self):
+        """Order-sensitive hash (hex string) of the contents - tags and values of items,
+        loops and contained containers. The name of the container itself is not included,
+        so equal hashes mean identical contents.
+
+        Recalculated from the contents on each call, using the cached hashes of the loops"""
+        hasher = hashlib.blake2b(digest_size=16)
+        for tag, value in self.items():
+            if isinstance(value, (NamedOrderedDict, Loop)):
+                hasher.update(('%r\0%s\n' % (tag, value.contentHash())).encode('utf-8'))
+            else:
+                hasher.update(('%r %r\n' % (tag, value)).encode('utf-8'))
+        return hasher.hexdigest()
+
 
 class StarContainer(NamedOrderedDict):
     """DataBlock or SaveFrame containing items and loops"""
@@ -314,8 +548,10 @@ class StarContainer(NamedOrderedDict):
 
     def _contentToString(self, indent=_defaultIndent, separator=_defaultSeparator):
         """Returns content of either DataBlock or SaveFrame as a string"""
+        return ''.join(self._iterContentStrings(indent=indent, separator=separator))
 
-        lines = []
+    def _iterContentStrings(self, indent=_defaultIndent, separator=_defaultSeparator, chunkSize=None):
+        """Iterator over the strings making up the content of either DataBlock or SaveFrame"""
 
         # Set item formatting
         # tagwidth = max(len(tt[0]) for tt in self.items()
@@ -332,18 +568,26 @@ class StarContainer(NamedOrderedDict):
         for tag, obj in self.items():
 
             if isinstance(obj, SaveFrame):
-                lines.append(obj.toString(indent=indent + _defaultIndent, separator=separator))
+                for text in obj._iterStrings(indent=indent + _defaultIndent, separator=separator,
+                                             chunkSize=chunkSize):
+                    yield text
 
             elif isinstance(obj, Loop):
                 if tag == obj.name:
                     # NB Loops can be contained in self once for each column.
                     # This if statement ensures we only get them once
-                    lines.append(obj.toString(indent=indent, separator=separator))
+                    for text in obj._iterStrings(indent=indent, separator=separator, chunkSize=chunkSize):
+                        yield text
 
             else:
-                lines.append(itemFormat % (tag, valueToStarString(obj)))
-        #
-        return ''.join(lines)
+                yield itemFormat % (tag, valueToStarString(obj))
+
+    def write(self, fp, indent=None, separator=_defaultSeparator, chunkSize=WRITE_CHUNK_ROWS):
+        """Write the same text as toString to open file fp, converting loops chunkSize rows at a time,
+        so that the whole text is never held in memory"""
+        if indent is None:
+            indent = self._defaultWriteIndent
+        _writeStrings(fp, self._iterStrings(indent=indent, separator=separator, chunkSize=chunkSize))
 
 
 class DataExtent(NamedOrderedDict):
@@ -353,8 +597,21 @@ class DataExtent(NamedOrderedDict):
         super(DataExtent, self).__init__(name=name)
 
     def toString(self, indent='', separator=_defaultSeparator):
+        return ''.join(self._iterStrings(indent=indent, separator=separator))
+
+    def _iterStrings(self, indent='', separator=_defaultSeparator, chunkSize=None):
+        """Iterator over the strings making up the toString text"""
         blockSeparator = '\n\n\n\n'
-        return blockSeparator.join(x.toString(indent=indent, separator=separator) for x in self.values())
+        for ii, dataBlock in enumerate(self.values()):
+            if ii:
+                yield blockSeparator
+            for text in dataBlock._iterStrings(indent=indent, separator=separator, chunkSize=chunkSize):
+                yield text
+
+    def write(self, fp, indent='', separator=_defaultSeparator, chunkSize=WRITE_CHUNK_ROWS):
+        """Write the same text as toString to open file fp, converting loops chunkSize rows at a time,
+        so that the whole text is never held in memory"""
+        _writeStrings(fp, self._iterStrings(indent=indent, separator=separator, chunkSize=chunkSize))
 
 
 # An object that cannot appear inside a Star file. Used as sentinel
@@ -374,15 +631,23 @@ class DataBlock(StarContainer):
     # Can be set in subclass instances
     tagPrefix = None
 
+    # Default indent for write
+    _defaultWriteIndent = ''
+
     def toString(self, indent='', separator=_defaultSeparator):
         """Convert DataBlock to string, for writing"""
+        return ''.join(self._iterStrings(indent=indent, separator=separator))
+
+    def _iterStrings(self, indent='', separator=_defaultSeparator, chunkSize=None):
+        """Iterator over the strings making up the toString text"""
 
         name = self.name
         if not name.startswith('data_'):
             name = 'data_' + name
-        return ('%s\n\n%s\n# End of %s\n'
-                % (name, self._contentToString(indent=indent,
-                                               separator=separator), name))
+        yield '%s\n\n' % name
+        for text in self._iterContentStrings(indent=indent, separator=separator, chunkSize=chunkSize):
+            yield text
+        yield '\n# End of %s\n' % name
 
 
 class SaveFrame(StarContainer):
@@ -392,19 +657,78 @@ class SaveFrame(StarContainer):
     # Can be set in subclass instances
     tagPrefix = None
 
+    # Default indent for write
+    _defaultWriteIndent = _defaultIndent
+
     def toString(self, indent=_defaultIndent, separator=_defaultSeparator):
         """Convert SaveFrame to string, for writing"""
+        return ''.join(self._iterStrings(indent=indent, separator=separator))
+
+    def _iterStrings(self, indent=_defaultIndent, separator=_defaultSeparator, chunkSize=None):
+        """Iterator over the strings making up the toString text"""
 
         name = self.name
         if not name.startswith('save_'):
             name = 'save_' + name
-        return ('\n%s%s\n\n%s%ssave_\n\n'
-                % (indent, name, self._contentToString(indent=indent + _defaultIndent,
-                                                       separator=separator), indent))
+        yield '\n%s%s\n\n' % (indent, name)
+        for text in self._iterContentStrings(indent=indent + _defaultIndent, separator=separator,
+                                             chunkSize=chunkSize):
+            yield text
+        yield '%ssave_\n\n' % indent
+
+
+class _LoopRowBase(OrderedDict):
+    """LoopRow without change tracking. Loop.newRow fills rows of this class and then sets their
+    class to LoopRow, so that filling the row does not go through LoopRow.__setitem__"""
+
+    # The Loop holding the row, whose cached contentHash and modificationStamp are reset on changes
+    __slots__ = ('_loop',)
 
 
-class LoopRow(OrderedDict):
-    """Loop row - OrderedDict with additional functionality"""
+class LoopRow(_LoopRowBase):
+    """Loop row - OrderedDict with additional functionality.
+
+    Changes to the row reset the contentHash and modificationStamp of the loop holding it"""
+
+    __slots__ = ()
+
+    def _resetLoop(self):
+        loop = getattr(self, '_loop', None)
+        if loop is not None:
+            loop._contentHash = loop._modificationStamp = None
+
+    def __setitem__(self, key, value):
+        OrderedDict.__setitem__(self, key, value)
+        self._resetLoop()
+
+    def __delitem__(self, key):
+        OrderedDict.__delitem__(self, key)
+        self._resetLoop()
+
+    def pop(self, key, *args):
+        self._resetLoop()
+        return OrderedDict.pop(self, key, *args)
+
+    def popitem(self, last=True):
+        self._resetLoop()
+        return OrderedDict.popitem(self, last=last)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self._resetLoop()
+        return OrderedDict.setdefault(self, key, default)
+
+    def clear(self):
+        self._resetLoop()
+        OrderedDict.clear(self)
+
+    def move_to_end(self, key, last=True):
+        self._resetLoop()
+        OrderedDict.move_to_end(self, key, last=last)
+
+    def __reduce__(self):
+        # OrderedDict.__reduce__ does not include slots in all Python versions
+        return self.__class__, (), (None, {'_loop': getattr(self, '_loop', None)}), None, iter(self.items())
 
     def _get(self, name):
         """Returns value of attribute 'name', or None if attribute is not defined
@@ -442,6 +766,88 @@ class LoopRow(OrderedDict):
             raise KeyError("%s has no attribute(s) matching %s" % (self.__class__.__name__, name))
 
 
+class _LoopRowList(list):
+    """List of rows, used as the data attribute of Loop.
+    Changes to the list, and to the LoopRows in it, reset the cached contentHash
+    and modificationStamp of the loop"""
+
+    __slots__ = ('_loop',)
+
+    def __init__(self, loop, rows=()):
+        super(_LoopRowList, self).__init__()
+        self._loop = loop
+        self.extend(rows)
+
+    def _adopt(self, rows):
+        """Reset the loop caches and make rows report their changes to the loop. Returns rows"""
+        loop = self._loop
+        loop._contentHash = loop._modificationStamp = None
+        for row in rows:
+            if isinstance(row, LoopRow):
+                row._loop = loop
+            elif not isinstance(row, tuple):
+                # Changes to other mutable rows, e.g. lists, cannot be detected
+                loop._untrackedRows = True
+        return rows
+
+    def _reset(self):
+        loop = self._loop
+        loop._contentHash = loop._modificationStamp = None
+
+    def __reduce__(self):
+        return self.__class__, (self._loop, list(self))
+
+    def append(self, row):
+        self._adopt((row,))
+        list.append(self, row)
+
+    def extend(self, rows):
+        list.extend(self, self._adopt(list(rows)))
+
+    def insert(self, index, row):
+        self._adopt((row,))
+        list.insert(self, index, row)
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            value = self._adopt(list(value))
+        else:
+            self._adopt((value,))
+        list.__setitem__(self, index, value)
+
+    def __iadd__(self, rows):
+        self.extend(rows)
+        return self
+
+    def __imul__(self, count):
+        self._reset()
+        return list.__imul__(self, count)
+
+    def __delitem__(self, index):
+        self._reset()
+        list.__delitem__(self, index)
+
+    def pop(self, index=-1):
+        self._reset()
+        return list.pop(self, index)
+
+    def remove(self, row):
+        self._reset()
+        list.remove(self, row)
+
+    def clear(self):
+        self._reset()
+        list.clear(self)
+
+    def sort(self, *args, **kwds):
+        self._reset()
+        list.sort(self, *args, **kwds)
+
+    def reverse(self):
+        self._reset()
+        list.reverse(self)
+
+
 class Loop:
     """Loop for general STAR object tree
     Attributes are:
@@ -456,10 +862,20 @@ class Loop:
     # Can be set in subclass instances.
     tagPrefix = None
 
+    # Cached result of contentHash
+    _contentHash = None
+
+    # Cached result of modificationStamp
+    _modificationStamp = None
+
+    # Set if data contains mutable rows other than LoopRows, whose changes cannot be detected,
+    # so that contentHash and modificationStamp are not cached
+    _untrackedRows = False
+
     def __init__(self, name=None, columns=None):
 
         self.name = name
-        self.data = []
+        self._data = _LoopRowList(self)
 
         if columns:
             # print ('@~~@~', type(columns), list(columns), list(columns) == list(x for x in columns))
@@ -475,6 +891,16 @@ class Loop:
         """Column names"""
         return tuple(self._columns)
 
+    @property
+    def data(self):
+        """List of rows. Changes to the list and its LoopRows are tracked for contentHash"""
+        return self._data
+
+    @data.setter
+    def data(self, rows):
+        self._untrackedRows = False
+        self._data = _LoopRowList(self, rows)
+
     def newRow(self, values=None):
         """Add new row, initialised from values"""
 
@@ -482,25 +908,29 @@ class Loop:
         columns = self._columns
 
         if values is None:
-            row = LoopRow((x, None) for x in columns)
+            row = _LoopRowBase((x, None) for x in columns)
 
-        elif isinstance(values, dict):
+        elif isinstance(values, Mapping):
             if any(x for x in values if x not in columns):
                 raise ValueError("Illegal fields in row input: %s"
                                  % list(x for x in values if x not in columns))
             else:
-                row = LoopRow((x, values.get(x)) for x in columns)
+                row = _LoopRowBase((x, values.get(x)) for x in columns)
 
         else:
             if len(values) > len(columns):
                 raise ValueError("Row passed %s values for %s columns" % (len(values), len(columns)))
-            row = LoopRow(zip(columns, values))
+            row = _LoopRowBase(zip(columns, values))
         #
-        self.data.append(row)
+        row.__class__ = LoopRow
+        row._loop = self
+        list.append(self._data, row)
+        self._contentHash = self._modificationStamp = None
         return row
 
     def addColumn(self, columnName, paddingValue=sentinel):
         """Add new column to loop. if paddingValue is set, including to None, rows with None"""
+        self._contentHash = self._modificationStamp = None
         columns = self._columns
         if columnName in columns:
             raise ValueError("%s: duplicate column name: %s" % (self, columnName))
@@ -516,6 +946,7 @@ class Loop:
 
     def removeColumn(self, columnName, removeData=False):
         """Remove column from loop. Will NOT work properly if called during parsing."""
+        self._contentHash = self._modificationStamp = None
         columns = self._columns
         if columnName not in columns:
             raise ValueError("%s: column named %s does not exist" % (self, columnName))
@@ -529,12 +960,75 @@ class Loop:
         else:
             columns.remove(columnName)
 
+    def getColumnValues(self, columnName):
+        """Get list of values for column columnName, in row order"""
+        if columnName not in self._columns:
+            raise ValueError("%s: column named %s does not exist" % (self, columnName))
+        return [row.get(columnName) for row in self.data]
+
+    def getRowValues(self):
+        """Get list of rows, each a list of values in column order"""
+        return [list(row) for row in self._rowValues()]
+
+    def contentHash(self):
+        """Order-sensitive hash (hex string) of the loop name, columns and row values.
+
+        The hash is cached, and reset by changes through the loop functions, loop.data and its LoopRows.
+        It is not cached if loop.data contains other mutable rows, e.g. lists"""
+        result = self._contentHash
+        if result is None:
+            hasher = hashlib.blake2b(repr((self.name, tuple(self._columns))).encode('utf-8'), digest_size=16)
+            for row in self._rowValues():
+                hasher.update(repr(tuple(row)).encode('utf-8'))
+            result = hasher.hexdigest()
+            if not self._untrackedRows:
+                self._contentHash = result
+        return result
+
+    def resetContentHash(self):
+        """Reset the cached contentHash and modificationStamp"""
+        self._contentHash = self._modificationStamp = None
+
+    def modificationStamp(self):
+        """Number that changes whenever the loop is modified, for detecting modifications
+        e.g. to re-validate only what has changed.
+
+        As for contentHash, changes through loop.data and its LoopRows are included.
+        If loop.data contains other mutable rows, the number changes on every call"""
+        result = self._modificationStamp
+        if result is None:
+            result = next(_modificationStamps)
+            if not self._untrackedRows:
+                self._modificationStamp = result
+        return result
+
+    def _rowValues(self):
+        """Iterator over rows as sequences of values, in column order"""
+        data = self.data
+        if data and isinstance(data[0], OrderedDict):
+            return (list(x.values()) for x in data)
+        else:
+            # Must be a sequence of some kind. This will break for non-ordered dicts
+            return iter(data)
+
     def toString(self, indent=_defaultIndent, separator=_defaultSeparator):
         """Stringifier function for loop.
 
         Accepts (subtypes of) Loop with data as sequence of rows,
         where rows can be tuples, lists, or OrderedDicts.
         In all cases the values must be in the order given by the columns attribute"""
+        return ''.join(self._iterStrings(indent=indent, separator=separator))
+
+    def write(self, fp, indent=_defaultIndent, separator=_defaultSeparator, chunkSize=WRITE_CHUNK_ROWS):
+        """Write the same text as toString to open file fp, converting chunkSize rows at a time,
+        so that the whole text is never held in memory"""
+        _writeStrings(fp, self._iterStrings(indent=indent, separator=separator, chunkSize=chunkSize))
+
+    def _iterStrings(self, indent=_defaultIndent, separator=_defaultSeparator, chunkSize=None):
+        """Iterator over the strings making up the toString text.
+
+        If chunkSize is set, the values are converted chunkSize rows at a time, after a first pass
+        to get the column widths, so that the converted values are never all held in memory"""
 
         # main body format
         lineFormat = indent + _defaultIndent + '%s\n'
@@ -550,31 +1044,234 @@ class Loop:
             for col in self._columns:
                 lines.append(lineFormat % col)
         lines.append('\n')
+        yield ''.join(lines)
 
         # write data
         data = self.data
         if data:
+            # Values are converted and padded column by column.
+            # NB as for zip(*rows), columns are truncated to the shortest row
+            columns = self._columnValueLists()
+            rowIndent = indent + _defaultIndent
+
+            if chunkSize is None:
+                columns = [_columnToStarStrings(col) for col in columns]
+                columnWidths = [max(map(len, col)) for col in columns]
+                yield _columnsToString(columns, columnWidths, rowIndent, separator)
 
-            # First convert to strings to get correct columns widths
-            if isinstance((data[0]), OrderedDict):
-                data = [[valueToStarString(y) for y in list(x.values())] for x in self.data]
             else:
-                # Must be a sequence of some kind. This will break for non-ordered dicts
-                data = [[valueToStarString(y) for y in x] for x in self.data]
-
-            columnWidths = [max(len(x) for x in col) for col in zip(*data)]
-            for row in data:
-                ll = list('%-*s' % (wdth, row[ii]) for ii, wdth in enumerate(columnWidths))
-                # Remove trailing spaces from last column:
-                ll[-1] = ll[-1].rstrip()
-                lines.append(lineFormat %
-                             separator.join(ll)
-                             )
+                # Get the column widths without keeping the strings.
+                # The last column is not padded, so its width is not needed
+                columnWidths = [_columnStarWidth(col) for col in columns[:-1]] + [0]
+                rowCount = len(columns[0]) if columns else 0
+                for start in range(0, rowCount, chunkSize):
+                    chunk = [_columnToStarStrings(col[start:start + chunkSize]) for col in columns]
+                    yield _columnsToString(chunk, columnWidths, rowIndent, separator)
 
         # Add stop_
-        lines.append(indent + 'stop_\n')
+        yield indent + 'stop_\n'
+
+    def _columnValueLists(self):
+        """List of value sequences, one for each column, in column order"""
+        return [list(col) for col in zip(*self._rowValues())]
+
+
+class LoopRowView(Mapping):
+    """Row of a ColumnarLoop - a lightweight view on the loop column lists,
+    with the same interface as LoopRow for reading and modifying values.
 
-        return ''.join(lines)
+    Columns cannot be added or removed through the row; use the loop functions.
+    NB the view refers to a row position, so after deleting rows from loop.data
+    previously obtained views refer to the row now at that position."""
+
+    __slots__ = ('_loop', '_index')
+
+    def __init__(self, loop, index):
+        self._loop = loop
+        self._index = index
+
+    def __getitem__(self, key):
+        loop = self._loop
+        return loop._columnData[loop._columnIndex[key]][self._index]
+
+    def __setitem__(self, key, value):
+        loop = self._loop
+        try:
+            ii = loop._columnIndex[key]
+        except KeyError:
+            raise KeyError("%s has no column %s - use addColumn" % (loop, key))
+        loop._columnData[ii][self._index] = value
+        loop._contentHash = loop._modificationStamp = None
+
+    def __contains__(self, key):
+        return key in self._loop._columnIndex
+
+    def __iter__(self):
+        return iter(self._loop._columns)
+
+    def __len__(self):
+        return len(self._loop._columns)
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, list(self.items()))
+
+    def get(self, key, default=None):
+        loop = self._loop
+        ii = loop._columnIndex.get(key)
+        if ii is None:
+            return default
+        return loop._columnData[ii][self._index]
+
+    def keys(self):
+        return list(self._loop._columns)
+
+    def values(self):
+        index = self._index
+        return [col[index] for col in self._loop._columnData]
+
+    def items(self):
+        return list(zip(self._loop._columns, self.values()))
+
+    # Same multi-column access as LoopRow
+    _get = LoopRow._get
+    _set = LoopRow._set
+
+
+class _ColumnarLoopData(Sequence):
+    """Sequence of LoopRowView, used as the data attribute of ColumnarLoop"""
+
+    __slots__ = ('_loop',)
+
+    def __init__(self, loop):
+        self._loop = loop
+
+    def __len__(self):
+        return self._loop._rowCount
+
+    def __getitem__(self, index):
+        loop = self._loop
+        if isinstance(index, slice):
+            return [LoopRowView(loop, ii) for ii in range(*index.indices(loop._rowCount))]
+        if index < 0:
+            index += loop._rowCount
+        if not 0 <= index < loop._rowCount:
+            raise IndexError("%s: row index out of range" % loop)
+        return LoopRowView(loop, index)
+
+    def __delitem__(self, index):
+        loop = self._loop
+        count = len(range(*index.indices(loop._rowCount))) if isinstance(index, slice) else 1
+        for col in loop._columnData:
+            del col[index]
+        loop._rowCount -= count
+        loop._contentHash = loop._modificationStamp = None
+
+    def __iter__(self):
+        loop = self._loop
+        return (LoopRowView(loop, ii) for ii in range(loop._rowCount))
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+class ColumnarLoop(Loop):
+    """Loop storing its data as one list per column, rather than an OrderedDict per row.
+
+    Uses much less memory for large loops. loop.data is a sequence of LoopRowView,
+    created on access, so that loop.data[i]['col'] works as for Loop.
+    Rows can be modified or deleted from data, but new rows must be added with newRow."""
+
+    def __init__(self, name=None, columns=None):
+        # NB Loop.__init__ not called, as self.data is read-only
+        self.name = name
+        self._columns = list(columns) if columns else []
+        self._columnIndex = dict((col, ii) for ii, col in enumerate(self._columns))
+        self._columnData = [[] for col in self._columns]
+        self._rowCount = 0
+
+    @property
+    def data(self):
+        """Sequence of rows (LoopRowView)"""
+        # Made on access, so as not to make a reference cycle
+        return _ColumnarLoopData(self)
+
+    def newRow(self, values=None):
+        """Add new row, initialised from values.
+        Missing values are set to None"""
+
+        columns = self._columns
+
+        if values is None:
+            for col in self._columnData:
+                col.append(None)
+
+        elif isinstance(values, Mapping):
+            if any(x for x in values if x not in columns):
+                raise ValueError("Illegal fields in row input: %s"
+                                 % list(x for x in values if x not in columns))
+            else:
+                for ii, col in enumerate(self._columnData):
+                    col.append(values.get(columns[ii]))
+
+        else:
+            if len(values) > len(columns):
+                raise ValueError("Row passed %s values for %s columns" % (len(values), len(columns)))
+            for col, value in zip_longest(self._columnData, values):
+                col.append(value)
+        #
+        self._rowCount += 1
+        self._contentHash = self._modificationStamp = None
+        return LoopRowView(self, self._rowCount - 1)
+
+    def addColumn(self, columnName, paddingValue=sentinel):
+        """Add new column to loop. if paddingValue is set, including to None, rows with None"""
+        self._contentHash = self._modificationStamp = None
+        columns = self._columns
+        if columnName in columns:
+            raise ValueError("%s: duplicate column name: %s" % (self, columnName))
+        elif self._rowCount and paddingValue is sentinel:
+            raise ValueError("%s: Cannot add columns when loop contains data" % self)
+        else:
+            self._columnIndex[columnName] = len(columns)
+            columns.append(columnName)
+            self._columnData.append([paddingValue] * self._rowCount)
+
+    def removeColumn(self, columnName, removeData=False):
+        """Remove column from loop"""
+        self._contentHash = self._modificationStamp = None
+        columns = self._columns
+        if columnName not in columns:
+            raise ValueError("%s: column named %s does not exist" % (self, columnName))
+        elif self._rowCount and not removeData:
+            raise ValueError("%s: Cannot remove columns when loop contains data" % self)
+        else:
+            ii = columns.index(columnName)
+            del columns[ii]
+            del self._columnData[ii]
+            self._columnIndex = dict((col, jj) for jj, col in enumerate(columns))
+
+    def getColumnValues(self, columnName):
+        """Get list of values for column columnName, in row order"""
+        ii = self._columnIndex.get(columnName)
+        if ii is None:
+            raise ValueError("%s: column named %s does not exist" % (self, columnName))
+        return list(self._columnData[ii])
+
+    def _setColumnData(self, columnData):
+        """Replace the loop contents with columnData, a list of value lists in column order"""
+        if len(columnData) != len(self._columns) or len(set(len(x) for x in columnData)) > 1:
+            raise ValueError("%s: column data do not match %s columns" % (self, len(self._columns)))
+        self._columnData = [list(x) for x in columnData]
+        self._rowCount = len(columnData[0]) if columnData else 0
+        self._contentHash = self._modificationStamp = None
+
+    def _rowValues(self):
+        """Iterator over rows as sequences of values, in column order"""
+        return zip(*self._columnData)
+
+    def _columnValueLists(self):
+        """List of value sequences, one for each column, in column order"""
+        return self._columnData
 
 
 def valueToStarString(value, quoteNumberStrings=False):
@@ -662,8 +1359,297 @@ def valueToStarString(value, quoteNumberStrings=False):
         return value
 
 
+def _columnToStarStrings(values):
+    """Convert a column of values to properly quoted STAR strings, as valueToStarString.
+
+    Columns of None and one other type (float, int, UnquotedValue, or strings that need no
+    quoting) are converted in bulk; other columns value by value"""
+
+    types = set(map(type, values))
+    hasNone = type(None) in types
+    if hasNone:
+        types.remove(type(None))
+    if len(types) == 1:
+        valueType = types.pop()
+
+        if valueType is float:
+            # NB filter drops None and zeros, which are finite
+            if all(map(math.isfinite, filter(None, values))):
+                if hasNone:
+                    return [NULLSTRING if x is None else _floatingPointFormat % x for x in values]
+                return [_floatingPointFormat % x for x in values]
+
+        elif valueType is int:
+            if hasNone:
+                return [NULLSTRING if x is None else str(x) for x in values]
+            return list(map(str, values))
+
+        elif valueType is UnquotedValue or valueType is str:
+            if valueType is str:
+                distinct = set(values)
+                distinct.discard(None)
+                if not distinct.isdisjoint(_quoteStrings) or not all(map(_isPlainStarString, distinct)):
+                    return list(map(valueToStarString, values))
+            if hasNone:
+                return [NULLSTRING if x is None else x for x in values]
+            return values
+
+    elif not types:
+        # All None
+        return [NULLSTRING] * len(values)
+
+    return list(map(valueToStarString, values))
+
+
+def _columnStarWidth(values):
+    """Length of the longest STAR string for a column of values, as from _columnToStarStrings.
+
+    For columns of None and int, UnquotedValue, or strings that need no quoting, the width is found
+    without converting the values; other columns are converted"""
+
+    types = set(map(type, values))
+    hasNone = type(None) in types
+    if hasNone:
+        types.remove(type(None))
+        if not types:
+            return len(NULLSTRING)
+    minWidth = len(NULLSTRING) if hasNone else 0
+
+    if len(types) == 1:
+        valueType = types.pop()
+
+        if valueType is int:
+            # The longest string is that of the largest or smallest value
+            ints = list(filter(None, values)) if hasNone else values
+            if ints:
+                return max(minWidth, len(str(max(ints))), len(str(min(ints))))
+            return max(minWidth, 1)
+
+        elif valueType is UnquotedValue or valueType is str:
+            distinct = set(values)
+            distinct.discard(None)
+            if valueType is UnquotedValue or (distinct.isdisjoint(_quoteStrings)
+                                              and all(map(_isPlainStarString, distinct))):
+                return max(minWidth, max(map(len, distinct)))
+
+    return max(map(len, _columnToStarStrings(values)))
+
+
+def _columnsToString(columns, columnWidths, rowIndent, separator):
+    """Format columns of strings as rows, padded to columnWidths"""
+
+    # NB trailing spaces are removed from the last column
+    lastColumn = [x.rstrip() for x in columns[len(columnWidths) - 1]]
+    rowFormat = (rowIndent.replace('%', '%%')
+                 + ''.join('%%-%ss%s' % (wdth, separator.replace('%', '%%')) for wdth in columnWidths[:-1])
+                 + '%s\n')
+    return ''.join(map(rowFormat.__mod__, zip(*(columns[:len(columnWidths) - 1] + [lastColumn]))))
+
+
+# Event names, as sent to StarEventHandler methods (push) or yielded by iterEvents (pull).
+# Events are tuples (eventName, *arguments):
+EVENT_START_DATABLOCK = 'startDataBlock'  # (name,)
+EVENT_END_DATABLOCK = 'endDataBlock'  # (name,)
+EVENT_START_SAVEFRAME = 'startSaveFrame'  # (name,)
+EVENT_END_SAVEFRAME = 'endSaveFrame'  # (name,)
+EVENT_ITEM = 'item'  # (tag, value)
+EVENT_LOOP_HEADER = 'loopHeader'  # (columns,) - start of loop, columns is a tuple of tags
+EVENT_LOOP_ROW = 'loopRow'  # (values,) - values is a tuple matching columns
+EVENT_END_LOOP = 'endLoop'  # ()
+_eventNames = (EVENT_START_DATABLOCK, EVENT_END_DATABLOCK, EVENT_START_SAVEFRAME, EVENT_END_SAVEFRAME,
+               EVENT_ITEM, EVENT_LOOP_HEADER, EVENT_LOOP_ROW, EVENT_END_LOOP)
+
+
+class StarEventHandler:
+    """Base class for consumers of the GeneralStarParser event stream.
+
+    Override the methods for the events of interest; the defaults do nothing.
+    Values are passed as str (quoted) or UnquotedValue, and tags follow the parser
+    lowerCaseTags setting, exactly as they appear in the tree built by parse().
+    Loop rows are sent one at a time, so handlers that do not keep them run in constant memory.
+    """
+
+    def startDataBlock(self, name):
+        pass
+
+    def endDataBlock(self, name):
+        pass
+
+    def startSaveFrame(self, name):
+        pass
+
+    def endSaveFrame(self, name):
+        pass
+
+    def item(self, tag, value):
+        pass
+
+    def loopHeader(self, columns):
+        pass
+
+    def loopRow(self, values):
+        pass
+
+    def endLoop(self):
+        pass
+
+
+class StarTreeBuilder(StarEventHandler):
+    """Event handler building the DataExtent object tree returned by parse()
+
+    loops are made as loopClass, Loop or ColumnarLoop"""
+
+    def __init__(self, loopClass=Loop):
+        self.result = DataExtent()
+        self.stack = [self.result]
+        self.loop = None
+        self.loopClass = loopClass
+
+    def _startContainer(self, obj):
+        self.stack[-1].addItem(obj.name, obj)
+        self.stack.append(obj)
+
+    def startDataBlock(self, name):
+        self._startContainer(DataBlock(name))
+
+    def endDataBlock(self, name):
+        self.stack.pop()
+
+    def startSaveFrame(self, name):
+        self._startContainer(SaveFrame(name))
+
+    def endSaveFrame(self, name):
+        self.stack.pop()
+
+    def item(self, tag, value):
+        self.stack[-1].addItem(tag, value)
+
+    def loopHeader(self, columns):
+        container = self.stack[-1]
+        loop = self.loop = self.loopClass(name=columns[0])
+        for column in columns:
+            loop.addColumn(column)
+            container.addItem(column, loop)
+
+    def loopRow(self, values):
+        self.loop.newRow(values=values)
+
+    def endLoop(self):
+        self.loop = None
+
+
+class SaveFrameFilter:
+    """Selection of the SaveFrames and loop columns passed on by GeneralStarParser.
+
+    A SaveFrame is accepted if its category is in includeCategories (if given)
+    and not in excludeCategories (if given). The category is taken from the prefix of the
+    first item tag (e.g. 'nef_chemical_shift_list' for '_nef_chemical_shift_list.sf_category');
+    SaveFrames starting with a loop, or without items, are always accepted.
+
+    loopColumns is a dictionary {loop category: column names}, e.g.
+    {'nef_chemical_shift': ['chain_code', 'sequence_code', 'atom_name', 'value']}"""
+
+    def __init__(self, includeCategories=None, excludeCategories=None, loopColumns=None, lowerCase=True):
+
+        convert = (lambda x: x.lower()) if lowerCase else (lambda x: x)
+        self.includeCategories = (None if includeCategories is None
+                                  else frozenset(convert(x) for x in includeCategories))
+        self.excludeCategories = frozenset(convert(x) for x in excludeCategories or ())
+        self.loopColumns = dict((convert(category), frozenset(convert(x) for x in columns))
+                                for category, columns in (loopColumns or {}).items())
+
+    @classmethod
+    def make(cls, includeCategories=None, excludeCategories=None, loopColumns=None, lowerCase=True):
+        """Make filter, or return None if there is nothing to filter"""
+        if includeCategories is None and not excludeCategories and not loopColumns:
+            return None
+        return cls(includeCategories, excludeCategories, loopColumns, lowerCase=lowerCase)
+
+    def key(self):
+        """Hashable summary of the filter settings, e.g. for cache keys"""
+        return (None if self.includeCategories is None else tuple(sorted(self.includeCategories)),
+                tuple(sorted(self.excludeCategories)),
+                tuple(sorted((x, tuple(sorted(y))) for x, y in self.loopColumns.items())))
+
+    def acceptsCategory(self, category):
+        """True if SaveFrames of category are accepted"""
+        if category in self.excludeCategories:
+            return False
+        return self.includeCategories is None or category in self.includeCategories
+
+    def loopColumnIndices(self, columns):
+        """Get indices of the accepted loop columns, from full column names ('_category.name'),
+        or None if all columns are accepted"""
+        if not self.loopColumns:
+            return None
+        category = columns[0][1:].split('.', 1)[0]
+        accepted = self.loopColumns.get(category)
+        if accepted is None:
+            return None
+        result = [ii for ii, column in enumerate(columns) if column.split('.', 1)[-1] in accepted]
+        return None if len(result) == len(columns) else result
+
+
+class _ParserContext:
+    """Lightweight placeholder for an open DataExtent, DataBlock or SaveFrame on the parser stack"""
+
+    __slots__ = ('name',)
+
+    # Name of the matching tree class, for messages
+    typeName = None
+
+    def __init__(self, name):
+        self.name = name
+
+    def __str__(self):
+        return '%s(name=%s)' % (self.typeName, self.name)
+
+
+class _DataExtentContext(_ParserContext):
+    __slots__ = ()
+    typeName = 'DataExtent'
+
+
+class _DataBlockContext(_ParserContext):
+    __slots__ = ()
+    typeName = 'DataBlock'
+
+
+class _SaveFrameContext(_ParserContext):
+    __slots__ = ()
+    typeName = 'SaveFrame'
+
+
+class _LoopContext(_ParserContext):
+    """Open loop on the parser stack: column names, the values of the current row,
+    and the interned unquoted values of each column"""
+
+    __slots__ = ('columns', 'row', 'rowCount', 'headerDone', 'internTables', 'keepColumns')
+    typeName = 'Loop'
+
+    def __init__(self):
+        super(_LoopContext, self).__init__('loop_')
+        self.columns = []
+        self.row = []
+        self.rowCount = 0
+        self.headerDone = False
+        self.internTables = None
+        # Indices of the columns passed on, if filtered, otherwise None
+        self.keepColumns = None
+
+    def __str__(self):
+        return '<Loop:%s>' % self.name
+
+    @property
+    def hasData(self):
+        return bool(self.rowCount or self.row)
+
+
 class GeneralStarParser:
-    """ Parser for text corresponding to a STAR file with one or more data blocks,
+    """ Parser for text corresponding to a STAR file with one or more data blocks.
+
+    The parser produces a stream of events (see StarEventHandler), either pulled with iterEvents()
+    or pushed to a handler with parseEvents(handler). parse() feeds the events to a StarTreeBuilder,
     producing a nested object structure matching the file (see module documentation for details:
 
     ::
@@ -678,7 +1664,8 @@ class GeneralStarParser:
 
     Parameters (default values correspond to the International Tables for Crystallography standard):
 
-    - *text* Text to parse
+    - *text* Text to parse. May also be a bytes-like object (e.g. an mmap) with utf-8 encoded text,
+      which is tokenised without decoding it as a whole
 
     - *enforceSaveFrameStop* : True. Raise an error for missing 'save_' terminators - Yes/No
 
@@ -690,10 +1677,20 @@ class GeneralStarParser:
 
     - *lowerCaseTags* : True. Convert all data and object names to lower case
 
+    Filters (see SaveFrameFilter), to parse only part of the text:
+
+    - *includeCategories* : None. If given, only SaveFrames of these categories are passed on
+
+    - *excludeCategories* : None. SaveFrames of these categories are not passed on
+
+    - *loopColumns* : None. Dictionary {loop category: column names}. Only these columns are passed
+      on for loops of the category; loops with none of the columns are left out
+
     """
 
     def __init__(self, text, enforceSaveFrameStop=True, enforceLoopStop=False,
-                 padIncompleteLoops=False, allowSquareBracketStrings=False, lowerCaseTags=True):
+                 padIncompleteLoops=False, allowSquareBracketStrings=False, lowerCaseTags=True,
+                 includeCategories=None, excludeCategories=None, loopColumns=None):
 
         self.enforceSaveFrameStop = enforceSaveFrameStop
         self.enforceLoopStop = enforceLoopStop
@@ -701,67 +1698,177 @@ class GeneralStarParser:
         self.allowSquareBracketStrings = allowSquareBracketStrings
         self.lowerCaseTags = lowerCaseTags
 
-        self.tokeniser = getTokenIterator(text)
+        self.filter = SaveFrameFilter.make(includeCategories, excludeCategories, loopColumns,
+                                           lowerCase=lowerCaseTags)
+
+        # Name of a SaveFrame whose start event waits for its category to be known (only when filtering),
+        # the context of a SaveFrame that is being skipped, and the offset to continue tokenising from
+        self._pendingSaveFrame = None
+        self._skippedSaveFrame = None
+        self._restartOffset = None
+
         self.text = text
+        self.tokeniser = self._getTokeniser()
 
         self.stack = []
         self.globalsCounter = 0
+        self.counter = 0
+
+        # Offset in text of the current token, and offsets of the line starts, made when needed
+        self.tokenStart = 0
+        self._lineStarts = None
+
+        # Events generated by the current token, waiting to be passed on
+        self.events = []
+
+        # Active Profiling.ParseProfile while parsing, if any
+        self.profile = None
 
     def _addDataBlock(self, name):
-        container = self.stack[-1]
-        obj = DataBlock(name)
-        container.addItem(name, obj)
-        self.stack.append(obj)
+        self.stack.append(_DataBlockContext(name))
+        self.events.append((EVENT_START_DATABLOCK, name))
 
     def _addSaveFrame(self, name):
-        container = self.stack[-1]
-        obj = SaveFrame(name)
-        container.addItem(name, obj)
-        self.stack.append(obj)
+        self.stack.append(_SaveFrameContext(name))
+        if self.filter is None:
+            self.events.append((EVENT_START_SAVEFRAME, name))
+        else:
+            # Start event is sent once the category is known, see _startPendingSaveFrame
+            self._pendingSaveFrame = name
+
+    def _startPendingSaveFrame(self):
+        """Send the start event of a SaveFrame waiting for its category"""
+        self.events.append((EVENT_START_SAVEFRAME, self._pendingSaveFrame))
+        self._pendingSaveFrame = None
+
+    def _popDataBlock(self):
+        self.events.append((EVENT_END_DATABLOCK, self.stack.pop().name))
+
+    def _popSaveFrame(self):
+        if self._pendingSaveFrame is not None:
+            # SaveFrame without items - keep it
+            self._startPendingSaveFrame()
+        saveFrame = self.stack.pop()
+        if saveFrame is self._skippedSaveFrame:
+            self._skippedSaveFrame = None
+        else:
+            self.events.append((EVENT_END_SAVEFRAME, saveFrame.name))
 
-    def _closeLoop(self, value):
+    def _getTokeniser(self, start=0):
+        """Get token iterator for the text, from offset start"""
+        if isinstance(self.text, str):
+            return getTokenIterator(self.text, start=start)
+        else:
+            return getBytesTokenIterator(self.text, start=start)
 
-        stack = self.stack
-        data = stack.pop()
-        loop = stack.pop()
-        if not isinstance(loop, Loop):
-            if isinstance(data, Loop):
-                raise TypeError("Implementation error, loop not correctly put on stack")
+    def _restartableTokens(self):
+        """Iterator over the tokens, continuing from self._restartOffset when that is set"""
+        while True:
+            for tk in self.tokeniser:
+                yield tk
+                if self._restartOffset is not None:
+                    break
             else:
-                raise StarSyntaxError(self._errorMessage("Loop stop_ %s outside loop" % value, value))
-
-        columnCount = len(loop._columns)
-        if not columnCount:
-            raise StarSyntaxError(self._errorMessage(" loop lacks column names", value))
+                return
+            self.tokeniser = self._getTokeniser(self._restartOffset)
+            self._restartOffset = None
 
-        if data:
+    def _skipSaveFrame(self):
+        """Skip the tokens of the current SaveFrame up to its end, without generating events,
+        making values, or checking the SaveFrame contents.
 
-            if len(data) % columnCount:
-                if self.padIncompleteLoops:
-                    print("WARNING Token %s: %s in %s is missing %s values. Last row was: %s"
-                          % (self.counter, loop, self.stack[-2],
-                             columnCount - (len(data) % columnCount), data[-1]))
-                else:
-                    raise StarSyntaxError(
-                            self._errorMessage("loop %s is missing %s values"
-                                               % (loop, (columnCount - (len(data) % columnCount))), value)
-                            )
+        If the end is a 'save_', 'data_' or 'global_' at the start of a line, with no multi-line strings
+        or other such names on the way, tokenising continues from there; otherwise the tokens are read
+        and discarded. NB token counts do not include the skipped tokens"""
 
-            # Make rows:
-            args = [iter(data)] * columnCount
-            for tt in zip_longest(*args, fillvalue=NULLSTRING):
-                loop.newRow(values=tt)
+        self._pendingSaveFrame = None
+        self._skippedSaveFrame = self.stack[-1]
 
+        text = self.text
+        if isinstance(text, str):
+            structurePattern, namePattern = _structurePattern, _structureNamePattern
         else:
+            structurePattern, namePattern = _bytesStructurePattern, _bytesStructureNamePattern
+        start = self.tokenStart
+        match = structurePattern.search(text, start)
+        if (match is not None and match.group(1) is None
+                and namePattern.search(text, start, match.start(2)) is None):
+            self._restartOffset = match.start(2)
+            return
+
+        for tk in self.tokeniser:
+            self.counter += 1
+            typ, value, self.tokenStart = tk
+            if typ == TOKEN_SAVE_FRAME:
+                self._closeSaveFrame(value)
+                if len(value) > 5:
+                    self._openSaveFrame(value)
+                return
+            elif typ == TOKEN_DATA_BLOCK:
+                self._processDataBlock(value)
+                return
+            elif typ == TOKEN_GLOBAL:
+                self._processGlobal(value)
+                return
+
+    def _endLoopHeader(self, loop, value):
+        """Loop header is complete - send it on"""
+        if not loop.columns:
+            raise StarSyntaxError(self._errorMessage(" loop lacks column names", value))
+        loop.headerDone = True
+        loop.internTables = [{} for x in loop.columns]
+        if self.filter is not None:
+            loop.keepColumns = self.filter.loopColumnIndices(loop.columns)
+            if loop.keepColumns is not None:
+                if loop.keepColumns:
+                    self.events.append((EVENT_LOOP_HEADER, tuple(loop.columns[ii] for ii in loop.keepColumns)))
+                return
+        self.events.append((EVENT_LOOP_HEADER, tuple(loop.columns)))
+
+    def _addLoopRow(self, loop, row):
+        """Send loop row values"""
+        keepColumns = loop.keepColumns
+        if keepColumns is None:
+            self.events.append((EVENT_LOOP_ROW, tuple(row)))
+        elif keepColumns:
+            self.events.append((EVENT_LOOP_ROW, tuple(row[ii] for ii in keepColumns)))
+
+    def _closeLoop(self, value):
+
+        stack = self.stack
+        loop = stack[-1]
+        if not isinstance(loop, _LoopContext):
+            raise StarSyntaxError(self._errorMessage("Loop stop_ %s outside loop" % value, value))
+        if not loop.headerDone:
             # empty loops appear here. We allow them, but that could change
-            pass
+            self._endLoopHeader(loop, value)
+
+        row = loop.row
+        if row:
+            columnCount = len(loop.columns)
+            if self.padIncompleteLoops:
+                print("WARNING Token %s: %s in %s is missing %s values. Last row was: %s"
+                      % (self.counter, loop, stack[-2],
+                         columnCount - len(row), row[-1]))
+                row.extend([NULLSTRING] * (columnCount - len(row)))
+                self._addLoopRow(loop, row)
+            else:
+                raise StarSyntaxError(
+                        self._errorMessage("loop %s is missing %s values"
+                                           % (loop, (columnCount - len(row))), value)
+                        )
+        stack.pop()
+        if loop.keepColumns != []:
+            self.events.append((EVENT_END_LOOP,))
+        if self.profile is not None:
+            self.profile.count(Profiling.PHASE_BUILD, loops=1, rows=loop.rowCount,
+                               cells=loop.rowCount * len(loop.columns))
 
     def _addLoopField(self, value):
 
         stack = self.stack
-        loop = stack[-2]
-        data = stack[-1]
-        if data:
+        loop = stack[-1]
+        if loop.hasData:
             if self.enforceLoopStop:
                 raise StarSyntaxError(
                         self._errorMessage("Illegal token %s in unclosed loop" % value, value)
@@ -771,11 +1878,10 @@ class GeneralStarParser:
                 self._closeLoop(value)
                 stack.append(value)
         else:
-            if not loop._columns:
+            if not loop.columns:
                 # name loop after first column
                 loop.name = value
-            loop.addColumn(value)
-            stack[-3].addItem(value, loop)
+            loop.columns.append(value)
 
     def _processComment(self, value):
         # Comments are ignored
@@ -799,7 +1905,7 @@ class GeneralStarParser:
             self.globalsCounter = 1
 
         # Terminate open elements
-        if isinstance(stack[-1], list):
+        if isinstance(stack[-1], _LoopContext):
             if self.enforceLoopStop:
                 raise StarSyntaxError(
                         self._errorMessage("Loop terminated by %s instead of stop_" % value, value)
@@ -808,19 +1914,19 @@ class GeneralStarParser:
                 # Close loop and pop it off the stack
                 self._closeLoop(value)
 
-        if isinstance(stack[-1], SaveFrame):
+        if isinstance(stack[-1], _SaveFrameContext):
             if self.enforceSaveFrameStop:
                 raise StarSyntaxError(
                         self._errorMessage("SaveFrame terminated by %s instead of save_" % value, value)
                         )
             else:
-                stack.pop()
+                self._popSaveFrame()
 
-        if isinstance(stack[-1], DataBlock):
-            stack.pop()
+        if isinstance(stack[-1], _DataBlockContext):
+            self._popDataBlock()
 
         # Add new DataBlock
-        if isinstance(stack[-1], DataExtent):
+        if isinstance(stack[-1], _DataExtentContext):
             if self.lowerCaseTags:
                 value = value.lower()
             self._addDataBlock(value)
@@ -834,7 +1940,7 @@ class GeneralStarParser:
         lowerValue = value.lower()
 
         # Terminate loop
-        if isinstance(stack[-1], list):
+        if isinstance(stack[-1], _LoopContext):
             if self.enforceLoopStop:
                 raise StarSyntaxError(
                         self._errorMessage("Loop terminated by %s instead of stop_" % value, value)
@@ -844,19 +1950,19 @@ class GeneralStarParser:
                 self._closeLoop(value)
 
         # terminate saveframe
-        if isinstance(stack[-1], SaveFrame):
+        if isinstance(stack[-1], _SaveFrameContext):
             if lowerValue == 'save_':
                 # Simple terminator. Close save frame
-                stack.pop()  #
+                self._popSaveFrame()
 
             elif self.enforceSaveFrameStop:
                 self._errorMessage("SaveFrame terminated by %s instead of save_" % value, value)
 
             else:
                 # New saveframe start. We are missing the terminator, but close and continue anyway
-                stack.pop()
+                self._popSaveFrame()
 
-        if not isinstance((stack[-1]), DataBlock):
+        if not isinstance((stack[-1]), _DataBlockContext):
             if lowerValue == 'save_':
                 raise StarSyntaxError(self._errorMessage("'%s' found out of context" % value, value))
 
@@ -867,7 +1973,7 @@ class GeneralStarParser:
         # Add new SaveFrame
         if self.lowerCaseTags:
             value = value.lower()
-        if isinstance(stack[-1], DataBlock):
+        if isinstance(stack[-1], _DataBlockContext):
             self._addSaveFrame(value)
         else:
             raise StarSyntaxError(
@@ -879,8 +1985,8 @@ class GeneralStarParser:
         stack = self.stack
 
         # Terminate open elements
-        if isinstance(stack[-1], list):
-            if not stack[-1]:
+        if isinstance(stack[-1], _LoopContext):
+            if not stack[-1].hasData:
                 # NB, nested loops are not supported
                 raise StarSyntaxError(
                         self._errorMessage("Loop terminated by %s instead of stop_" % value, value)
@@ -893,10 +1999,12 @@ class GeneralStarParser:
                 # Close loop and pop it off the stack
                 self._closeLoop(value)
 
-        if isinstance(stack[-1], (SaveFrame, DataBlock)):
-            # NB Loop naming and adding to container is done when first column name is read
-            stack.append(Loop(name='loop_'))
-            stack.append(list())
+        if isinstance(stack[-1], (_SaveFrameContext, _DataBlockContext)):
+            if self._pendingSaveFrame is not None:
+                # SaveFrame starting with a loop - keep it
+                self._startPendingSaveFrame()
+            # NB Loop naming is done when first column name is read
+            stack.append(_LoopContext())
 
         else:
             raise StarSyntaxError(self._errorMessage("loop_ out of context", value))
@@ -909,9 +2017,16 @@ class GeneralStarParser:
         stack = self.stack
 
         useValue = value.lower() if self.lowerCaseTags else value
-        if isinstance(stack[-1], (SaveFrame, DataBlock)):
+        if isinstance(stack[-1], (_SaveFrameContext, _DataBlockContext)):
+            if self._pendingSaveFrame is not None:
+                # First item of a SaveFrame - its prefix gives the category
+                if self.filter.acceptsCategory(useValue[1:].split('.', 1)[0]):
+                    self._startPendingSaveFrame()
+                else:
+                    self._skipSaveFrame()
+                    return
             stack.append(useValue)
-        elif isinstance(stack[-1], list):
+        elif isinstance(stack[-1], _LoopContext):
             self._addLoopField(useValue)
         else:
             raise StarSyntaxError(self._errorMessage(
@@ -924,19 +2039,37 @@ class GeneralStarParser:
         if isinstance(last, str):
             # Value half of tag, value pair
             stack.pop()
-            stack[-1].addItem(last, value)
+            self.events.append((EVENT_ITEM, last, value))
+        elif isinstance(last, _LoopContext):
+            if not last.headerDone:
+                self._endLoopHeader(last, value)
+            row = last.row
+            if value.__class__ is UnquotedValue:
+                # Share one object between equal values in a column
+                table = last.internTables[len(row)]
+                interned = table.get(value)
+                if interned is not None:
+                    value = interned
+                elif len(table) < MAX_INTERNED_VALUES:
+                    table[value] = value
+            row.append(value)
+            if len(row) == len(last.columns):
+                if last.keepColumns is None:
+                    self.events.append((EVENT_LOOP_ROW, tuple(row)))
+                else:
+                    self._addLoopRow(last, row)
+                row.clear()
+                last.rowCount += 1
         else:
-            try:
-                func = last.append
-            except AttributeError:
-                raise StarSyntaxError(self._errorMessage("Data value %s must be in item or loop_" % value,
-                                                         value))
-            func(value)
+            raise StarSyntaxError(self._errorMessage("Data value %s must be in item or loop_" % value,
+                                                     value))
 
-    def parse(self):
+    def iterEvents(self):
+        """Iterator over the parser events (see StarEventHandler), as tuples (eventName, *arguments)"""
 
         # Speed optimisation:
         processValue = self.processValue
+        events = self.events
 
         # NBNB This list must be in sync with numerical values of tk.type, as returned from the tokeniser
         processFunctions = [None] * 20
@@ -954,95 +2087,131 @@ class GeneralStarParser:
         # quotedValueTags = (TOKEN_SQUOTE_STRING, TOKEN_DQUOTE_STRING, TOKEN_MULTILINE)
 
         stack = self.stack
-
-        result = DataExtent()
-        stack.append(result)
+        stack.append(_DataExtentContext('Root'))
 
         value = None
         self.counter = 0  # Token counter
-        try:
-            for tk in self.tokeniser:
-                self.counter += 1
-                typ, value = tk
+        tokens = self.tokeniser if self.filter is None else self._restartableTokens()
+        self.profile = Profiling.activeProfile()
+        if self.profile is not None:
+            tokens = Profiling.timedTokens(self.profile, tokens)
+        for tk in tokens:
+            self.counter += 1
+            typ, value, self.tokenStart = tk
+
+            if typ in unquotedValueTags:
+                value = UnquotedValue(value)
+                processValue(value)
 
-                if typ in unquotedValueTags:
-                    value = UnquotedValue(value)
-                    processValue(value)
+            else:
+                func = processFunctions[typ]
 
-                else:
-                    func = processFunctions[typ]
+                if func is None:
 
-                    if func is None:
+                    if typ == TOKEN_SAVE_FRAME:
+                        # save_ string
+                        self._closeSaveFrame(value)
+                        if len(value) > 5:
+                            self._openSaveFrame(value)
 
-                        if typ == TOKEN_SAVE_FRAME:
-                            # save_ string
-                            self._closeSaveFrame(value)
-                            if len(value) > 5:
-                                self._openSaveFrame(value)
+                    elif typ in (TOKEN_BAD_CONSTRUCT, TOKEN_BAD_TOKEN):
+                        self._processBadToken(value, typ)
 
-                        elif typ in (TOKEN_BAD_CONSTRUCT, TOKEN_BAD_TOKEN):
+                    elif typ == TOKEN_SQUARE_BRACKET:
+                        if self.allowSquareBracketStrings:
+                            processValue(UnquotedValue(value))
+                        else:
                             self._processBadToken(value, typ)
 
-                        elif typ == TOKEN_SQUARE_BRACKET:
-                            if self.allowSquareBracketStrings:
-                                processValue(UnquotedValue(value))
-                            else:
-                                self._processBadToken(value, typ)
-
-                        else:
-                            raise StarSyntaxError("Unknown token type: %s" % typ)
                     else:
-                        func(value)
+                        raise StarSyntaxError("Unknown token type: %s" % typ)
+                else:
+                    func(value)
+
+            if events:
+                yield from events
+                events.clear()
+
+        # End of data - clean up stack
+        if isinstance(stack[-1], str):
+            raise StarSyntaxError(self._errorMessage("File ends with item name", value))
+
+        if isinstance(stack[-1], _LoopContext):
+            self._closeLoop('<End-of-File>')
 
-            # End of data - clean up stack
-            if isinstance(stack[-1], str):
-                raise StarSyntaxError(self._errorMessage("File ends with item name", value))
+        if isinstance(stack[-1], _SaveFrameContext):
+            self._popSaveFrame()
 
-            if isinstance(stack[-1], list):
-                self._closeLoop('<End-of-File>')
+        if isinstance(stack[-1], _DataBlockContext):
+            self._popDataBlock()
 
-            if isinstance(stack[-1], SaveFrame):
-                stack.pop()
+        if isinstance(stack[-1], _DataExtentContext):
+            stack.pop()
+
+        if stack:
+            raise RuntimeError(self._errorMessage("stack not empty at end of file", value))
 
-            if isinstance(stack[-1], DataBlock):
-                stack.pop()
+        yield from events
+        events.clear()
 
-            if isinstance(stack[-1], DataExtent):
-                stack.pop()
+    def parseEvents(self, handler):
+        """Parse the text, calling the matching handler method (see StarEventHandler) for each event.
+        Returns handler"""
 
-            if stack:
-                raise RuntimeError(self._errorMessage("stack not empty at end of file", value))
+        handlerFunctions = dict((name, getattr(handler, name)) for name in _eventNames)
+        rowFunction = handlerFunctions[EVENT_LOOP_ROW]
+        try:
+            with Profiling.phase(Profiling.PHASE_BUILD):
+                for event in self.iterEvents():
+                    if event[0] is EVENT_LOOP_ROW:
+                        rowFunction(event[1])
+                    else:
+                        handlerFunctions[event[0]](*event[1:])
         except:
             print("ERROR at token %s" % self.counter)
+            # Release the tokeniser, so that a memory-mapped input can be closed
+            self.tokeniser.close()
             raise
         #
-        return result
+        return handler
+
+    def parse(self, columnar=False):
+        """Parse the text and return the DataExtent object tree.
+        If columnar, loops are made as ColumnarLoop"""
+        loopClass = ColumnarLoop if columnar else Loop
+        return self.parseEvents(StarTreeBuilder(loopClass=loopClass)).result
+
+    def location(self, offset=None):
+        """Get (line, column) in the text, both counting from 1, of offset in the text
+        (in bytes for bytes input). Defaults to the start of the current token"""
+
+        if offset is None:
+            offset = self.tokenStart
+
+        text = self.text
+        lineStarts = self._lineStarts
+        if lineStarts is None:
+            # Made once, on the first call
+            lineEnd = _lineEnd if isinstance(text, str) else _bytesLineEnd
+            lineStarts = self._lineStarts = [0]
+            lineStarts.extend(x.end() for x in lineEnd.finditer(text))
+
+        line = bisect.bisect_right(lineStarts, offset)
+        lineStart = lineStarts[line - 1]
+        if isinstance(text, str):
+            column = offset - lineStart + 1
+        else:
+            column = len(bytes(text[lineStart:offset]).decode('utf-8', 'replace')) + 1
+        #
+        return line, column
 
     def _errorMessage(self, msg, value):
         """Make standard error message"""
-        template = "Error in context: %s, at token %s, line: %s\n%s"
+        template = "Error in context: %s, at token %s, line: %s, column: %s\n%s"
         tags = [(x if isinstance(x, str) else x.name) for x in self.stack[1:]] + [value]
-
-        lines = self.text.splitlines()
-        lineCount = len(lines)
-        ii = 0
-        if tags:
-            jj = 0
-            tag = tags[jj]
-            while ii < lineCount:
-                if tag in lines[ii].lower().split():
-                    # This line contains the current tag - go to the next tag
-                    jj += 1
-                    if jj < len(tags):
-                        tag = tags[jj]
-                    else:
-                        # This line contains the last of the tags - it is the line we want
-                        break
-                else:
-                    # nothing found here - try next line
-                    ii += 1
+        line, column = self.location()
         #
-        return template % (tags[:-1], tags[-1], ii + 1, msg)  #
+        return template % (tags[:-1], tags[-1], line, column, msg)
 
 
 def extractMatchingNameSequence(name, matchNames):
@@ -0,0 +1,124 @@
+"""Alignment of the rows of two loops on their key columns, for comparing NEF files
+
+Used by both the nef and CompareNef command line programs.
+
+  loopKeysArgument      argparse type for --keys loop:column,column
+  getLoopKeyColumns     key columns from --keys or, with --keyalign, the NEF specification
+  alignLoopRows         match the rows of two Loop objects on their key columns
+
+"""
+#=========================================================================================
+# Licence, Reference and Credits
+#=========================================================================================
+__copyright__ = "Copyright (C) CCPN project (http://www.ccpn.ac.uk) 2014 - 2021"
+__credits__ = ("Ed Brooksbank, Joanna Fox, Victoria A Higman, Luca Mureddu, Eliza Płoskoń",
+               "Timothy J Ragan, Brian O Smith, Gary S Thompson & Geerten W Vuister")
+__licence__ = ("CCPN licence. See http://www.ccpn.ac.uk/v3-software/downloads/license")
+__reference__ = ("Skinner, S.P., Fogh, R.H., Boucher, W., Ragan, T.J., Mureddu, L.G., & Vuister, G.W.",
+                 "CcpNmr AnalysisAssign: a flexible platform for integrated NMR analysis",
+                 "J.Biomol.Nmr (2016), 66, 111-124, http://doi.org/10.1007/s10858-016-0060-y")
+#=========================================================================================
+# Last code modification
+#=========================================================================================
+__modifiedBy__ = "$modifiedBy: Ed Brooksbank $"
+__dateModified__ = "$dateModified: 2021-05-10 18:47:35 +0100 (Mon, May 10, 2021) $"
+__version__ = "$Revision: 3.0.4 $"
+#=========================================================================================
+# Created
+#=========================================================================================
+__author__ = "$Author: CCPN $"
+__date__ = "$Date: 2017-04-07 10:28:41 +0000 (Fri, April 07, 2017) $"
+#=========================================================================================
+# Start of code
+#=========================================================================================
+
+import os
+from collections import deque
+
+from . import StarIo
+
+
+_specificationKeyColumns = None
+
+
+def loopKeysArgument(value):
+    """Parse a loop key specification 'loop:column,column' into (loopName, keyColumns),
+    for use as an argparse type, e.g. for the --keys argument
+    """
+    import argparse
+
+    loopName, _sep, columns = value.partition(':')
+    keyColumns = tuple(col for col in columns.split(',') if col)
+    if not (loopName and keyColumns):
+        raise argparse.ArgumentTypeError("{} must be of the form loop:column,column".format(value))
+
+    return loopName, keyColumns
+
+
+def _getSpecificationKeyColumns():
+    """Return the is_key columns of the loops in the default Nef specification, loaded on first use
+    """
+    global _specificationKeyColumns
+
+    if _specificationKeyColumns is None:
+        from . import NEF_ROOT_PATH, Specification
+
+        specification = Specification.getNefSpecification(os.path.join(NEF_ROOT_PATH, 'mmcif_nef_v1_1.dic'))
+        _specificationKeyColumns = StarIo.getSpecificationKeyColumns(specification)
+    return _specificationKeyColumns
+
+
+def getLoopKeyColumns(loop1, loop2, options):
+    """Return the key columns used to align the rows of two loops,
+    or None if the rows are to be compared by position
+
+    Keys given with --keys (options.loopKeys) take precedence over the specification keys
+    used with --keyalign (options.keyAlign)
+    Key columns must be present in both loops
+    """
+    keyColumns = None
+    loopKeys = getattr(options, 'loopKeys', None)
+    if loopKeys:
+        keyColumns = dict(loopKeys).get(loop1.name)
+    if keyColumns is None and getattr(options, 'keyAlign', False):
+        keyColumns = _getSpecificationKeyColumns().get(loop1.name)
+
+    if keyColumns and all(col in loop1.columns and col in loop2.columns for col in keyColumns):
+        return keyColumns
+
+
+def _rowKeys(loop, keyColumns, options):
+    """Return the list of key tuples for the rows of loop
+    """
+    columnValues = [loop.getColumnValues(col) for col in keyColumns]
+    if options.ignoreCase:
+        columnValues = [[val.lower() if isinstance(val, str) else val for val in values] for values in columnValues]
+    return list(zip(*columnValues))
+
+
+def alignLoopRows(loop1, loop2, keyColumns, options):
+    """Align the rows of two loops on the values in keyColumns using a hash join
+    Rows with duplicate keys are paired in the order that they appear in the loops
+
+    :param loop1: first Loop object, of type GenericStarParser.Loop
+    :param loop2: second Loop object, of type GenericStarParser.Loop
+    :param keyColumns: tuple of column names
+    :param options: nameSpace holding the commandLineArguments
+    :return: tuple(list of matched (rowIndex1, rowIndex2), list of rowIndex only in loop1, list of rowIndex only in loop2)
+    """
+    rightRows = {}
+    for rowIndex, key in enumerate(_rowKeys(loop2, keyColumns, options)):
+        rightRows.setdefault(key, deque()).append(rowIndex)
+
+    rowPairs = []
+    inLeftRows = []
+    for rowIndex, key in enumerate(_rowKeys(loop1, keyColumns, options)):
+        matches = rightRows.get(key)
+        if matches:
+            rowPairs.append((rowIndex, matches.popleft()))
+        else:
+            inLeftRows.append(rowIndex)
+
+    inRightRows = sorted(rowIndex for matches in rightRows.values() for rowIndex in matches)
+
+    return rowPairs, inLeftRows, inRightRows
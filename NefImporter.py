@@ -246,6 +246,7 @@ if __name__ == '__main__' and __package__ is None:
 
 
 from . import StarIo
+from . import GenericStarParser
 from . import ErrorLog as el
 from . import Validator
 from . import Specification
@@ -602,16 +603,14 @@ class NefImporter(el.ErrorLog):
         if not os.path.isfile(_path):
             raise RuntimeError('Nef dictionary file "%s" not found' % fileName)
 
-        with open(_path) as fp:
-            data = fp.read()
-        converter = Specification.CifDicConverter(data, logger=self._logFunc)
-        converter.convertToNef()
-        self._validateNefDict = converter.result
+        # specification is parsed once per process and shared between importers
+        self._validateNefDict = Specification.getNefSpecification(_path, logger=self._logFunc)
 
         return True
 
     def _doValidate(self) -> bool:
         """Validate the current state of self._nefDict
+        Saveframes unchanged since the previous validation are not checked again
         :return True if nefDict validated successfully
         """
         result = self._validator.isValid(self._nefDict, self._validateNefDict)
@@ -624,14 +623,28 @@ class NefImporter(el.ErrorLog):
         Check whether the Nef object contains the required information
         :return True or False:
         """
+        if self._isValid is None:
+            # deferred after lazy loading or editing
+            self._doValidate()
         return self._isValid
 
+    def validate(self) -> bool:
+        """
+        Validate the Nef object again, e.g. after editing the saveFrames directly.
+        Only saveFrames changed since the previous validation are checked again,
+        including changes made to loop rows in place
+        :return True or False:
+        """
+        return self._doValidate()
+
     @property
     def validErrorLog(self):
         """
         Return the error log from checking validity
         :return dict:
         """
+        if self._isValid is None:
+            self._doValidate()
         return self._validator._validation_errors
 
     def _namedToNefDict(self, frame):
@@ -768,6 +781,8 @@ class NefImporter(el.ErrorLog):
         """
         name = self._insertPrefix(name)
 
+        # re-validated on the next isValid; only changed saveFrames are checked again
+        self._isValid = None
         self._nefDict[name] = StarIo.NmrSaveFrame()
         if required_fields is not None:
             self._nefDict[name].update({k: '' for k in required_fields})
@@ -883,7 +898,7 @@ class NefImporter(el.ErrorLog):
     @el.ErrorLog(errorCode=el.NEFERROR_BADFROMSTRING)
     def fromString(self, text, mode='standard'):
         # set the Nef from the contents of the string, opposite of toString
-        dataExtent = StarIo.parseNef(text=text, mode=mode)
+        dataExtent = StarIo.parseNef(text=text, mode=mode, specification=self._validateNefDict)
         if dataExtent:
             dbs = [dataExtent[db] for db in dataExtent.keys()]
             if dbs:
@@ -893,10 +908,23 @@ class NefImporter(el.ErrorLog):
             self._nefDict = {}
 
     @el.ErrorLog(errorCode=el.NEFERROR_ERRORLOADINGFILE)
-    def loadFile(self, fileName=None, mode='standard') -> StarIo.NmrDataBlock:
+    def loadFile(self, fileName=None, mode='standard', lazy=False,
+                 includeCategories=None, excludeCategories=None, loopColumns=None) -> StarIo.NmrDataBlock:
         """Load and parse Nef-file fileName
         :param fileName: path to a Nef-file
+        :param lazy: if True, saveFrames are only parsed when first accessed,
+                     and validation is deferred until isValid is checked
+        :param includeCategories: saveFrame categories to load; other saveFrames are skipped
+        :param excludeCategories: saveFrame categories to skip
+        :param loopColumns: dict {loop category: column names} of the loop columns to load
+                            (see StarIo.parseNefFile)
         :return a NmrDataBlock instance
+
+        If anything is filtered, validation is deferred until isValid is checked,
+        as the loaded data are normally incomplete
+
+        Values are converted according to the item types in the NEF specification,
+        or by their appearance for items not in the specification
         """
         if not isinstance(fileName, (str, Path)):
             raise RuntimeError('Invalid Nef file %r' % fileName)
@@ -907,13 +935,22 @@ class NefImporter(el.ErrorLog):
         if not os.path.isfile(_path):
             raise RuntimeError('Nef file "%s" not found' % fileName)
 
-        nefDataExtent = StarIo.parseNefFile(fileName=fileName, mode=mode)
+        nefDataExtent = StarIo.parseNefFile(fileName=fileName, mode=mode, lazy=lazy,
+                                            specification=self._validateNefDict,
+                                            includeCategories=includeCategories,
+                                            excludeCategories=excludeCategories, loopColumns=loopColumns)
         _dataBlocks = list(nefDataExtent.values())
         if len(_dataBlocks) > 1:
             raise RuntimeError('More than one datablock in a NEF file is not allowed.  Using the first and discarding the rest.\n')
         self._nefDict = _dataBlocks[0]
         self._path = fileName
-        self._doValidate()
+        if isinstance(self._nefDict, StarIo.LazyNmrDataBlock):
+            # validation would parse all saveFrames
+            self._isValid = None
+        elif includeCategories is not None or excludeCategories or loopColumns:
+            self._isValid = None
+        else:
+            self._doValidate()
         return self.data
 
     @el.ErrorLog(errorCode=el.NEFERROR_ERRORLOADINGFILE)
@@ -922,7 +959,7 @@ class NefImporter(el.ErrorLog):
         :param text: Nef-formatted text
         :return a NmrDataBlock instance
         """
-        nefDataExtent = StarIo.parseNef(text=text, mode=mode)
+        nefDataExtent = StarIo.parseNef(text=text, mode=mode, specification=self._validateNefDict)
         _dataBlocks = list(nefDataExtent.values())
         if len(_dataBlocks) > 1:
             raise RuntimeError('More than one datablock in a NEF file is not allowed.  Using the first and discarding the rest.\n')
@@ -933,9 +970,10 @@ class NefImporter(el.ErrorLog):
         return self.data
 
     @el.ErrorLog(errorCode=el.NEFERROR_ERRORSAVINGFILE)
-    def saveFile(self, fileName=None):
-        with open(fileName, 'w') as op:
-            op.write(self._nefDict.toString())
+    def saveFile(self, fileName=None, atomic=False):
+        """Write the nef data to fileName, streaming the saveframes and loops.
+        If atomic is True, write to a temporary file that then replaces fileName"""
+        GenericStarParser.writeFile(self._nefDict, fileName, atomic=atomic)
 
         return True
 
@@ -950,8 +988,8 @@ class NefImporter(el.ErrorLog):
         if not self._nefDict:
             return ()
 
-        names = [db for db in self._nefDict
-                 if isinstance(self._nefDict[db], StarIo.NmrSaveFrame)]
+        # NB does not parse the saveFrames of a lazily loaded file
+        names = self._nefDict.saveFrameNames()
 
         if returnType == NEF_RETURNNEF:
             names = [self._removePrefix(nm) for nm in names if nm and nm.startswith(NEF_PREFIX)]
@@ -980,6 +1018,7 @@ class NefImporter(el.ErrorLog):
         name = self._insertPrefix(name)
         if name in self._nefDict:
             del self._nefDict[name]
+            self._isValid = None
             return True
 
     @el.ErrorLog(errorCode=el.NEFERROR_SAVEFRAMEDOESNOTEXIST)
@@ -988,6 +1027,7 @@ class NefImporter(el.ErrorLog):
         name = self._insertPrefix(name)
         if name in self._nefDict and newName not in self._nefDict:
             saveFrame = self._nefDict[name]
+            self._isValid = None
 
             _frameID = _saveFrameNameFromCategory(saveFrame)
             framecode, frameName, subName, prefix, postfix, preSerial, postSerial, category = _frameID
@@ -1233,7 +1273,7 @@ class NefDict(StarIo.NmrSaveFrame, el.ErrorLog):
         try:
             import pandas as pd
 
-            df = pd.DataFrame(data=sf.data, columns=sf.columns)
+            df = pd.DataFrame(data=sf.getRowValues(), columns=sf.columns)
             df.replace({'.': np.NAN, 'true': True, 'false': False}, inplace=True)
             return df
         except:
@@ -0,0 +1,195 @@
+"""Persistent cache of parsed STAR/NEF files
+
+The parsed object tree is stored as a pickle in PARSE_CACHE_DIR, keyed by the file content
+and the parser settings, so that files that are read repeatedly do not need to be tokenised
+and converted every time. Least recently used cache files are removed when the total size
+exceeds PARSE_CACHE_MAX_SIZE.
+
+The cache is opt-in: use the useCache parameter of GenericStarParser.parseFile,
+StarIo.parseNefFile or StarIo.parseNmrStarFile.
+
+"""
+#=========================================================================================
+# Licence, Reference and Credits
+#=========================================================================================
+__copyright__ = "Copyright (C) CCPN project (http://www.ccpn.ac.uk) 2014 - 2021"
+__credits__ = ("Ed Brooksbank, Joanna Fox, Victoria A Higman, Luca Mureddu, Eliza Płoskoń",
+               "Timothy J Ragan, Brian O Smith, Gary S Thompson & Geerten W Vuister")
+__licence__ = ("CCPN licence. See http://www.ccpn.ac.uk/v3-software/downloads/license")
+__reference__ = ("Skinner, S.P., Fogh, R.H., Boucher, W., Ragan, T.J., Mureddu, L.G., & Vuister, G.W.",
+                 "CcpNmr AnalysisAssign: a flexible platform for integrated NMR analysis",
+                 "J.Biomol.Nmr (2016), 66, 111-124, http://doi.org/10.1007/s10858-016-0060-y")
+#=========================================================================================
+# Last code modification
+#=========================================================================================
+__modifiedBy__ = "$modifiedBy: Ed Brooksbank $"
+__dateModified__ = "$dateModified: 2021-05-10 18:47:35 +0100 (Mon, May 10, 2021) $"
+__version__ = "$Revision: 3.0.4 $"
+#=========================================================================================
+# Created
+#=========================================================================================
+__author__ = "$Author: CCPN $"
+__date__ = "$Date: 2017-04-07 10:28:41 +0000 (Fri, April 07, 2017) $"
+#=========================================================================================
+# Start of code
+#=========================================================================================
+
+import sys
+import os
+import hashlib
+import pickle
+
+from . import __version__ as _libraryVersion
+from .SafeOpen import writePickleAtomic
+
+
+# Version of the cache files; increment whenever the classes of the parsed object tree
+# change, to invalidate existing cache files
+PARSE_CACHE_VERSION = 2
+PARSE_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'ccpn', 'nef', 'parse')
+
+# Maximum total size of the cache files, in bytes
+PARSE_CACHE_MAX_SIZE = 512 * 1024 * 1024
+
+_CACHE_PREFIX = 'parse_'
+_CACHE_SUFFIX = '.pickle'
+
+# Process-wide (path, mtime, size) -> content hash, so unchanged files are not re-hashed
+_fileHashes = {}
+
+# Process-wide cache statistics
+_statistics = {'hits': 0, 'misses': 0, 'writes': 0, 'evictions': 0}
+
+
+def getParsedFile(fileName, parserKey, parseFunction):
+    """Get the parsed object tree for fileName, from the cache if present.
+
+    On a miss, parseFunction() is called, and the result is stored in the cache.
+    Each call returns a new object tree, which may be modified freely.
+
+    :param fileName: path of the file to parse
+    :param parserKey: tuple of the parser settings that determine the result, e.g. module and mode
+    :param parseFunction: callable, without parameters, returning the parsed object tree
+    :return parsed object tree
+    """
+    filePath = os.path.normpath(os.path.abspath(os.path.expanduser(str(fileName))))
+    cachePath = _parseCachePath(_fileContentHash(filePath), parserKey)
+
+    result = _readParseCache(cachePath)
+    if result is None:
+        _statistics['misses'] += 1
+        result = parseFunction()
+        if _writeParseCache(cachePath, result):
+            _statistics['writes'] += 1
+            _evictParseCache()
+    else:
+        _statistics['hits'] += 1
+    #
+    return result
+
+
+def parseCacheStatistics():
+    """Get dict of the cache statistics for this process - hits, misses, writes, evictions -
+    and of the cache files - files, size (in bytes)"""
+    result = dict(_statistics)
+    cacheFiles = _listParseCache()
+    result['files'] = len(cacheFiles)
+    result['size'] = sum(size for _path, _atime, size in cacheFiles)
+    return result
+
+
+def clearParseCache(removeFiles=True):
+    """Reset the cache statistics and the process-wide file hashes,
+    and optionally remove the cache files in PARSE_CACHE_DIR"""
+    _fileHashes.clear()
+    for key in _statistics:
+        _statistics[key] = 0
+
+    if removeFiles:
+        for cachePath, _atime, _size in _listParseCache():
+            try:
+                os.remove(cachePath)
+            except OSError:
+                pass
+
+
+def _fileContentHash(filePath):
+    """Content hash of filePath, re-using the process-wide value if path, mtime and size are unchanged"""
+    stat = os.stat(filePath)
+    statKey = (filePath, stat.st_mtime_ns, stat.st_size)
+    result = _fileHashes.get(statKey)
+    if result is None:
+        hasher = hashlib.sha1()
+        with open(filePath, 'rb') as fp:
+            for block in iter(lambda: fp.read(1 << 20), b''):
+                hasher.update(block)
+        result = _fileHashes[statKey] = hasher.hexdigest()
+    return result
+
+
+def _parseCachePath(contentHash, parserKey):
+    """Path of the cache file, unique for content, parser settings, library version,
+    cache version and Python version"""
+    settings = hashlib.sha1(repr((parserKey, _libraryVersion)).encode('utf-8')).hexdigest()[:16]
+    fileName = '%s%s_%s_v%s_py%s%s%s' % (_CACHE_PREFIX, contentHash, settings, PARSE_CACHE_VERSION,
+                                         sys.version_info[0], sys.version_info[1], _CACHE_SUFFIX)
+    return os.path.join(PARSE_CACHE_DIR, fileName)
+
+
+def _readParseCache(cachePath):
+    """Read cached object tree; return None if missing or unreadable"""
+    if not os.path.isfile(cachePath):
+        return None
+    try:
+        with open(cachePath, 'rb') as fp:
+            result = pickle.load(fp)
+    except Exception:
+        # corrupt or incompatible file - reparse and overwrite
+        return None
+
+    try:
+        # mark as recently used, for the eviction order
+        os.utime(cachePath)
+    except OSError:
+        pass
+    return result
+
+
+def _writeParseCache(cachePath, tree):
+    """Write object tree to the cache. Failures are ignored, as the cache is optional.
+    Return True if the file was written"""
+    try:
+        writePickleAtomic(cachePath, tree)
+    except Exception:
+        return False
+    return True
+
+
+def _listParseCache():
+    """List of (path, last use time, size) of the cache files"""
+    result = []
+    if os.path.isdir(PARSE_CACHE_DIR):
+        for fileName in os.listdir(PARSE_CACHE_DIR):
+            if fileName.startswith(_CACHE_PREFIX) and fileName.endswith(_CACHE_SUFFIX):
+                cachePath = os.path.join(PARSE_CACHE_DIR, fileName)
+                try:
+                    stat = os.stat(cachePath)
+                except OSError:
+                    continue
+                result.append((cachePath, stat.st_mtime, stat.st_size))
+    return result
+
+
+def _evictParseCache():
+    """Remove the least recently used cache files until the total size is within PARSE_CACHE_MAX_SIZE"""
+    cacheFiles = sorted(_listParseCache(), key=lambda x: x[1])
+    totalSize = sum(size for _path, _atime, size in cacheFiles)
+    for cachePath, _atime, size in cacheFiles:
+        if totalSize <= PARSE_CACHE_MAX_SIZE:
+            break
+        try:
+            os.remove(cachePath)
+        except OSError:
+            continue
+        totalSize -= size
+        _statistics['evictions'] += 1
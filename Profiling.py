@@ -0,0 +1,254 @@
+"""Optional instrumentation of the parse, conversion, validation and write phases
+
+Profiling is off unless a profile is active, and then costs only a check per phase:
+
+    with Profiling.profile(traceMemory=True) as parseProfile:
+        nefData = StarIo.parseNefFile(fileName)
+    print(parseProfile.report())
+
+or, from the command line, 'nef.py --profile ...'.
+
+Phases (see PHASES) record the number of calls, the time spent in the phase itself, i.e. excluding
+nested phases, counts of tokens, loop rows, loop values, saveframes, ..., and, if traceMemory
+is set, the peak of the memory traced by tracemalloc during the phase. Peaks within a phase
+need Python 3.9 or later; on earlier versions the traced memory at the phase boundaries is used.
+Timing the tokeniser adds an overhead per token, which is included in the 'tokenise' time.
+
+When NEF files are parsed in a single pass, loop values are converted as they are read,
+so that their conversion is part of 'build' rather than 'convert'.
+
+"""
+#=========================================================================================
+# Licence, Reference and Credits
+#=========================================================================================
+__copyright__ = "Copyright (C) CCPN project (http://www.ccpn.ac.uk) 2014 - 2021"
+__credits__ = ("Ed Brooksbank, Joanna Fox, Victoria A Higman, Luca Mureddu, Eliza Płoskoń",
+               "Timothy J Ragan, Brian O Smith, Gary S Thompson & Geerten W Vuister")
+__licence__ = ("CCPN licence. See http://www.ccpn.ac.uk/v3-software/downloads/license")
+__reference__ = ("Skinner, S.P., Fogh, R.H., Boucher, W., Ragan, T.J., Mureddu, L.G., & Vuister, G.W.",
+                 "CcpNmr AnalysisAssign: a flexible platform for integrated NMR analysis",
+                 "J.Biomol.Nmr (2016), 66, 111-124, http://doi.org/10.1007/s10858-016-0060-y")
+#=========================================================================================
+# Last code modification
+#=========================================================================================
+__modifiedBy__ = "$modifiedBy: Ed Brooksbank $"
+__dateModified__ = "$dateModified: 2021-05-10 18:47:35 +0100 (Mon, May 10, 2021) $"
+__version__ = "$Revision: 3.0.4 $"
+#=========================================================================================
+# Created
+#=========================================================================================
+__author__ = "$Author: CCPN $"
+__date__ = "$Date: 2017-04-07 10:28:41 +0000 (Fri, April 07, 2017) $"
+#=========================================================================================
+# Start of code
+#=========================================================================================
+
+import time
+import functools
+import tracemalloc
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+# Phase names, in report order
+PHASE_TOKENISE = 'tokenise'  # STAR tokeniser (GenericStarParser)
+PHASE_BUILD = 'build'  # Parser and event handler: object tree, or single-pass NEF/NMR-STAR conversion
+PHASE_PREVALIDATE = 'preValidate'  # StarIo._StarDataConverter.preValidate, and per saveframe
+PHASE_CONVERT = 'convert'  # StarIo._StarDataConverter.convert, and per saveframe
+PHASE_VALIDATE = 'validate'  # Validator._validateAll
+PHASE_WRITE = 'write'  # GenericStarParser write functions
+PHASES = (PHASE_TOKENISE, PHASE_BUILD, PHASE_PREVALIDATE, PHASE_CONVERT, PHASE_VALIDATE, PHASE_WRITE)
+
+# The active ParseProfile, if any
+_activeProfile = None
+
+# tracemalloc.reset_peak needs Python 3.9 or later. Without it, the peak memory of a phase is
+# approximated by the largest traced memory at the start and end of the phase and its nested phases
+_resetPeak = getattr(tracemalloc, 'reset_peak', None)
+
+
+def _tracedPeak():
+    """Peak traced memory since the last _resetPeak, or the current traced memory if peaks cannot be reset"""
+    current, peak = tracemalloc.get_traced_memory()
+    return current if _resetPeak is None else peak
+
+
+class PhaseStatistics:
+    """Statistics for one phase"""
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.time = 0.0
+        self.peakMemory = None
+        self.counts = OrderedDict()
+
+    def asDict(self):
+        """Statistics as a dictionary"""
+        return OrderedDict((('calls', self.calls), ('time', self.time), ('peakMemory', self.peakMemory),
+                            ('counts', OrderedDict(self.counts))))
+
+
+class ParseProfile:
+    """Statistics per phase, collected while the profile is active (see profile())"""
+
+    def __init__(self, traceMemory=False):
+        self.traceMemory = traceMemory
+        self.phases = OrderedDict((name, PhaseStatistics(name)) for name in PHASES)
+
+        # Open phases: lists [statistics, start time, time in nested phases, peak memory so far]
+        self._stack = []
+
+    def _getPhase(self, name):
+        result = self.phases.get(name)
+        if result is None:
+            result = self.phases[name] = PhaseStatistics(name)
+        return result
+
+    def count(self, name, **counts):
+        """Add counts (e.g. rows=10, cells=80) to phase name"""
+        phaseCounts = self._getPhase(name).counts
+        for key, value in counts.items():
+            phaseCounts[key] = phaseCounts.get(key, 0) + value
+
+    def addTime(self, name, seconds, calls=0, **counts):
+        """Add time measured separately, e.g. for the tokeniser, to phase name.
+        The time is taken out of the time of the enclosing phase"""
+        phase = self._getPhase(name)
+        phase.time += seconds
+        phase.calls += calls
+        if counts:
+            self.count(name, **counts)
+        if self._stack:
+            self._stack[-1][2] += seconds
+
+    def _startPhase(self, name):
+        if self.traceMemory:
+            if self._stack:
+                # keep the peak of the enclosing phase before the reset
+                record = self._stack[-1]
+                record[3] = max(record[3], _tracedPeak())
+            if _resetPeak is not None:
+                _resetPeak()
+        self._stack.append([self._getPhase(name), time.perf_counter(), 0.0,
+                            _tracedPeak() if self.traceMemory else 0])
+
+    def _endPhase(self):
+        phase, startTime, nestedTime, peakSoFar = self._stack.pop()
+        elapsed = time.perf_counter() - startTime
+        phase.calls += 1
+        phase.time += elapsed - nestedTime
+        if self._stack:
+            self._stack[-1][2] += elapsed
+
+        if self.traceMemory:
+            peak = max(peakSoFar, _tracedPeak())
+            phase.peakMemory = max(phase.peakMemory or 0, peak)
+            if self._stack:
+                record = self._stack[-1]
+                record[3] = max(record[3], peak)
+
+    def totalTime(self):
+        """Total time of all phases"""
+        return sum(phase.time for phase in self.phases.values())
+
+    def asDict(self):
+        """Statistics as a dictionary {phase name: statistics dictionary}, for phases that were used"""
+        return OrderedDict((name, phase.asDict()) for name, phase in self.phases.items()
+                           if phase.calls or phase.counts)
+
+    def report(self):
+        """Statistics as a text table, for phases that were used"""
+        lines = ['%-12s %8s %10s %10s  %s' % ('phase', 'calls', 'time (s)', 'peak (MB)', 'counts')]
+        for phase in self.phases.values():
+            if phase.calls or phase.counts:
+                peak = '-' if phase.peakMemory is None else '%.1f' % (phase.peakMemory / 1.0e6)
+                counts = ', '.join('%s=%s' % tt for tt in phase.counts.items())
+                lines.append(('%-12s %8d %10.4f %10s  %s' % (phase.name, phase.calls, phase.time, peak,
+                                                              counts)).rstrip())
+        lines.append('%-12s %8s %10.4f' % ('total', '', self.totalTime()))
+        return '\n'.join(lines)
+
+
+def activeProfile():
+    """The active ParseProfile, or None"""
+    return _activeProfile
+
+
+@contextmanager
+def profile(traceMemory=False):
+    """Context manager activating a new ParseProfile, which it returns.
+    If traceMemory, tracemalloc is started (if not already running) to get the peak memory per phase"""
+    global _activeProfile
+
+    result = ParseProfile(traceMemory=traceMemory)
+    previousProfile = _activeProfile
+    startTrace = traceMemory and not tracemalloc.is_tracing()
+    if startTrace:
+        tracemalloc.start()
+    _activeProfile = result
+    try:
+        yield result
+    finally:
+        _activeProfile = previousProfile
+        if startTrace:
+            tracemalloc.stop()
+
+
+@contextmanager
+def _phaseContext(parseProfile, name):
+    parseProfile._startPhase(name)
+    try:
+        yield parseProfile
+    finally:
+        parseProfile._endPhase()
+
+
+@contextmanager
+def _nullContext():
+    yield None
+
+
+def phase(name):
+    """Context manager recording phase name in the active profile.
+    Returns the active profile, or None if there is none"""
+    if _activeProfile is None:
+        return _nullContext()
+    return _phaseContext(_activeProfile, name)
+
+
+def profiled(name):
+    """Decorator recording the calls of the function as phase name in the active profile"""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwds):
+            if _activeProfile is None:
+                return func(*args, **kwds)
+            with _phaseContext(_activeProfile, name):
+                return func(*args, **kwds)
+
+        return wrapper
+
+    return decorator
+
+
+def timedTokens(parseProfile, tokens, name=PHASE_TOKENISE):
+    """Iterator over tokens, adding the time taken to get them, and their number,
+    to phase name of parseProfile"""
+    perf_counter = time.perf_counter
+    tokenTime = 0.0
+    tokenCount = 0
+    try:
+        while True:
+            t0 = perf_counter()
+            try:
+                tk = next(tokens)
+            except StopIteration:
+                tokenTime += perf_counter() - t0
+                return
+            tokenTime += perf_counter() - t0
+            tokenCount += 1
+            yield tk
+    finally:
+        parseProfile.addTime(name, tokenTime, calls=1, tokens=tokenCount)
@@ -1,5 +1,6 @@
 """
-Functions to append a number to the end of a filename if it already exists
+Functions to append a number to the end of a filename if it already exists,
+and to replace files atomically
 """
 #=========================================================================================
 # Licence, Reference and Credits
@@ -28,6 +29,8 @@ __date__ = "$Date: 2017-06-16 16:28:31 +0000 (Fri, June 16, 2017) $"
 import itertools
 import errno
 import os
+import pickle
+import tempfile
 import sys
 from contextlib import contextmanager
 
@@ -113,3 +116,27 @@ def getSafeFilename(path, mode='w'):
         else:
             # return the new filename
             return filename
+
+
+def writePickleAtomic(path, obj):
+    """Pickle obj to path, via a unique temporary file in the same directory that then replaces path,
+    so that concurrent readers and writers, also in other threads or on other hosts,
+    never see a partly written file. The directory is created if needed.
+    On failure only the temporary file is removed, and the exception is raised.
+
+    :param path: filepath and filename.
+    :param obj: object to pickle
+    """
+    directory, fileName = os.path.split(path)
+    os.makedirs(directory or '.', exist_ok=True)
+    fd, tempPath = tempfile.mkstemp(prefix='.%s.' % fileName, suffix='.tmp', dir=directory or None)
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            pickle.dump(obj, fp, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tempPath, path)
+    except BaseException:
+        try:
+            os.remove(tempPath)
+        except OSError:
+            pass
+        raise
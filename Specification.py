@@ -27,27 +27,132 @@ __date__ = "$Date: 2017-04-07 10:28:41 +0000 (Fri, April 07, 2017) $"
 #=========================================================================================
 
 import sys
+import os
+import hashlib
+import pickle
 
 from . import GenericStarParser
 from . import StarIo
+from .SafeOpen import writePickleAtomic
 
 
 INFOPREFIX = 'INFO: '
 
+# Version of the precompiled specification files; increment whenever the structure
+# produced by CifDicConverter changes, to invalidate existing cache files
+SPECIFICATION_CACHE_VERSION = 2
+SPECIFICATION_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'ccpn', 'nef')
 
-# TODO, This is a DRAFT only - not used and not currently functional.
-# May be upgraded later, for specification-aware NEF I/O
+# Process-wide registry of converted specifications:
+#   (path, mtime, size, additionalBlocks) -> content hash
+#   (content hash, additionalBlocks) -> NmrDataBlock
+_specificationStats = {}
+_specificationRegistry = {}
 
 
 def getCcpnSpecification(filePath):
     """Get NEF specification summary with ccpn-specific additions"""
 
-    converter = CifDicConverter(open(filePath).read(),
-                                additionalBlocks=('ccpn_additions',))
-    #
-    return converter.convertToNef()
+    return getNefSpecification(filePath, additionalBlocks=('ccpn_additions',))
+
+
+def getNefSpecification(filePath, additionalBlocks=(), logger=None, useDiskCache=True):
+    """Get the NEF specification summary for the mmcif .dic file filePath.
 
+    The .dic file is parsed and converted at most once per process; subsequent calls
+    return the same NmrDataBlock, which must be treated as read-only.
+    The registry is keyed by path, modification time and content hash, so an edited
+    file is re-read. If useDiskCache is True, the converted specification is also
+    stored as a versioned pickle in SPECIFICATION_CACHE_DIR and reused by other processes.
 
+    :param filePath: path of the mmcif .dic file
+    :param additionalBlocks: names of program-specific datablocks to include
+    :param logger: callable for the CifDicConverter messages, only used when converting
+    :param useDiskCache: read/write the precompiled specification on disk
+    :return NmrDataBlock instance
+    """
+    filePath = os.path.normpath(os.path.abspath(os.path.expanduser(str(filePath))))
+    additionalBlocks = tuple(additionalBlocks)
+
+    stat = os.stat(filePath)
+    statKey = (filePath, stat.st_mtime_ns, stat.st_size, additionalBlocks)
+    contentHash = _specificationStats.get(statKey)
+    if contentHash is not None:
+        result = _specificationRegistry.get((contentHash, additionalBlocks))
+        if result is not None:
+            return result
+
+    with open(filePath, 'rb') as fp:
+        data = fp.read()
+    contentHash = hashlib.sha1(data).hexdigest()
+    _specificationStats[statKey] = contentHash
+
+    key = (contentHash, additionalBlocks)
+    result = _specificationRegistry.get(key)
+    if result is None:
+        cachePath = _specificationCachePath(contentHash, additionalBlocks) if useDiskCache else None
+        result = _readSpecificationCache(cachePath)
+        if result is None:
+            converter = CifDicConverter(data.decode('utf-8'), additionalBlocks=additionalBlocks,
+                                        logger=logger)
+            result = converter.convertToNef()
+            _writeSpecificationCache(cachePath, result)
+        _specificationRegistry[key] = result
+    #
+    return result
+
+
+def clearSpecificationCache(removeFiles=False):
+    """Clear the process-wide specification registry,
+    and optionally the precompiled files in SPECIFICATION_CACHE_DIR"""
+    _specificationStats.clear()
+    _specificationRegistry.clear()
+
+    if removeFiles and os.path.isdir(SPECIFICATION_CACHE_DIR):
+        for fileName in os.listdir(SPECIFICATION_CACHE_DIR):
+            if fileName.startswith('specification_') and fileName.endswith('.pickle'):
+                try:
+                    os.remove(os.path.join(SPECIFICATION_CACHE_DIR, fileName))
+                except OSError:
+                    pass
+
+
+def _specificationCachePath(contentHash, additionalBlocks):
+    """Path of the precompiled specification file, unique for content, blocks,
+    cache version and Python version"""
+    blocks = hashlib.sha1(repr(additionalBlocks).encode('utf-8')).hexdigest()[:8]
+    fileName = 'specification_%s_%s_v%s_py%s%s.pickle' % (contentHash, blocks, SPECIFICATION_CACHE_VERSION,
+                                                          sys.version_info[0], sys.version_info[1])
+    return os.path.join(SPECIFICATION_CACHE_DIR, fileName)
+
+
+def _readSpecificationCache(cachePath):
+    """Read precompiled specification; return None if missing or unreadable"""
+    if cachePath is None or not os.path.isfile(cachePath):
+        return None
+    try:
+        with open(cachePath, 'rb') as fp:
+            result = pickle.load(fp)
+    except Exception:
+        # corrupt or incompatible file - reconvert and overwrite
+        return None
+    if not isinstance(result, StarIo.NmrDataBlock):
+        return None
+    return result
+
+
+def _writeSpecificationCache(cachePath, specification):
+    """Write precompiled specification. Failures are ignored, as the cache is optional"""
+    if cachePath is None:
+        return
+    try:
+        writePickleAtomic(cachePath, specification)
+    except Exception:
+        pass
+
+
+# TODO The structure of the specification summary is a DRAFT,
+# that may be upgraded later, for specification-aware NEF I/O
 class CifDicConverter(object):
     """Converts mmcif .dic file, with program-specific additions datablocks
     into a single NEF data structure, containing:
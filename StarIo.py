@@ -23,6 +23,9 @@ and other STAR variants satisfying the following requirements:
    The 'NmrStar' functions will read any Star file that satisfies the constraints above, while
     the 'Nef' functions will also enforce the NEF=-specific constraints above
 
+   With lazy=True the saveframe positions are found by a quick scan of the text,
+    and each saveframe is parsed on first access (see LazyNmrDataBlock)
+
 
   On reading tag prefixes ('_', 'save_', 'data_' are stripped,
   as are the parts of tags before the first '.'
@@ -64,8 +67,12 @@ __date__ = "$Date: 2017-04-07 10:28:41 +0000 (Fri, April 07, 2017) $"
 
 import keyword
 import os
+import re
+from collections import OrderedDict
+from functools import partial
 
 from . import GenericStarParser
+from . import Profiling
 
 
 NULLSTRING = GenericStarParser.NULLSTRING
@@ -82,63 +89,108 @@ ll[34] = ll[35] = ll[39] = '?'
 latin_1_to_framecode_translator = ''.join(ll)
 
 
-def parseNmrStar(text, mode='standard'):
+def parseNmrStar(text, mode='standard', columnar=False, lazy=False, specification=None,
+                 includeCategories=None, excludeCategories=None, loopColumns=None):
     """load NMRSTAR file"""
-    dataExtent = GenericStarParser.parse(text, mode)
-    converter = _StarDataConverter(dataExtent)
-    converter.preValidate()
-    result = converter.convert()
-    #
-    return result
+    return _parseNmrText(text, mode, fileType='star', columnar=columnar, lazy=lazy,
+                         specification=specification, includeCategories=includeCategories,
+                         excludeCategories=excludeCategories, loopColumns=loopColumns)
 
 
-def parseNmrStarFile(fileName, mode='standard', wrapInDataBlock=False):
+def parseNmrStarFile(fileName, mode='standard', wrapInDataBlock=False, columnar=False, lazy=False,
+                     useMmap=False, specification=None, useCache=False,
+                     includeCategories=None, excludeCategories=None, loopColumns=None):
     """parse NMRSTAR from file.
     :param fileName: path of the star-file to parse
     :param mode: parsing mode: any of ('lenient', 'strict', 'standard', 'IUCr')
     :param wrapInDataBlock: flag; if True a missing DataBlock start will be added
+    :param columnar: flag; if True loops are stored column-wise (ColumnarNmrLoop)
+    :param lazy: flag; if True saveframes are parsed on first access (LazyNmrDataBlock)
+    :param useMmap: flag; if True the file is memory-mapped and tokenised as bytes (ignored if lazy)
+    :param specification: NEF specification NmrDataBlock, used to convert values by item type
+    :param useCache: flag; if True the parsed tree is read from, or stored in, the persistent
+                     parse cache (see ParseCache) (ignored if lazy)
+    :param includeCategories: saveframe categories to read; other saveframes are skipped
+    :param excludeCategories: saveframe categories to skip
+    :param loopColumns: dict {loop category: column names} of the loop columns to read
     :return NmrDataBlock instance
     """
-    with open(fileName) as fp:
-        text = fp.read()
-
-    if wrapInDataBlock and 'save_' in text and not 'data_' in text:
-        text = "data_dummy \n\n" + text
-
-    dataExtent = GenericStarParser.parse(text, mode)
-    converter = _StarDataConverter(dataExtent, fileType='star')
-    converter.preValidate()
-    result = converter.convert()
-    #
-    return result
+    return _parseNmrFile(fileName, mode, fileType='star', wrapInDataBlock=wrapInDataBlock,
+                         columnar=columnar, lazy=lazy, useMmap=useMmap, specification=specification,
+                         useCache=useCache, includeCategories=includeCategories,
+                         excludeCategories=excludeCategories, loopColumns=loopColumns)
 
 
-def parseNef(text, mode='standard'):
+def parseNef(text, mode='standard', columnar=False, lazy=False, specification=None,
+             includeCategories=None, excludeCategories=None, loopColumns=None):
     """load NEF from string"""
 
-    dataExtent = GenericStarParser.parse(text, mode)
-    converter = _StarDataConverter(dataExtent, fileType='nef')
-    converter.preValidate()
-    result = converter.convert()
-    #
-    return result
+    return _parseNmrText(text, mode, fileType='nef', columnar=columnar, lazy=lazy,
+                         specification=specification, includeCategories=includeCategories,
+                         excludeCategories=excludeCategories, loopColumns=loopColumns)
 
 
-def parseNefFile(fileName, mode='standard', wrapInDataBlock=False):
+def parseNefFile(fileName, mode='standard', wrapInDataBlock=False, columnar=False, lazy=False,
+                 useMmap=False, specification=None, useCache=False,
+                 includeCategories=None, excludeCategories=None, loopColumns=None):
     """parse NEF from file
 
-    if wrapInDataBlock missing DataBlock start will be provided"""
+    if wrapInDataBlock missing DataBlock start will be provided
+    if columnar loops are stored column-wise (ColumnarNmrLoop), which saves memory
+    if lazy saveframes are indexed, and only parsed on first access (LazyNmrDataBlock)
+    if useMmap the file is memory-mapped and tokenised as bytes, without reading it all
+    into memory as text (ignored if lazy)
+    if specification (a NEF specification NmrDataBlock, see Specification.getNefSpecification)
+    is given, values are converted according to the item type_code where known
+    if useCache the parsed tree is read from, or stored in, the persistent parse cache
+    (see ParseCache), keyed by the file content and the parser settings (ignored if lazy)
+    if includeCategories is given, only saveframes of these categories are read, and
+    saveframes of excludeCategories are never read; skipped saveframes are scanned over
+    without making loops or converting values (lazy is ignored if categories are filtered)
+    if loopColumns, a dict {loop category: column names}, is given, only these columns are read
+    for loops of the category, e.g. {'nef_chemical_shift': ['chain_code', 'sequence_code',
+    'residue_name', 'atom_name', 'value']}"""
+    return _parseNmrFile(fileName, mode, fileType='nef', wrapInDataBlock=wrapInDataBlock,
+                         columnar=columnar, lazy=lazy, useMmap=useMmap, specification=specification,
+                         useCache=useCache, includeCategories=includeCategories,
+                         excludeCategories=excludeCategories, loopColumns=loopColumns)
+
+
+def _parseNmrFile(fileName, mode, fileType, wrapInDataBlock=False, columnar=False, lazy=False,
+                  useMmap=False, specification=None, useCache=False, **filters):
+    """parse NEF or NMRSTAR file - see parseNefFile"""
+
+    saveFrameFilter = GenericStarParser.SaveFrameFilter.make(**filters)
+    if saveFrameFilter is not None:
+        lazy = False
+
+    if useCache and not lazy:
+        from . import ParseCache
+
+        specificationHash = None if specification is None else specification.contentHash()
+        parserKey = ('StarIo', fileType, mode, wrapInDataBlock, columnar, specificationHash)
+        if saveFrameFilter is not None:
+            parserKey += (saveFrameFilter.key(),)
+        return ParseCache.getParsedFile(fileName, parserKey,
+                                        lambda: _parseNmrFile(fileName, mode, fileType,
+                                                              wrapInDataBlock=wrapInDataBlock,
+                                                              columnar=columnar, useMmap=useMmap,
+                                                              specification=specification, **filters))
+
+    if useMmap and not lazy:
+        with GenericStarParser.openMmap(fileName) as data:
+            if wrapInDataBlock and data.find(b'save_') >= 0 and data.find(b'data_') < 0:
+                data = b"data_dummy \n\n" + data[:]
+            return _parseNmrText(data, mode, fileType=fileType, columnar=columnar,
+                                 specification=specification, **filters)
+
     with open(fileName) as fp:
         text = fp.read()
 
     if wrapInDataBlock and 'save_' in text and not 'data_' in text:
         text = "data_dummy \n\n" + text
-    dataExtent = GenericStarParser.parse(text, mode)
-    converter = _StarDataConverter(dataExtent, fileType='nef')
-    converter.preValidate()
-    result = converter.convert()
-    #
-    return result
+    return _parseNmrText(text, mode, fileType=fileType, columnar=columnar, lazy=lazy,
+                         specification=specification, **filters)
 
 
 def string2FramecodeString(text):
@@ -184,6 +236,100 @@ class NmrLoop(GenericStarParser.Loop):
         """Prefix to use before item tags on output"""
         return '_%s.' % self.name
 
+    def _expandColumnNames(self, columns):
+        """Get list of column names from columns (a name, or a list of names; None for all)
+
+        Names that are not columns, but match a series of columns 'name_1', 'name_2', ...,
+        are expanded to the series, as for LoopRow._get"""
+        if columns is None:
+            return list(self._columns)
+        elif isinstance(columns, str):
+            columns = [columns]
+
+        result = []
+        for name in columns:
+            if name in self._columns:
+                result.append(name)
+            else:
+                tags = GenericStarParser.extractMatchingNameSequence(name, self._columns)
+                if not tags:
+                    raise ValueError("%s: no column(s) matching %s" % (self, name))
+                result.extend(tags)
+        #
+        return result
+
+    def toNumpy(self, columns=None, dtype=float, masked=False, fillValue=None):
+        """Get loop data as numpy array of shape (number of rows, number of columns)
+
+        columns is a column name or a list of column names, default all columns.
+        A name like 'position' matches a series of columns 'position_1', 'position_2', ...
+        A single column name that does not match a series gives a one-dimensional array.
+
+        Null values are set to fillValue, by default NaN for floating point dtypes
+        and None for dtype object. Nulls in other dtypes raise ValueError, unless masked is True,
+        in which case the result is a numpy.ma.MaskedArray with the nulls masked."""
+        import numpy as np
+
+        single = isinstance(columns, str) and columns in self._columns
+        names = self._expandColumnNames(columns)
+        dtype = np.dtype(dtype)
+
+        result = np.empty((len(self.data), len(names)), dtype=dtype)
+        mask = np.zeros(result.shape, dtype=bool) if masked else None
+        for ii, name in enumerate(names):
+            values, nulls = _fillNulls(self.getColumnValues(name), dtype, masked, fillValue,
+                                       context=(self, name))
+            result[:, ii] = values
+            if masked and nulls:
+                mask[nulls, ii] = True
+
+        if masked:
+            result = np.ma.masked_array(result, mask=mask)
+        if single:
+            result = result[:, 0]
+        #
+        return result
+
+    def toStructuredArray(self, columns=None, dtypes=None, masked=False):
+        """Get loop data as numpy structured array, with one field per column
+
+        columns are as for toNumpy; dtypes is an optional dict {columnName:dtype}.
+        Other column dtypes are derived from the values: bool, int, float or string.
+        Null values are NaN in float columns; int columns with nulls are made float,
+        and bool or string columns with nulls are made object, with nulls as None.
+        If masked is True the result is a numpy.ma.MaskedArray with the nulls masked,
+        and column types are not changed because of nulls."""
+        import numpy as np
+
+        names = self._expandColumnNames(columns)
+        dtypes = dtypes or {}
+
+        columnValues = [self.getColumnValues(name) for name in names]
+        fieldTypes = [np.dtype(dtypes[name]) if name in dtypes else _columnDtype(values, masked)
+                      for name, values in zip(names, columnValues)]
+
+        result = np.empty(len(self.data), dtype=list(zip(names, fieldTypes)))
+        masks = {}
+        for name, values, dtype in zip(names, columnValues, fieldTypes):
+            values, nulls = _fillNulls(values, dtype, masked, None, context=(self, name))
+            result[name] = values
+            if nulls:
+                masks[name] = nulls
+
+        if masked:
+            result = np.ma.masked_array(result)
+            for name, nulls in masks.items():
+                result.mask[name][nulls] = True
+        #
+        return result
+
+
+class ColumnarNmrLoop(NmrLoop, GenericStarParser.ColumnarLoop):
+    """NmrLoop storing its data column-wise - see GenericStarParser.ColumnarLoop
+
+    self.data is a sequence of row views, that support the same access as NmrLoop rows."""
+    pass
+
 
 class NmrSaveFrame(GenericStarParser.SaveFrame):
     """SaveFrame (OrderedDict)for NMRSTAR/NEF object tree"""
@@ -203,6 +349,28 @@ class NmrSaveFrame(GenericStarParser.SaveFrame):
         self.addItem(name, loop)
         return loop
 
+    def getPeakPositions(self):
+        """Peak positions from the nef_peak loop of a nef_nmr_spectrum saveframe,
+        as numpy float array of shape (number of peaks, num_dimensions). Null positions are NaN"""
+        loop = self.get('nef_peak')
+        if loop is None:
+            raise ValueError("%s has no nef_peak loop" % self)
+        dimensionCount = self.get('num_dimensions')
+        if dimensionCount:
+            columns = ['position_%s' % ii for ii in range(1, dimensionCount + 1)]
+        else:
+            columns = ['position']
+        return loop.toNumpy(columns, dtype=float)
+
+    def getChemicalShifts(self):
+        """Contents of the nef_chemical_shift loop of a nef_chemical_shift_list saveframe,
+        as numpy structured array. Null values and uncertainties are NaN"""
+        loop = self.get('nef_chemical_shift')
+        if loop is None:
+            raise ValueError("%s has no nef_chemical_shift loop" % self)
+        return loop.toStructuredArray(dtypes={'value': float, 'value_uncertainty': float},
+                                      masked=True)
+
 
 class NmrDataBlock(GenericStarParser.DataBlock):
     """DataBlock (OrderedDict)for NMRSTAR/NEF object tree"""
@@ -220,6 +388,113 @@ class NmrDataBlock(GenericStarParser.DataBlock):
         """Add existing NmrSaveFrame to the DataBlock"""
         self.addItem(saveFrame['sf_framecode'], saveFrame)
 
+    def saveFrameNames(self):
+        """Names of the NmrSaveFrames in the DataBlock"""
+        return [tag for tag, value in self.items() if isinstance(value, NmrSaveFrame)]
+
+
+class _SaveFrameExtent:
+    """Position of an unparsed saveframe in the text of a LazyNmrDataBlock"""
+
+    __slots__ = ('start', 'end', 'lineNumber')
+
+    def __init__(self, start, end, lineNumber):
+        self.start = start
+        self.end = end
+        self.lineNumber = lineNumber
+
+
+class LazyNmrDataBlock(NmrDataBlock):
+    """NmrDataBlock that parses each saveframe from the file text on first access.
+
+    The saveframe names are known from the start, so that e.g. 'name in dataBlock',
+    keys() and saveFrameNames() do not parse anything.
+    Getting a saveframe (dataBlock[name], get, values, items) parses and validates it,
+    so errors in a saveframe are raised on first access rather than on loading.
+    Keys are the sf_framecode values, as for NmrDataBlock.
+
+    Make using parseNef(..., lazy=True) or parseNefFile(..., lazy=True)"""
+
+    def __init__(self, name=None, text=None, header=None, fileType='nef', mode='standard',
+                 columnar=False, specification=None):
+        super(LazyNmrDataBlock, self).__init__(name=name)
+        self._text = text
+        self._fileType = fileType
+        self._mode = mode
+        self._columnar = columnar
+        self._specification = specification
+
+        # DataBlock tag from the text, for parsing saveframes
+        self._header = header
+
+    def __getitem__(self, key):
+        value = OrderedDict.__getitem__(self, key)
+        if isinstance(value, _SaveFrameExtent):
+            value = self._loadSaveFrame(key, value)
+        return value
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def values(self):
+        return [self[key] for key in self]
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+    def pop(self, key, *args):
+        if key in self:
+            value = self[key]
+            del self[key]
+            return value
+        return OrderedDict.pop(self, key, *args)
+
+    def __eq__(self, other):
+        self.loadAll()
+        return super(LazyNmrDataBlock, self).__eq__(other)
+
+    __hash__ = None
+
+    def saveFrameNames(self):
+        """Names of the saveframes in the DataBlock. Does not load any saveframe"""
+        return [tag for tag, value in OrderedDict.items(self)
+                if isinstance(value, (NmrSaveFrame, _SaveFrameExtent))]
+
+    def isLoaded(self, name):
+        """True if saveframe name has been parsed (or was not read from the text)"""
+        return not isinstance(OrderedDict.__getitem__(self, name), _SaveFrameExtent)
+
+    def loadAll(self):
+        """Parse all remaining saveframes"""
+        for key in self:
+            self[key]
+
+    def _addSaveFrameExtent(self, name, extent):
+        self.addItem(name, extent)
+
+    def _loadSaveFrame(self, key, extent):
+        """Parse saveframe at extent and replace the placeholder under key"""
+
+        # Pad with newlines so that error messages give the line numbers in the file
+        text = '%s%s%s' % (self._header, '\n' * max(1, extent.lineNumber - 1),
+                           self._text[extent.start:extent.end])
+        dataExtent = _parseNmrText(text, self._mode, fileType=self._fileType, columnar=self._columnar,
+                                   specification=self._specification)
+        saveFrames = list(list(dataExtent.values())[0].values())
+        if len(saveFrames) != 1:
+            raise StarValidationError("Error loading saveframe %s: %s saveframes found"
+                                      % (key, len(saveFrames)))
+        saveFrame = saveFrames[0]
+        OrderedDict.__setitem__(self, key, saveFrame)
+
+        if not any(isinstance(x, _SaveFrameExtent) for x in OrderedDict.values(self)):
+            # All loaded - release the text
+            self._text = None
+        #
+        return saveFrame
+
 
 class NmrLoopRow(GenericStarParser.LoopRow):
     pass
@@ -234,13 +509,13 @@ class _StarDataConverter:
     validFileTypes = ('nef', 'star')
 
     def __init__(self, dataExtent, fileType='star',
-                 specification=None, convertColumnNames=True):
+                 specification=None, convertColumnNames=True, columnar=False):
 
         # Set option settings
-        if specification is None:
-            self.specification = None
-        else:
-            raise NotImplementedError("_StarDataConverter specification input not yet implemented")
+        # specification is a NEF specification NmrDataBlock, as from Specification.getNefSpecification
+        # It is used to convert values by the type_code of the items, where known
+        self.specification = specification
+        self.valueTypes = getSpecificationValueTypes(specification) if specification is not None else {}
         fileType = fileType and fileType.lower()
         if fileType not in self.validFileTypes:
             raise StarValidationError("fileType %s must be one of %s" % (fileType, self.validFileTypes))
@@ -248,11 +523,15 @@ class _StarDataConverter:
 
         self.convertColumnNames = convertColumnNames
 
+        # Make ColumnarNmrLoop rather than NmrLoop
+        self.columnar = columnar
+
         self.dataExtent = dataExtent
 
         # Stack of objects parsed, to give context for error messages
         self.stack = []
 
+    @Profiling.profiled(Profiling.PHASE_PREVALIDATE)
     def preValidate(self):
         self.stack = []
 
@@ -265,6 +544,7 @@ class _StarDataConverter:
             print(self._errorMessage('System error:'))
             raise
 
+    @Profiling.profiled(Profiling.PHASE_CONVERT)
     def convert(self):
 
         nmrDataExtent = NmrDataExtent(name=self.dataExtent.name)
@@ -305,15 +585,8 @@ class _StarDataConverter:
 
         self.stack.append(dataBlock)
 
-        # get NmrDataBlock name
-        name = dataBlock.name
-        if name.startswith('data_'):
-            name = name[5:] or '__MissingDataBlockName'
-        elif name == 'global_':
-            name = 'global'
-
         # Make NmrDataBlock and connect it
-        nmrDataBlock = NmrDataBlock(name=name)
+        nmrDataBlock = NmrDataBlock(name=self._nmrDataBlockName(dataBlock.name))
 
         for saveFrame in dataBlock.values():
             nmrSaveFrame = self.convertSaveFrame(saveFrame)
@@ -322,6 +595,14 @@ class _StarDataConverter:
         self.stack.pop()
         return nmrDataBlock
 
+    def _nmrDataBlockName(self, name):
+        """get NmrDataBlock name from DataBlock name"""
+        if name.startswith('data_'):
+            name = name[5:] or '__MissingDataBlockName'
+        elif name == 'global_':
+            name = 'global'
+        return name
+
     def preValidateSaveFrame(self, saveFrame):
 
         self.stack.append(saveFrame)
@@ -405,9 +686,9 @@ class _StarDataConverter:
 
             #
             if isinstance(value, str):
-                if isinstance(value, UnquotedValue):
-                    value = self.convertValue(value, category=lowerCaseCategory, tag=tag)
                 objname = tag[len(prefix):]
+                if isinstance(value, UnquotedValue):
+                    value = self._getValueConverter(lowerCaseCategory, objname, tag)(value)
                 newSaveFrame.addItem(objname, value)
 
             elif isinstance(value, GenericStarParser.Loop):
@@ -437,6 +718,32 @@ class _StarDataConverter:
 
         self.stack.append(loop)
 
+        category, columns = self._convertColumnNames(loop)
+        converters = self._getRowConverters(category, columns)
+
+        newLoop = self._newLoop(category, columns)
+        if self.columnar:
+            # Convert column by column
+            if isinstance(loop, GenericStarParser.ColumnarLoop):
+                oldColumnData = loop._columnData
+            else:
+                oldColumnData = list(zip(*loop._rowValues())) or [() for x in columns]
+            newLoop._setColumnData(
+                    [[ff(x) if isinstance(x, UnquotedValue) else x for x in values]
+                     for ff, values in zip(converters, oldColumnData)]
+                    )
+
+        else:
+            for row in loop.data:
+                newLoop.newRow(self._convertRow(converters, row.values()))
+
+        #
+        self.stack.pop()
+        return newLoop
+
+    def _convertColumnNames(self, loop):
+        """Get NmrLoop category and column names from the column names of a generic loop"""
+
         oldColumns = loop.columns
         commonPrefix = os.path.commonprefix(oldColumns)
         tt = commonPrefix.split('.', 1)
@@ -470,29 +777,42 @@ class _StarDataConverter:
                 raise ValueError("column name (as modified) clashes with Python keyword: %s" % ss)
 
             columns.append(tag)
-
-        newLoop = NmrLoop(category, columns)
-        ff = self.convertValue  #convertValue(value, category=lowerCaseCategory, tag=tag)
-        for row in loop.data:
-            values = [ff(x, category, columns[ii]) if isinstance(x, UnquotedValue) else x
-                      for ii, x in enumerate(row.values())
-                      ]
-            newLoop.newRow(values)
-
         #
-        self.stack.pop()
-        return newLoop
+        return category, columns
+
+    def _newLoop(self, category, columns):
+        """Make new, empty NmrLoop (or ColumnarNmrLoop)"""
+        if self.columnar:
+            return ColumnarNmrLoop(category, columns)
+        else:
+            return NmrLoop(category, columns)
+
+    def _getRowConverters(self, category, columns):
+        """Get list of value conversion functions matching loop columns.
+        Each function shares the results between equal values, see _internedConverter"""
+        return [_internedConverter(self._getValueConverter(category, tag, tag)) for tag in columns]
+
+    def _convertRow(self, converters, values):
+        """Convert loop row values, in column order, using matching converters"""
+        return [ff(x) if isinstance(x, UnquotedValue) else x
+                for ff, x in zip(converters, values)
+                ]
+
+    def _getValueConverter(self, category, name, tag):
+        """Get function converting unquoted values for item name in category.
+
+        Uses the type from the specification, if known, otherwise convertValue"""
+        valueType = self.valueTypes.get((category, name))
+        if valueType is None:
+            return partial(self.convertValue, category=category, tag=tag)
+        else:
+            return partial(_convertTypedValue, valueType, partial(self.convertValue, tag=tag))
 
     def convertValue(self, value, category=None, tag=None):
-        """Convert unquoted string value."""
+        """Convert unquoted string value, using heuristics to determine the type."""
 
         # assert isinstance(value, GenericStarParser.UnquotedValue)
 
-        # if self.specification:
-        #   # Add specification-dependent processing here
-        #   #
-        #   return value
-
         # Convert special values
         if value == NULLSTRING:
             # null  value
@@ -533,6 +853,395 @@ class _StarDataConverter:
         raise StarValidationError(self._errorMessage(msg))
 
 
+class _StarEventConverter(_StarDataConverter, GenericStarParser.StarEventHandler):
+    """Single-pass converter from the GeneralStarParser event stream
+    to a NEF or NMRSTAR nested data structure, without making the generic object tree.
+
+    Validation and conversion are as for _StarDataConverter, with the same errors,
+    but each SaveFrame is validated and converted as soon as it is complete,
+    and loop rows are converted as they are parsed.
+
+    The result is in self.result"""
+
+    def __init__(self, fileType='star', specification=None, convertColumnNames=True, columnar=False):
+
+        _StarDataConverter.__init__(self, None, fileType=fileType, specification=specification,
+                                    convertColumnNames=convertColumnNames, columnar=columnar)
+
+        self.result = NmrDataExtent(name='Root')
+
+        # Generic containers for the DataBlock and SaveFrame being parsed.
+        # They provide the error context and checks for duplicate tags,
+        # but hold only the SaveFrame items and empty loops, not the converted data
+        self.dataExtent = GenericStarParser.DataExtent()
+        self.dataBlock = None
+        self.saveFrame = None
+        self.nmrDataBlock = None
+
+        # Converted loops for the current SaveFrame, by first column name
+        self.loops = {}
+
+        # Current loop, with value conversion functions for the columns
+        self.loop = None
+        self.loopConverters = None
+
+    def startDataBlock(self, name):
+        dataBlock = self.dataBlock = GenericStarParser.DataBlock(name)
+        self.dataExtent.addItem(name, dataBlock)
+
+        self.stack = [dataBlock]
+        if name != 'global_' and not name.startswith('data_'):
+            self.raiseValidationError("DataBlock name  must be 'global_' or start with 'data_'")
+
+        self.nmrDataBlock = NmrDataBlock(name=self._nmrDataBlockName(name))
+        self.result.addItem(self.nmrDataBlock.name, self.nmrDataBlock)
+
+    def endDataBlock(self, name):
+        self.dataBlock = self.nmrDataBlock = None
+        self.stack = []
+
+    def startSaveFrame(self, name):
+        # Register name only, for the duplicate check
+        self.dataBlock.addItem(name, None)
+        self.saveFrame = GenericStarParser.SaveFrame(name)
+        self.loops = {}
+
+    def endSaveFrame(self, name):
+        saveFrame = self.saveFrame
+        self.stack = [self.dataBlock]
+        with Profiling.phase(Profiling.PHASE_PREVALIDATE) as parseProfile:
+            self.preValidateSaveFrame(saveFrame)
+        with Profiling.phase(Profiling.PHASE_CONVERT):
+            nmrSaveFrame = self.convertSaveFrame(saveFrame)
+        if parseProfile is not None:
+            parseProfile.count(Profiling.PHASE_CONVERT, saveFrames=1)
+        self.nmrDataBlock.addItem(nmrSaveFrame.name, nmrSaveFrame)
+        self.saveFrame = None
+        self.loops = {}
+
+    def item(self, tag, value):
+        if self.saveFrame is None:
+            self.dataBlock.addItem(tag, value)
+            self._raiseNonSaveFrameError(tag, value)
+        else:
+            self.saveFrame.addItem(tag, value)
+
+    def loopHeader(self, columns):
+
+        # Empty generic loop, for validation and the duplicate checks
+        loop = GenericStarParser.Loop(name=columns[0])
+        container = self.saveFrame if self.saveFrame is not None else self.dataBlock
+        for column in columns:
+            loop.addColumn(column)
+            container.addItem(column, loop)
+        if self.saveFrame is None:
+            self._raiseNonSaveFrameError(loop.name, loop)
+
+        self.stack = [self.dataBlock, self.saveFrame, loop.name]
+        self.preValidateLoop(loop)
+        self.stack.append(loop)
+        category, columns = self._convertColumnNames(loop)
+        self.stack = [self.dataBlock]
+
+        self.loop = self.loops[loop.name] = self._newLoop(category, columns)
+        self.loopConverters = self._getRowConverters(category, columns)
+
+    def loopRow(self, values):
+        self.loop.newRow(self._convertRow(self.loopConverters, values))
+
+    def endLoop(self):
+        self.loop = None
+
+    def convertLoop(self, loop):
+        # Loops are converted while parsing - get the result
+        return self.loops[loop.name]
+
+    def _raiseNonSaveFrameError(self, tag, value):
+        self.stack = [self.dataBlock]
+        self.raiseValidationError("%s file DataBlock contains non-saveframe element %s:%s"
+                                  % (self.fileType, tag, value))
+
+
+def _parseNmrText(text, mode, fileType, columnar=False, lazy=False, specification=None, **filters):
+    """Parse NEF or NMRSTAR text string in a single pass, returning NmrDataExtent
+
+    If lazy, and the text has a simple enough structure, saveframes are only indexed
+    and the datablock is returned as a LazyNmrDataBlock.
+    filters are the saveframe and loop column filters of GenericStarParser.parse;
+    lazy is ignored if there is anything to filter"""
+
+    if lazy and GenericStarParser.SaveFrameFilter.make(**filters) is None:
+        index = _indexSaveFrames(text)
+        if index is not None:
+            header, headerEnd, saveFrameExtents = index
+
+            # Parse the DataBlock header (and any comments) to validate the DataBlock
+            result = _parseNmrText(text[:headerEnd], mode, fileType=fileType)
+            dataBlock = list(result.values())[0]
+            lazyDataBlock = LazyNmrDataBlock(name=dataBlock.name, text=text, header=header,
+                                             fileType=fileType, mode=mode, columnar=columnar,
+                                             specification=specification)
+            for name, extent in saveFrameExtents:
+                lazyDataBlock._addSaveFrameExtent(name, extent)
+            result[dataBlock.name] = lazyDataBlock
+            return result
+
+    converter = _StarEventConverter(fileType=fileType, columnar=columnar, specification=specification)
+    GenericStarParser.parseEvents(text, converter, mode=mode, **filters)
+    return converter.result
+
+
+# Start of line, followed by either multiline string delimiter or a DataBlock or SaveFrame tag
+_structurePattern = re.compile(r'^(;)|^[ \t]*(data_\S*|global_|save_\S*)(?=\s|$)', re.M)
+
+
+# sf_framecode item at the start of a line, with quoted or unquoted value
+_framecodePattern = re.compile(r"""^[ \t]*_\S+\.sf_framecode[ \t]+(?:'([^'\n]*)'|"([^"\n]*)"|(\S+))""",
+                               re.M | re.I)
+
+
+def _indexSaveFrames(text):
+    """Find the saveframe positions in text, without parsing the saveframe contents.
+
+    Returns (DataBlock tag, end of DataBlock tag, [(sf_framecode, _SaveFrameExtent), ...]),
+    or None if the text cannot be indexed this way, i.e. if it does not consist of
+    a single DataBlock containing only saveframes, with each 'save_' tag at the start of a line
+    and an sf_framecode item matching the saveframe name.
+    Texts that return None should be parsed normally, which will also catch any errors"""
+
+    header = headerEnd = None
+    saveFrameStart = None
+    saveFrameName = None
+    inMultiline = False
+    lastEnd = 0
+    gaps = []
+    result = []
+    names = set()
+    lineNumber = 1
+
+    for match in _structurePattern.finditer(text):
+
+        if match.group(1):
+            inMultiline = not inMultiline
+            continue
+        elif inMultiline:
+            continue
+
+        tag = match.group(2)
+        start = match.start(2)
+        if tag.startswith('save_'):
+            if headerEnd is None:
+                return None
+
+            elif tag == 'save_':
+                # End of saveframe
+                if saveFrameStart is None:
+                    return None
+                lineNumber += text.count('\n', lastEnd, saveFrameStart)
+                end = match.end()
+                # The saveframe is stored under its sf_framecode, as for normal loading,
+                # which may differ in case from the name in the 'save_' tag
+                framecodeMatch = _framecodePattern.search(text, saveFrameStart, end)
+                if framecodeMatch is None:
+                    return None
+                framecode = next(x for x in framecodeMatch.groups() if x is not None)
+                if framecode.lower() != saveFrameName.lower():
+                    return None
+                result.append((framecode, _SaveFrameExtent(saveFrameStart, end, lineNumber)))
+                lineNumber += text.count('\n', saveFrameStart, end)
+                lastEnd = end
+                saveFrameStart = None
+
+            else:
+                # Start of saveframe
+                if saveFrameStart is not None:
+                    return None
+                saveFrameName = tag[5:]
+                if not saveFrameName or saveFrameName.lower() in names:
+                    return None
+                names.add(saveFrameName.lower())
+                gaps.append((lastEnd, start))
+                saveFrameStart = start
+
+        elif headerEnd is None:
+            # DataBlock header
+            gaps.append((0, start))
+            header = tag
+            headerEnd = lastEnd = match.end()
+            lineNumber += text.count('\n', 0, headerEnd)
+
+        else:
+            # More than one DataBlock
+            return None
+
+    if headerEnd is None or saveFrameStart is not None or inMultiline:
+        return None
+
+    # Outside saveframes only comments are allowed
+    gaps.append((lastEnd, len(text)))
+    for start, end in gaps:
+        for line in text[start:end].splitlines():
+            line = line.strip()
+            if line and not line.startswith('#'):
+                return None
+    #
+    return header, headerEnd, result
+
+
+def _columnDtype(values, masked=False):
+    """numpy dtype matching column values: bool, int64, float64 or unicode string.
+    Unless masked, int columns with nulls are float64, and bool or string columns with nulls object"""
+    import numpy as np
+
+    hasNulls = False
+    types = set()
+    maxLength = 1
+    for value in values:
+        if value is None:
+            hasNulls = True
+        else:
+            types.add(type(value))
+            if isinstance(value, str):
+                maxLength = max(maxLength, len(value))
+
+    if not types:
+        return np.dtype(float)
+    elif types <= {int, float} and bool not in types:
+        if float in types or (hasNulls and not masked):
+            return np.dtype(float)
+        return np.dtype('int64')
+    elif hasNulls and not masked:
+        return np.dtype(object)
+    elif types == {bool}:
+        return np.dtype(bool)
+    elif all(issubclass(x, str) for x in types):
+        return np.dtype('U%s' % maxLength)
+    else:
+        return np.dtype(object)
+
+
+def _fillNulls(values, dtype, masked, fillValue, context=None):
+    """Replace null values (None) for conversion to dtype. Returns (values, nullIndices)
+
+    Default fillValue is NaN for floating point dtypes, None for object, and zero/empty if masked"""
+
+    nulls = [ii for ii, value in enumerate(values) if value is None]
+    if nulls:
+        if fillValue is None:
+            if dtype.kind in 'fc':
+                fillValue = float('nan')
+            elif dtype.kind == 'O':
+                return values, nulls
+            elif masked:
+                fillValue = dtype.type()
+            else:
+                raise ValueError("%s column %s: null values cannot be converted to %s"
+                                 % (context[0], context[1], dtype))
+        values = list(values)
+        for ii in nulls:
+            values[ii] = fillValue
+    #
+    return values, nulls
+
+
+# Special values, converted the same for all types
+_specialValues = {NULLSTRING: None, UNKNOWNSTRING: None, TRUESTRING: True, FALSESTRING: False}
+
+
+def getSpecificationValueTypes(specification):
+    """Get dict {(category, itemName):valueType} from NEF specification NmrDataBlock,
+    where valueType is int, float or str, from the item type_code.
+
+    category is the saveframe category for saveframe items and the loop category for loop columns.
+    Items whose type is numeric but not int or float are left out."""
+
+    primitiveCodes = {}
+    specificationFrame = specification.get('nef_specification')
+    if specificationFrame is not None and 'item_type_list' in specificationFrame:
+        for row in specificationFrame['item_type_list'].data:
+            primitiveCodes[row['code']] = row['primitive_code']
+
+    prefix = 'nef_saveframe_'
+    result = {}
+    for name, saveFrame in specification.items():
+        if name.startswith(prefix) and 'nef_item' in saveFrame:
+            saveFrameCategory = name[len(prefix):]
+            for row in saveFrame['nef_item'].data:
+                typeCode = row['type_code']
+                if typeCode == 'int':
+                    valueType = int
+                elif typeCode == 'float':
+                    valueType = float
+                elif primitiveCodes.get(typeCode) in ('char', 'uchar'):
+                    valueType = str
+                else:
+                    continue
+                result[(row['loop_category'] or saveFrameCategory, row['name'])] = valueType
+    #
+    return result
+
+
+def getSpecificationKeyColumns(specification):
+    """Get dict {loopCategory:(columnName, ...)} from NEF specification NmrDataBlock,
+    giving the is_key columns of each loop in specification order.
+
+    Loops without key columns are left out."""
+
+    prefix = 'nef_saveframe_'
+    result = {}
+    for name, saveFrame in specification.items():
+        if name.startswith(prefix) and 'nef_item' in saveFrame:
+            for row in saveFrame['nef_item'].data:
+                loopCategory = row['loop_category']
+                if loopCategory and row['is_key'] is True:
+                    result.setdefault(loopCategory, []).append(row['name'])
+    #
+    return dict((category, tuple(names)) for category, names in result.items())
+
+
+def _convertTypedValue(valueType, fallback, value):
+    """Convert unquoted string value to valueType (int, float, or str).
+    Special values are converted as in _StarDataConverter.convertValue;
+    values that do not match the type are passed to fallback"""
+
+    if value in _specialValues:
+        return _specialValues[value]
+    elif value[0] == '$':
+        # SaveFrame reference
+        return value[1:]
+    elif valueType is str:
+        return value
+    try:
+        return valueType(value)
+    except ValueError:
+        return fallback(value)
+
+
+def _internedConverter(converter, maxSize=None):
+    """Wrap value conversion function converter, so that the same result object is returned
+    for equal values. Results are stored for up to maxSize distinct values
+    (default GenericStarParser.MAX_INTERNED_VALUES)"""
+
+    if maxSize is None:
+        maxSize = GenericStarParser.MAX_INTERNED_VALUES
+    results = {}
+    getResult = results.get
+
+    def convert(value):
+        result = getResult(value, _notInterned)
+        if result is _notInterned:
+            result = converter(value)
+            if len(results) < maxSize:
+                results[value] = result
+        return result
+
+    return convert
+
+
+# Marker for values without stored results in _internedConverter
+_notInterned = object()
+
+
 def splitNefSequence(rows):
     """Split a sequence of nef_sequence dicts assumed to belong to the same chain
     into a list of lists of sequentially linked stretches following the NEF rules
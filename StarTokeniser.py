@@ -112,6 +112,11 @@ _REGEX = r"""(?xmi) # $Revision$  # No 'u' flag for perl 5.8.8/RHEL5 compatibili
 # Compiled form of _REGEX
 _star_pattern = re.compile(_REGEX, re.UNICODE)
 
+# Compiled bytes form of the same _REGEX, for tokenising bytes or memory-mapped files.
+# NB in bytes mode \s matches only ASCII whitespace, so e.g. non-breaking spaces
+# are not token separators, and line endings are not normalised as for text-mode files
+_star_bytes_pattern = re.compile(_REGEX.encode('ascii'))
+
 # Token types. NB numbers must be synced to regex - these are used directly!!!
 TOKEN_MULTILINE         = 1
 TOKEN_COMMENT           = 2
@@ -138,14 +143,30 @@ TOKEN_BAD_TOKEN         = 17
 # - to wrap the regex iterator without a wrapping class.
 
 #
-StarToken = collections.namedtuple('StarToken', ('type', 'value'))
+# start is the offset of the token in the text - in characters for text input, in bytes for bytes input
+StarToken = collections.namedtuple('StarToken', ('type', 'value', 'start'))
 
 
 # Removed for Python 2 compatibility:
 # StarToken.__doc__ = "StarToken named tuple (with fields 'type', 'value')"
 # "returned by the STAR token iterator"
 
-def getTokenIterator(text):
-    """Iterator that returns an iterator over all STAR tokens in a generic STAR file"""
-    return (StarToken(x.lastindex, x.group(x.lastindex))
-            for x in _star_pattern.finditer(text))
+def getTokenIterator(text, start=0):
+    """Iterator that returns an iterator over all STAR tokens in a generic STAR file,
+    starting at offset start, which must be at a token or whitespace"""
+    return (StarToken(x.lastindex, x.group(x.lastindex), x.start())
+            for x in _star_pattern.finditer(text, start))
+
+
+def getBytesTokenIterator(data, encoding='utf-8', start=0):
+    """Iterator over all STAR tokens in data, a bytes-like object (bytes, mmap, ...),
+    starting at offset start, which must be at a token or whitespace
+
+    Only the token values are decoded, as they are reached.
+    '\\r\\n' line endings inside multi-line strings are converted to '\\n', as for text-mode files"""
+    for x in _star_bytes_pattern.finditer(data, start):
+        typ = x.lastindex
+        value = x.group(typ).decode(encoding)
+        if typ == TOKEN_MULTILINE and '\r' in value:
+            value = value.replace('\r\n', '\n')
+        yield StarToken(typ, value, x.start())
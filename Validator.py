@@ -30,6 +30,11 @@ __date__ = "$Date: 2017-03-23 16:50:22 +0000 (Thu, March 23, 2017) $"
 #=========================================================================================
 
 import re
+from collections import namedtuple, OrderedDict
+from operator import itemgetter
+
+from . import GenericStarParser
+from . import Profiling
 
 NMR_EXCHANGE_FORMAT = 'nmr_exchange_format'
 FRAME_PREFIX = 'nef_saveframe_'
@@ -53,17 +58,317 @@ CREATION_DATE = 'creation_date'
 UUID = 'uuid'
 VERSION = 'version'
 CCPN_PREFIX = 'ccpn_'
+ITEM_TYPE_LIST = 'item_type_list'
+TYPE_CODE = 'type_code'
+
+# Maximum number of incorrect values quoted in the type error for a loop column
+MAX_TYPE_ERROR_EXAMPLES = 5
+
+# Validation plan for a saveframe category, compiled from the specification
+# Fields that are checked for presence are tuples, to keep the order of the error messages
+_SaveFramePlan = namedtuple('_SaveFramePlan', ('category', 'mandatoryFields', 'allowedFields', 'loopNames',
+                                               'mandatoryLoops', 'loopPlans'))
+_LoopPlan = namedtuple('_LoopPlan', ('mandatoryFields', 'allowedFields', 'columnTypes', 'keyColumns'))
+
+# Value check for a type_code from the specification item_type_list.
+# Values of numericTypes are accepted as is; other values are matched, as text, against
+# valuePattern, or all together against columnPattern, with values separated by '\0'
+_TypeCheck = namedtuple('_TypeCheck', ('typeCode', 'numericTypes', 'valuePattern', 'columnPattern'))
+_NoneType = type(None)
+
+# Referential integrity error, as reported by Validator.integrityErrors
+#   errorType is one of the integrity error types below, row is the loop row index, or None
+#   for saveframe items, columns and values are tuples of the column names and values concerned
+IntegrityError = namedtuple('IntegrityError', ('errorType', 'saveFrame', 'loop', 'row', 'columns', 'values', 'message'))
+
+DUPLICATE_KEY = 'duplicate_key'
+MISSING_SAVEFRAME = 'missing_saveframe'
+MISSING_ROW = 'missing_row'
+MISSING_RESIDUE = 'missing_residue'
+RESIDUE_NAME_MISMATCH = 'residue_name_mismatch'
+
+# References to saveframes, as {(sf_category, loop category or None, column): (referenced sf_category, ...)}
+FRAMECODE_REFERENCES = {
+    ('nef_nmr_spectrum', None, 'chemical_shift_list')                            : ('nef_chemical_shift_list',),
+    ('nef_peak_restraint_links', 'nef_peak_restraint_link', 'nmr_spectrum_id')   : ('nef_nmr_spectrum',),
+    ('nef_peak_restraint_links', 'nef_peak_restraint_link', 'restraint_list_id') : ('nef_distance_restraint_list',
+                                                                                    'nef_dihedral_restraint_list',
+                                                                                    'nef_rdc_restraint_list'),
+    }
+
+# References to rows in other saveframes, as {(loop category, framecode column, column): referenced column},
+# where referenced column is looked up in the loops of the saveframe given by framecode column
+ROW_REFERENCES = {
+    ('nef_peak_restraint_link', 'nmr_spectrum_id', 'peak_id')         : 'peak_id',
+    ('nef_peak_restraint_link', 'restraint_list_id', 'restraint_id')  : 'restraint_id',
+    }
+
+# Residues are referenced by chain_code, sequence_code and residue_name columns, with an optional
+# suffix '_1', '_2', etc.; chain and sequence codes with these prefixes/characters are unassigned
+_UNASSIGNED_CHAIN_PREFIXES = ('@', '#')
+_UNASSIGNED_SEQUENCE_CHARACTER = '@'
+# Uncertain chain and sequence codes end in '?', e.g. '108?';
+# offset sequence codes refer to a residue relative to another, e.g. '28-1' or '28+1'
+_UNCERTAIN_CODE_SUFFIX = '?'
+_offsetSequenceCode = re.compile(r'.+[+-][0-9]+').fullmatch
+_MAX_RESIDUE_REFERENCES = 15
+
+# Saveframes with at least this many loop rows are validated in a process pool, if Validator.jobs > 1
+# and there are at least two of them; smaller files are validated serially, to avoid the process startup
+PARALLEL_MIN_ROWS = 20000
+
+# Loop shipped to a validation process, with the values stored column-wise
+_LoopData = namedtuple('_LoopData', ('name', 'columns', 'columnData'))
+
+# Validation plans in a validation process, set by _initValidationProcess
+_processPlans = None
+
+# Plans for the most recently used specifications, as [(validNef, plans), ...]
+_validationPlans = []
+_MAX_VALIDATION_PLANS = 4
+
+
+def getValidationPlans(validNef):
+    """Get dict {sf_category: _SaveFramePlan} for the specification validNef.
+
+    The plans are compiled on first use and re-used for the same specification object,
+    which must be treated as read-only"""
+    for specification, plans in _validationPlans:
+        if specification is validNef:
+            return plans
+
+    plans = _compileValidationPlans(validNef)
+    _validationPlans.insert(0, (validNef, plans))
+    del _validationPlans[_MAX_VALIDATION_PLANS:]
+    return plans
+
+
+def _compileValidationPlans(validNef):
+    """Compile the validation plans for all saveframe categories in the specification validNef.
+
+    The first specification frame for a category is used; ccpn_ categories are not validated
+    unless defined in the first frame of the specification"""
+    typeChecks = _compileTypeChecks(validNef)
+    plans = {}
+    for index, validFrame in enumerate(validNef.values()):
+
+        # get the actual name from the end the the name - may need to be more complex later
+        checkName = re.findall(FRAME_SEARCH, validFrame.name)
+        if not checkName or checkName[0] in plans or (index and checkName[0].startswith(CCPN_PREFIX)):
+            continue
+
+        items = validFrame[NEF_ITEM].data
+        loopRows = validFrame[NEF_LOOP].data if NEF_LOOP in validFrame else []
+
+        # items against loop_category = None, i.e., this saveframe
+        mandatoryFields = tuple(nm[NAME] for nm in items if nm[IS_MANDATORY] is True and nm[LOOP_CATEGORY] is None)
+        optionalFields = tuple(nm[NAME] for nm in items if nm[IS_MANDATORY] is False and nm[LOOP_CATEGORY] is None)
+        loopNames = tuple(nm[CATEGORY] for nm in loopRows)
+
+        loopPlans = {}
+        for loop in loopNames:
+            # get the keys that belong to this loop
+            mandatoryLoopFields = tuple(nm[NAME] for nm in items if nm[IS_MANDATORY] is True and nm[LOOP_CATEGORY] == loop)
+            optionalLoopFields = tuple(nm[NAME] for nm in items if nm[IS_MANDATORY] is False and nm[LOOP_CATEGORY] == loop)
+            columnTypes = dict((nm[NAME], typeChecks[nm[TYPE_CODE]]) for nm in items
+                               if nm[LOOP_CATEGORY] == loop and nm[TYPE_CODE] in typeChecks)
+            loopPlans[loop] = _LoopPlan(mandatoryFields=mandatoryLoopFields,
+                                        allowedFields=frozenset(mandatoryLoopFields + optionalLoopFields),
+                                        columnTypes=columnTypes,
+                                        keyColumns=tuple(nm[NAME] for nm in items
+                                                         if nm[IS_KEY] is True and nm[LOOP_CATEGORY] == loop))
+
+        plans[checkName[0]] = _SaveFramePlan(category=checkName[0],
+                                             mandatoryFields=mandatoryFields,
+                                             allowedFields=frozenset(mandatoryFields + optionalFields + loopNames),
+                                             loopNames=frozenset(loopNames),
+                                             mandatoryLoops=tuple(nm[CATEGORY] for nm in loopRows if nm[IS_MANDATORY] is True),
+                                             loopPlans=loopPlans)
+    return plans
+
+
+def _compileTypeChecks(validNef):
+    """Get dict {type_code: _TypeCheck} from the item_type_list of the specification validNef.
+
+    Type codes whose construct is not a valid regular expression are left out (not checked)"""
+    result = {}
+    specificationFrame = validNef.get(SPECIFICATION_KEY)
+    if specificationFrame is None or ITEM_TYPE_LIST not in specificationFrame:
+        return result
+
+    for row in specificationFrame[ITEM_TYPE_LIST].data:
+        typeCode = row['code']
+        construct = row['construct']
+        if typeCode == 'int':
+            numericTypes = frozenset((int,))
+        elif row['primitive_code'] == 'numb':
+            numericTypes = frozenset((int, float))
+        else:
+            numericTypes = frozenset()
+
+        try:
+            valuePattern = re.compile(construct, re.DOTALL)
+            columnPattern = re.compile('(?:{0})(?:\x00(?:{0}))*'.format(construct), re.DOTALL)
+        except (re.error, TypeError):
+            continue
+        result[typeCode] = _TypeCheck(typeCode, numericTypes, valuePattern, columnPattern)
+    return result
+
+
+def _valueText(value):
+    """Text of a converted value, as in the Nef file, for matching against the type constructs"""
+    if value is True:
+        return 'true'
+    elif value is False:
+        return 'false'
+    return str(value)
+
+
+def _columnTypeErrors(values, typeCheck):
+    """Get list of (index, value) for the values of a loop column that do not match typeCheck.
+
+    None (null or unknown) values are always accepted. The column is checked in bulk -
+    by the set of value types, and one regular expression match over the text values -
+    and only searched value by value if that fails"""
+    numericTypes = typeCheck.numericTypes
+    valueTypes = set(map(type, values))
+    valueTypes.discard(_NoneType)
+    if valueTypes <= numericTypes:
+        return []
+
+    if all(issubclass(valueType, str) for valueType in valueTypes):
+        # columns of text values are mostly repeats, so only the distinct values are matched
+        texts = set(values)
+        texts.discard(None)
+    else:
+        texts = [_valueText(x) for x in values if x is not None and type(x) not in numericTypes]
+    if typeCheck.columnPattern.fullmatch('\x00'.join(texts)) is not None:
+        return []
+
+    valuePattern = typeCheck.valuePattern
+    return [(ii, x) for ii, x in enumerate(values)
+            if x is not None and type(x) not in numericTypes and valuePattern.fullmatch(_valueText(x)) is None]
+
+
+def _loopColumnValues(loop, column):
+    """Get list of values for column in loop, or None if no row has the column"""
+    if column not in loop.columns:
+        return None
+    if not isinstance(loop, GenericStarParser.ColumnarLoop):
+        try:
+            return list(map(itemgetter(column), loop.data))
+        except KeyError:
+            # inconsistent rows are reported by Validator._loop_inconsistent_rows
+            pass
+    return loop.getColumnValues(column)
+
+
+def _residueColumns(columns):
+    """Get list of (chain_code, sequence_code, residue_name or None) column name triplets in columns"""
+    result = []
+    for suffix in [''] + ['_{}'.format(ii) for ii in range(1, _MAX_RESIDUE_REFERENCES + 1)]:
+        chainColumn = 'chain_code' + suffix
+        sequenceColumn = 'sequence_code' + suffix
+        if chainColumn in columns and sequenceColumn in columns:
+            residueColumn = 'residue_name' + suffix
+            result.append((chainColumn, sequenceColumn, residueColumn if residueColumn in columns else None))
+    return result
+
+
+def _isUnassigned(chainCode, sequenceCode):
+    """True if the residue reference is unassigned (or partly assigned), uncertain or an offset,
+    so not in nef_sequence"""
+    if chainCode is None or sequenceCode is None:
+        return True
+    chainCode = str(chainCode)
+    sequenceCode = str(sequenceCode)
+    return (chainCode.startswith(_UNASSIGNED_CHAIN_PREFIXES)
+            or _UNASSIGNED_SEQUENCE_CHARACTER in sequenceCode
+            or chainCode.endswith(_UNCERTAIN_CODE_SUFFIX) or sequenceCode.endswith(_UNCERTAIN_CODE_SUFFIX)
+            or _offsetSequenceCode(sequenceCode) is not None)
+
+
+def _saveFrameStamp(saveframe):
+    """Modification stamp for the saveframe and its loops, that changes whenever any of them is modified,
+    or None if modifications cannot be detected, e.g. for loops given as lists"""
+    if not isinstance(saveframe, GenericStarParser.NamedOrderedDict):
+        return None
+
+    result = [saveframe.modificationStamp()]
+    for value in saveframe.values():
+        if isinstance(value, GenericStarParser.Loop):
+            result.append(value.modificationStamp())
+        elif isinstance(value, (list, dict)):
+            return None
+    return tuple(result)
+
+
+def _saveFrameRowCount(saveframe):
+    """Total number of rows in the loops of saveframe"""
+    return sum(len(value.data) for value in saveframe.values() if isinstance(value, GenericStarParser.Loop))
+
+
+def _saveFramePayload(saveframe):
+    """Get (name, [(tag, value), ...]) for saveframe, with loops as _LoopData, for shipping to a validation process,
+    or None if the saveframe cannot be shipped without changing the validation result"""
+    items = []
+    for tag, value in saveframe.items():
+        if isinstance(value, GenericStarParser.Loop):
+            columns = value.columns
+            if not isinstance(value, GenericStarParser.ColumnarLoop):
+                keys = dict.fromkeys(columns).keys()
+                if not all(row.keys() == keys for row in value.data):
+                    # inconsistent rows are lost in the columnar form
+                    return None
+            value = _LoopData(value.name, columns, [_loopColumnValues(value, column) for column in columns])
+        elif isinstance(value, (list, dict)):
+            return None
+        items.append((tag, value))
+    return saveframe.name, items
+
+
+def _initValidationProcess(plans):
+    """Set the validation plans in a validation process"""
+    global _processPlans
+    _processPlans = plans
+
+
+def _validateSaveFramePayload(sf_name, payload):
+    """Validate a saveframe shipped by _saveFramePayload, in a validation process
+
+    :return (error key, list of errors), as Validator._validate_saveframe
+    """
+    name, items = payload
+    saveframe = GenericStarParser.SaveFrame(name)
+    for tag, value in items:
+        if isinstance(value, _LoopData):
+            loop = GenericStarParser.ColumnarLoop(value.name, value.columns)
+            loop._setColumnData(value.columnData)
+            value = loop
+        saveframe[tag] = value
+    return Validator()._validate_saveframe(sf_name, saveframe, _processPlans)
 
 
 class Validator(object):
 
-    def __init__(self, nef=None, validateNefDict=None):
+    def __init__(self, nef=None, validateNefDict=None, jobs=1):
         self.nef = nef
         self.validateNefDict = validateNefDict
         self._validation_errors = None
 
+        # Number of processes for validating saveframes with at least PARALLEL_MIN_ROWS rows
+        self.jobs = jobs
+
+        # Validation results of the saveframes at the last validation,
+        # as {sf_name: (saveframe, modification stamp, error key, errors)}, and the specification used
+        self._saveFrameResults = {}
+        self._saveFrameResultsSpecification = None
+
     def isValid(self, nef=None, validNef=None):
         """Return whether the Nef file is valid
+
+        Saveframes that are unchanged since the previous validation by this Validator
+        are not validated again - see _saveFrameStamp
         """
         if nef is None:
             nef = self.nef
@@ -83,6 +388,13 @@ class Validator(object):
             self.isValid(self.nef, self.validateNefDict)
         return self._validation_errors
 
+    def clearValidationCache(self):
+        """Clear the stored saveframe results, so that the next validation checks all saveframes
+        """
+        self._saveFrameResults = {}
+        self._saveFrameResultsSpecification = None
+
+    @Profiling.profiled(Profiling.PHASE_VALIDATE)
     def _validateAll(self, nef=None, validNef=None):
         """Validate a nef file (nef) against a nef dictionary (validNef)
         """
@@ -97,84 +409,294 @@ class Validator(object):
 
         self._validation_errors = dict()
         self._validation_errors[SAVEFRAME] = []
+        plans = getValidationPlans(validNef)
+
+        # saveframe results from the previous validation, if against the same specification
+        if self._saveFrameResultsSpecification is not validNef:
+            self._saveFrameResults = {}
+            self._saveFrameResultsSpecification = validNef
+        previousResults = self._saveFrameResults
+        self._saveFrameResults = saveFrameResults = {}
 
         # validate meta_data
         e = self._validation_errors[SAVEFRAME]
         e += self._validate_nmr_meta_data(nef, validNef)
 
         # go through all the saveframes in the Nef object
+        saveFrames = []
+        nameError = None
         for sf_name, saveframe in nef.items():
 
             if SF_FRAMECODE not in saveframe or saveframe.name != saveframe[SF_FRAMECODE]:
-                e = self._validation_errors[SAVEFRAME]
-                e += ["Saveframe.name for sf_framecode '{}' is not defined correctly.".format(saveframe[SF_FRAMECODE]), ]
+                nameError = "Saveframe.name for sf_framecode '{}' is not defined correctly.".format(saveframe[SF_FRAMECODE])
                 break
+            saveFrames.append((sf_name, saveframe))
+
+        # re-use the results from the previous validation for unchanged saveframes
+        pending = []
+        for sf_name, saveframe in saveFrames:
+            stamp = _saveFrameStamp(saveframe)
+            result = previousResults.get(sf_name)
+            if stamp is not None and result is not None and result[0] is saveframe and result[1] == stamp:
+                saveFrameResults[sf_name] = result
+            else:
+                pending.append((sf_name, saveframe, stamp))
+
+        parseProfile = Profiling.activeProfile()
+        if parseProfile is not None:
+            parseProfile.count(Profiling.PHASE_VALIDATE, saveFrames=len(saveFrames),
+                               changedSaveFrames=len(pending))
+
+        # validate the changed saveframes, the large ones in parallel if required
+        parallelResults = self._validate_parallel(pending, plans) if (self.jobs or 1) > 1 else {}
+        for sf_name, saveframe, stamp in pending:
+            result = parallelResults.get(sf_name)
+            if result is None:
+                result = self._validate_saveframe(sf_name, saveframe, plans)
+            saveFrameResults[sf_name] = (saveframe, stamp) + result
+
+        # merge the errors in saveframe order
+        for sf_name, saveframe in saveFrames:
+            errorKey, errors = saveFrameResults[sf_name][2:]
+            if errorKey is not None:
+                e = self._validation_errors.setdefault(errorKey, [])
+                e += errors
+
+        if nameError is not None:
+            e = self._validation_errors[SAVEFRAME]
+            e += [nameError, ]
+
+        return self._validation_errors
 
-            # check against the validation dictionary
-            for vName, validFrame in validNef.items():
+    def _validate_parallel(self, saveFrames, plans):
+        """Validate the saveframes with at least PARALLEL_MIN_ROWS rows in a pool of self.jobs processes,
+        if there are at least two of them
 
-                # get the actual name from the end the the name - may need to be more complex later
-                checkName = re.findall(FRAME_SEARCH, validFrame.name)
+        :param saveFrames: list of (sf_name, saveframe, modification stamp)
+        :return dict {sf_name: (error key, list of errors)} for the saveframes validated
+        """
+        from concurrent.futures import ProcessPoolExecutor
+
+        names = []
+        payloads = []
+        for sf_name, saveframe, _stamp in saveFrames:
+            if _saveFrameRowCount(saveframe) >= PARALLEL_MIN_ROWS:
+                payload = _saveFramePayload(saveframe)
+                if payload is not None:
+                    names.append(sf_name)
+                    payloads.append(payload)
+        if len(payloads) < 2:
+            return {}
+
+        with ProcessPoolExecutor(max_workers=min(self.jobs, len(payloads)),
+                                 initializer=_initValidationProcess, initargs=(plans,)) as executor:
+            return dict(zip(names, executor.map(_validateSaveFramePayload, names, payloads)))
+
+    def _validate_saveframe(self, sf_name, saveframe, plans):
+        """Validate a saveframe against the validation plan for its category
+
+        :return (error key, list of errors), error key is the category, SAVEFRAME, or None if not checked
+        """
+        # check against the validation plan for the category
+        category = saveframe.get(SF_CATEGORY)
+        plan = plans.get(category)
 
-                if checkName and SF_CATEGORY in saveframe and saveframe[SF_CATEGORY] == checkName[0]:
+        if plan is not None:
 
-                    ERROR_KEY = checkName[0]
-                    if ERROR_KEY not in self._validation_errors:
-                        self._validation_errors[ERROR_KEY] = []
-                    e = self._validation_errors[ERROR_KEY]
+            e = []
 
-                    # check items against loop_category = None, i.e., this saveframe
-                    mandatoryFields = [nm[NAME] for nm in validFrame[NEF_ITEM].data if nm[IS_MANDATORY] is True and nm[LOOP_CATEGORY] is None]
-                    optionalFields = [nm[NAME] for nm in validFrame[NEF_ITEM].data if nm[IS_MANDATORY] is False and nm[LOOP_CATEGORY] is None]
-                    loopNames = [nm['category'] for nm in validFrame[NEF_LOOP].data]
+            # check for missing words/framecode is not correct/category is mismatched/bad fields (keys)
+            e += self._sf_framecode_name_mismatch(saveframe, sf_name)
+            e += self._dict_missing_keys(saveframe, plan.mandatoryFields, label=sf_name)
+            e += self._sf_category_name_mismatch(saveframe, category)
+            e += self._dict_nonallowed_keys(saveframe, plan.allowedFields, label=sf_name)
 
-                    # check for missing words/framecode is not correct/category is mismatched/bad fields (keys)
-                    e += self._sf_framecode_name_mismatch(saveframe, sf_name)
-                    e += self._dict_missing_keys(saveframe, mandatoryFields, label=sf_name)
-                    e += self._sf_category_name_mismatch(saveframe, checkName[0])
-                    e += self._dict_nonallowed_keys(saveframe, mandatoryFields + optionalFields + loopNames, label=sf_name)
+            loops = [kk for kk in saveframe.keys() if kk in plan.loopNames]
 
-                    loops = [kk for kk in saveframe.keys() if kk in loopNames]
+            # check that all the mandatory loops have been included
+            e += self._dict_missing_keys(loops, plan.mandatoryLoops, label=sf_name, keyType='loop')
 
-                    # check that all the mandatory loops have been included
-                    mandatoryLoops = [nm[CATEGORY] for nm in validFrame[NEF_LOOP].data if nm[IS_MANDATORY] is True]
-                    e += self._dict_missing_keys(loops, mandatoryLoops, label=sf_name, keyType='loop')
+            # iterate through loops
+            for loop in loops:
 
-                    # iterate through loops
-                    for loop in loops:
+                # get the keys that belong to this loop
+                loopPlan = plan.loopPlans[loop]
 
-                        # get the keys that belong to this loop
-                        mandatoryLoopFields = [nm[NAME] for nm in validFrame[NEF_ITEM].data if nm[IS_MANDATORY] is True and nm[LOOP_CATEGORY] == loop]
-                        optionalLoopFields = [nm[NAME] for nm in validFrame[NEF_ITEM].data if nm[IS_MANDATORY] is False and nm[LOOP_CATEGORY] == loop]
+                if saveframe[loop]:
+                    # NOTE:ED - changed to allow empty loops
+                    if saveframe[loop].data:
+                        # check for missing words/bad fields (keys)/malformed loops
+                        e += self._dict_missing_keys(saveframe[loop].data[0], loopPlan.mandatoryFields, label='{}:{}'.format(sf_name, loop))
+                        e += self._dict_nonallowed_keys(saveframe[loop].data[0], loopPlan.allowedFields, label='{}:{}'.format(sf_name, loop))
+                        e += self._loop_inconsistent_rows(saveframe[loop], label='{}:{}'.format(sf_name, loop))
+                        e += self._loop_type_errors(saveframe[loop], loopPlan.columnTypes, label='{}:{}'.format(sf_name, loop))
+                    else:
+                        # there should not be any loops without data - could be mandatory loops
+                        # e += ["Loop '{}' contains no data.".format(loop), ]
+                        pass
 
-                        if saveframe[loop]:
-                            # NOTE:ED - changed to allow empty loops
-                            if saveframe[loop].data:
-                                # check for missing words/bad fields (keys)/malformed loops
-                                e += self._dict_missing_keys(saveframe[loop].data[0], mandatoryLoopFields, label='{}:{}'.format(sf_name, loop))
-                                e += self._dict_nonallowed_keys(saveframe[loop].data[0], mandatoryLoopFields + optionalLoopFields, label='{}:{}'.format(sf_name, loop))
-                                e += self._loop_entries_inconsistent_keys(saveframe[loop].data, label='{}:{}'.format(sf_name, loop))
-                            else:
-                                # there should not be any loops without data - could be mandatory loops
-                                # e += ["Loop '{}' contains no data.".format(loop), ]
-                                pass
+                else:
+                    # this error is a catch-all as loadFile should test the integrity of the nef file before validation
+                    e += ["Error reading loop '{}'.".format(loop), ]
 
-                        else:
-                            # this error is a catch-all as loadFile should test the integrity of the nef file before validation
-                            e += ["Error reading loop '{}'.".format(loop), ]
+            return category, e
 
-                    break
+        elif category is not None and category.startswith(CCPN_PREFIX):
 
-                elif SF_CATEGORY in saveframe and saveframe[SF_CATEGORY].startswith(CCPN_PREFIX):
+            # skip ccpn_ specific categories for now.
+            return None, []
 
-                    # skip ccpn_ specific categories for now.
-                    break
+        else:
+            return SAVEFRAME, ["No sf_category '{}' found (possibly bad name defined).".format(saveframe[SF_CATEGORY]),]
 
-            else:
-                e = self._validation_errors[SAVEFRAME]
-                e += ["No sf_category '{}' found (possibly bad name defined).".format(saveframe[SF_CATEGORY]),]
+    def integrityErrors(self, nef=None, validNef=None):
+        """Check the referential integrity of the Nef file, and return list of IntegrityError.
 
-        return self._validation_errors
+        Checks that the is_key columns of each loop are unique, that references to saveframes
+        (FRAMECODE_REFERENCES) and to rows in other saveframes (ROW_REFERENCES) exist,
+        and that assigned residues are in nef_sequence, with the same residue_name.
+
+        Indexes of the referenced values are built once, so the check is linear in the number of rows.
+        The check is separate from isValid, as unresolved references are common in work-in-progress files
+        """
+        if nef is None:
+            nef = self.nef
+        if validNef is None:
+            validNef = self.validateNefDict
+        if not nef:
+            raise RuntimeError('Error: nef not defined')
+        if not validNef:
+            raise RuntimeError('Error: validateNefDict not defined')
+
+        plans = getValidationPlans(validNef)
+
+        # indexes over the whole file
+        frameCategories = dict((sf_name, saveframe.get(SF_CATEGORY)) for sf_name, saveframe in nef.items())
+        residueNames = {}
+        for saveframe in nef.values():
+            sequence = saveframe.get('nef_sequence')
+            if sequence is not None and isinstance(sequence, GenericStarParser.Loop):
+                residues = list(zip(_loopColumnValues(sequence, 'chain_code') or [],
+                                    _loopColumnValues(sequence, 'sequence_code') or []))
+                residueNames.update(zip(residues, _loopColumnValues(sequence, 'residue_name') or [None] * len(residues)))
+        rowIndexes = {}
+
+        errors = []
+        for sf_name, saveframe in nef.items():
+            category = saveframe.get(SF_CATEGORY)
+            plan = plans.get(category)
+
+            for tag, value in saveframe.items():
+                if isinstance(value, GenericStarParser.Loop):
+                    loopPlan = plan.loopPlans.get(tag) if plan is not None else None
+                    if loopPlan is not None and loopPlan.keyColumns:
+                        errors += self._duplicate_key_errors(sf_name, value, loopPlan.keyColumns)
+                    errors += self._loop_reference_errors(nef, sf_name, category, value, frameCategories, rowIndexes)
+                    if tag != 'nef_sequence':
+                        errors += self._residue_reference_errors(sf_name, value, residueNames)
+
+                else:
+                    references = FRAMECODE_REFERENCES.get((category, None, tag))
+                    if references and value is not None and frameCategories.get(value) not in references:
+                        errors.append(IntegrityError(MISSING_SAVEFRAME, sf_name, None, None, (tag,), (value,),
+                                                     "{}: {} '{}' is not a {} saveframe."
+                                                     .format(sf_name, tag, value, ' or '.join(references))))
+        return errors
+
+    def _duplicate_key_errors(self, sf_name, loop, keyColumns):
+        """Check that the keyColumns values of the loop rows are unique"""
+        errors = []
+        columnValues = [_loopColumnValues(loop, column) for column in keyColumns]
+        if any(values is None for values in columnValues):
+            # missing key columns are reported by isValid
+            return errors
+
+        keyValues = list(zip(*columnValues))
+        if len(set(keyValues)) == len(keyValues):
+            return errors
+
+        keys = {}
+        for ii, key in enumerate(keyValues):
+            first = keys.setdefault(key, ii)
+            if first != ii:
+                errors.append(IntegrityError(DUPLICATE_KEY, sf_name, loop.name, ii, keyColumns, key,
+                                             '{}:{} item {}: duplicate key {} = {}, as item {}.'
+                                             .format(sf_name, loop.name, ii, keyColumns, key, first)))
+        return errors
+
+    def _loop_reference_errors(self, nef, sf_name, category, loop, frameCategories, rowIndexes):
+        """Check the references from the loop to other saveframes, and rows in other saveframes"""
+        errors = []
+        for column in loop.columns:
+            references = FRAMECODE_REFERENCES.get((category, loop.name, column))
+            if references:
+                for ii, value in enumerate(_loopColumnValues(loop, column)):
+                    if value is not None and frameCategories.get(value) not in references:
+                        errors.append(IntegrityError(MISSING_SAVEFRAME, sf_name, loop.name, ii, (column,), (value,),
+                                                     "{}:{} item {}: {} '{}' is not a {} saveframe."
+                                                     .format(sf_name, loop.name, ii, column, value,
+                                                             ' or '.join(references))))
+
+        for (loopName, frameColumn, column), referencedColumn in ROW_REFERENCES.items():
+            if loopName != loop.name or frameColumn not in loop.columns or column not in loop.columns:
+                continue
+
+            for ii, (frameCode, value) in enumerate(zip(_loopColumnValues(loop, frameColumn),
+                                                        _loopColumnValues(loop, column))):
+                if value is None or frameCode not in nef:
+                    # missing saveframes are reported above
+                    continue
+
+                index = rowIndexes.get((frameCode, referencedColumn))
+                if index is None:
+                    # index referencedColumn over all the loops in the referenced saveframe
+                    index = rowIndexes[(frameCode, referencedColumn)] = set()
+                    for referencedLoop in nef[frameCode].values():
+                        if isinstance(referencedLoop, GenericStarParser.Loop):
+                            index.update(_loopColumnValues(referencedLoop, referencedColumn) or ())
+
+                if value not in index:
+                    errors.append(IntegrityError(MISSING_ROW, sf_name, loop.name, ii, (frameColumn, column),
+                                                 (frameCode, value),
+                                                 "{}:{} item {}: {} {!r} not found in saveframe '{}'."
+                                                 .format(sf_name, loop.name, ii, column, value, frameCode)))
+        return errors
+
+    def _residue_reference_errors(self, sf_name, loop, residueNames):
+        """Check that the assigned residues referenced in the loop are in nef_sequence"""
+        errors = []
+        for chainColumn, sequenceColumn, residueColumn in _residueColumns(loop.columns):
+            chainCodes = _loopColumnValues(loop, chainColumn)
+            sequenceCodes = _loopColumnValues(loop, sequenceColumn)
+            names = _loopColumnValues(loop, residueColumn) if residueColumn else [None] * len(chainCodes)
+            references = list(zip(zip(chainCodes, sequenceCodes), names))
+
+            # check the distinct references, and only search the rows if any are incorrect
+            badReferences = set()
+            for residue, name in set(references):
+                if residue in residueNames:
+                    sequenceName = residueNames[residue]
+                    if name is not None and sequenceName is not None and name != sequenceName:
+                        badReferences.add((residue, name))
+                elif not _isUnassigned(*residue):
+                    badReferences.add((residue, name))
+            if not badReferences:
+                continue
+
+            for ii, (residue, name) in enumerate(references):
+                if (residue, name) not in badReferences:
+                    continue
+                if residue not in residueNames:
+                    errors.append(IntegrityError(MISSING_RESIDUE, sf_name, loop.name, ii,
+                                                 (chainColumn, sequenceColumn), residue,
+                                                 "{}:{} item {}: residue {}.{} not in nef_sequence."
+                                                 .format(sf_name, loop.name, ii, *residue)))
+                else:
+                    errors.append(IntegrityError(RESIDUE_NAME_MISMATCH, sf_name, loop.name, ii,
+                                                 (chainColumn, sequenceColumn, residueColumn), residue + (name,),
+                                                 "{}:{} item {}: residue {}.{} is {} in nef_sequence, not {}."
+                                                 .format(sf_name, loop.name, ii, *residue, residueNames[residue], name)))
+        return errors
 
     def _validate_nmr_meta_data(self, nef, validNef):
         """Check that the information in the meta_data is correct for this version
@@ -254,24 +776,58 @@ class Validator(object):
         #     return ["No sf_category.",]
         return []
 
+    def _loop_inconsistent_rows(self, loop, label):
+        """Check that all the rows of loop have the same fields, in a single pass over the rows.
+
+        ColumnarLoop rows are views on the loop columns, so cannot be inconsistent and are skipped.
+        Rows of other loops are compared with the loop columns, and only if any row differs
+        are the missing fields reported per row"""
+        if isinstance(loop, GenericStarParser.ColumnarLoop):
+            return []
+
+        data = loop.data
+        columns = dict.fromkeys(loop.columns).keys()
+        if all(entry.keys() == columns for entry in data):
+            return []
+        return self._loop_entries_inconsistent_keys(data, label)
+
+    def _loop_type_errors(self, loop, columnTypes, label):
+        """Check the values of the loop columns against the type_code from the specification.
+
+        Gives at most one error per column, with the number of incorrect values
+        and up to MAX_TYPE_ERROR_EXAMPLES examples"""
+        errors = []
+        for column in loop.columns:
+            typeCheck = columnTypes.get(column)
+            if typeCheck is None:
+                continue
+
+            values = _loopColumnValues(loop, column)
+            badValues = _columnTypeErrors(values, typeCheck)
+            if badValues:
+                examples = ', '.join('item {} {!r}'.format(ii, value)
+                                     for ii, value in badValues[:MAX_TYPE_ERROR_EXAMPLES])
+                if len(badValues) > MAX_TYPE_ERROR_EXAMPLES:
+                    examples += ' and {} more'.format(len(badValues) - MAX_TYPE_ERROR_EXAMPLES)
+                errors.append("{}: column {} has {} value(s) not of type '{}': {}."
+                              .format(label, column, len(badValues), typeCheck.typeCode, examples))
+        return errors
+
     def _loop_entries_inconsistent_keys(self, loop, label):
         errors = []
         if len(loop) > 0:
-            fields = list(loop[0].keys())
-            fields_count = len(fields)
-            finished = False
-            while not finished:
-                errors = []
-                finished = True
-                for i, entry in enumerate(loop):
-                    for field in entry:
-                        if field not in fields:
-                            fields.append(field)
-                    if len(fields) > fields_count:
-                        fields_count = len(fields)
-                        finished = False
-                        break
-                    errors += self._dict_missing_keys(entry, fields, label=label + ' item {}'
+            # all fields in the loop, in order of first appearance
+            fields = dict.fromkeys(loop[0].keys())
+            allFields = fields.keys()
+            for entry in loop:
+                if not allFields >= entry.keys():
+                    fields.update(dict.fromkeys(entry.keys()))
+
+            # rows contain only known fields, so any shorter row has missing fields
+            fieldsCount = len(fields)
+            for i, entry in enumerate(loop):
+                if len(entry) != fieldsCount:
+                    errors += self._dict_missing_keys(entry, allFields, label=label + ' item {}'
                                                       .format(i))
         return errors
 
@@ -38,6 +38,10 @@ Command Line Usage:
         -s, --screen            Output batch processing to screen, default is to .txt files
                                 may be used with -d
 
+        -j N, --jobs N          Compare the files of a batch in N parallel processes,
+                                the output is written in the same order as for a
+                                single process
+
         -r, --replace           Replace existing .txt files. If false then files are
                                 appended with '(n)' before the extension, where n is
                                 the next available number
@@ -49,12 +53,32 @@ Command Line Usage:
         --same                  output similarities between Nef files
                                 default is differences
 
+        -q, --quick             No output, only compare the content hashes of the two
+                                files given with -f; the exit code is 0 if the contents
+                                are identical, 1 if different and 2 on error
+
         -a, --almostequal       Consider float/complex numbers to be equal if within the
                                 relative tolerance
 
         -p, --places            Specify the number of decimal places for the relative
                                 tolerance
 
+        -k, --keyalign          Align the rows of loops on the key columns defined in the
+                                Nef specification, rows are listed as present in only one
+                                file or compared with the matching row in the other file
+
+        --keys loop:column,column
+                                Align the rows of loop on the given key columns,
+                                takes precedence over --keyalign
+
+    --profile               Print the time spent in each phase - tokenise, build,
+                            preValidate, convert, validate, write - with the counts of
+                            tokens, loop rows and values, and saveframes, to stderr
+
+        --profilememory         Also trace the peak memory of each phase; this makes
+                                the processing considerably slower. Peaks within
+                                a phase need Python 3.9 or later
+
     --verify                Verify Nef files
 
                             Can be used with switches: -f, -d
@@ -121,8 +145,10 @@ nef.py contains the following routines:
   compareDataBlocks     compare two DataBlock objects and return a comparison list as above
   compareSaveFrames     compare two SaveFrame objects and return a comparison list as above
   compareLoops          compare two Loop objects and return a comparison list as above
+  alignLoopRows         match the rows of two Loop objects on their key columns
 
   compareNefFiles       compare two Nef files and return a comparison list as above
+  quickCompareNefFiles  check whether two Nef files have identical contents from their content hashes
   batchCompareNefFiles  compare two directories of Nef files.
                         Nef Files common to specified directories are compared and the comparison
                         lists are written to the third directory as .txt
@@ -200,13 +226,16 @@ if __name__ == '__main__' and __package__ is None:
 
 import re
 import unittest
-from . import GenericStarParser, StarIo
+from . import GenericStarParser, StarIo, Profiling
 from .SafeOpen import safeOpen
+from .LoopAlignment import loopKeysArgument, getLoopKeyColumns, alignLoopRows
+from .BatchCompare import jobsArgument, parallelCompareNefFiles
 from os import listdir
 from os.path import isfile, join
 from enum import Enum
 from collections.abc import Iterable
 from collections import OrderedDict
+from functools import partial
 from math import isclose
 from cmath import isclose as cisclose
 from ast import literal_eval
@@ -290,6 +319,8 @@ def defineArguments():
                         help='Output directory for batch compare')
 
     parser.add_argument('-s', '--screen', dest='screen', action='store_true', default=False, help='Output batch processing to screen')
+    parser.add_argument('-j', '--jobs', dest='jobs', default=None, type=jobsArgument,
+                        help='Number of processes for batch compare')
     parser.add_argument('-r', '--replace', dest='replaceExisting', action='store_true', default=False,
                         help='Replace existing .txt files. If false, new files are appended with "(n)"')
     parser.add_argument('-c', '--create', dest='createDirs', action='store_true', default=False,
@@ -299,6 +330,8 @@ def defineArguments():
 
     parser.add_argument('--same', dest='identical', action='store_true', default=False,
                         help='Output similarities between Nef files; default is differences')
+    parser.add_argument('-q', '--quick', dest='quick', action='store_true', default=False,
+                        help='No output, exit code 0 if the Nef files are identical, 1 if different, 2 on error')
 
     parser.add_argument('-a', '--almostequal', dest='almostEqual', action='store_true', default=True,
                         help='Consider float/complex values as equal if within tolerance')
@@ -308,6 +341,17 @@ def defineArguments():
     parser.add_argument('-m', '--maxrows', dest='maxRows', default=None, type=_checkInt,
                         help='Specify the maximum number of rows to show/print in each loop/saveframe')
 
+    parser.add_argument('-k', '--keyalign', dest='keyAlign', action='store_true', default=False,
+                        help='Align loop rows on the key columns of the Nef specification')
+    parser.add_argument('--keys', dest='loopKeys', nargs='*', default=None, type=loopKeysArgument,
+                        metavar='loop:column,column',
+                        help='Align the rows of loop on the given key columns')
+
+    parser.add_argument('--profile', dest='profile', action='store_true', default=False,
+                        help='Print the time spent in each phase of loading, validating and writing')
+    parser.add_argument('--profilememory', dest='profileMemory', action='store_true', default=False,
+                        help='With --profile, also trace the peak memory of each phase (Python 3.9 or later for full peaks)')
+
     group = parser.add_mutually_exclusive_group()
     for nefItem in NEFOPTIONS:
         group.add_argument('--{}'.format(nefItem.value), dest='nefOption', action='store_const', const=nefItem,
@@ -669,6 +713,95 @@ def _compareObjects(obj1, obj2, options):
     return True
 
 
+#=========================================================================================
+# _identicalContents
+#=========================================================================================
+
+def _identicalContents(obj1, obj2, options):
+    """Return True if obj1 and obj2 need not be compared as their content hashes are the same
+    Only applies when listing differences; with options.identical everything is listed
+    """
+    return not options.identical and obj1.contentHash() == obj2.contentHash()
+
+
+#=========================================================================================
+# _compareColumnValues
+#=========================================================================================
+
+# Largest ints that convert exactly to float64 and int64
+_MAX_FLOAT_INT = 2 ** 53
+_MAX_INT64 = 2 ** 63 - 1
+
+
+def _numericColumnType(values):
+    """Return int if values contains only int values or None, float if it contains only int/float values or None,
+    and None otherwise
+    """
+    types = set(map(type, values))
+    types.discard(type(None))
+    if types <= {int}:
+        return int
+    elif types <= {int, float}:
+        return float
+    return None
+
+
+def _compareColumnValues(values1, values2, options):
+    """Compare two equal-length lists of column values
+    Return the list of indices where the result of _compareObjects is options.identical,
+    i.e., the rows to report
+
+    Columns containing only int/float/None values are compared as whole numpy arrays
+    using the same rules as _compareObjects; other columns are compared cell by cell.
+    Int columns are compared as int64, and int/float columns as float64, unless they contain ints
+    too large to convert exactly, which are compared cell by cell
+    """
+    columnTypes = {_numericColumnType(values1), _numericColumnType(values2)}
+    if None not in columnTypes:
+        if columnTypes == {int} and not options.almostEqual:
+            dtype, maxInt = 'int64', _MAX_INT64
+        else:
+            dtype, maxInt = float, _MAX_FLOAT_INT
+        if all(abs(val) <= maxInt for values in (values1, values2) for val in values if type(val) is int):
+            result = _compareNumericColumnValues(values1, values2, dtype, options)
+            if result is not None:
+                return result
+
+    # values of the same type that are equal always compare as equal, skip the literal_eval in _compareObjects
+    return [ii for ii, (value1, value2) in enumerate(zip(values1, values2))
+            if ((type(value1) is type(value2) and value1 == value2) or
+                _compareObjects(value1, value2, options)) == options.identical]
+
+
+def _compareNumericColumnValues(values1, values2, dtype, options):
+    """Compare two equal-length lists of int/float/None values as numpy arrays of dtype
+    Return the list of indices where the result of _compareObjects is options.identical,
+    or None if numpy is not available
+    """
+    try:
+        import numpy as np
+    except ImportError:
+        return None
+
+    isNone1 = np.array([val is None for val in values1], dtype=bool)
+    isNone2 = np.array([val is None for val in values2], dtype=bool)
+    array1 = np.array([0 if val is None else val for val in values1], dtype=dtype)
+    array2 = np.array([0 if val is None else val for val in values2], dtype=dtype)
+
+    with np.errstate(invalid='ignore', over='ignore'):
+        if options.almostEqual:
+            # symmetric relative tolerance, as math.isclose
+            relTol = pow(10, -options.places)
+            equal = (array1 == array2) | (np.isfinite(array1) & np.isfinite(array2) &
+                                          (np.abs(array1 - array2) <= relTol * np.maximum(np.abs(array1), np.abs(array2))))
+        else:
+            equal = array1 == array2
+
+    # None only compares equal to None
+    equal = np.where(isNone1 | isNone2, isNone1 & isNone2, equal)
+    return np.flatnonzero(equal == options.identical).tolist()
+
+
 #=========================================================================================
 # compareLoops
 #=========================================================================================
@@ -688,6 +821,10 @@ def compareLoops(loop1, loop2, options, cItem=None, nefList=None):
     if nefList is None:
         nefList = []
 
+    if _identicalContents(loop1, loop2, options):
+        # nothing to list
+        return nefList
+
     lSet = [bl for bl in loop1.columns]
     rSet = [bl for bl in loop2.columns]
     inLeft = set(lSet).difference(rSet)
@@ -716,18 +853,37 @@ def compareLoops(loop1, loop2, options, cItem=None, nefList=None):
             nefLoopItem.warningList.append('<rowLength>:  {} {} {}'.format(len(loop1.data),
                                                                            symbol, len(loop2.data)))
 
-        # carry on and compare the common table
+        keyColumns = getLoopKeyColumns(loop1, loop2, options)
+        if keyColumns:
+            # match rows on the key columns, list the unmatched rows and compare the matched rows
+            rowPairs, inLeftRows, inRightRows = alignLoopRows(loop1, loop2, keyColumns, options)
+            _createRowList(cItem, loop1, inLeftRows, keyColumns, nefList, options, inWhich=whichTypes.LEFT)
+            _createRowList(cItem, loop2, inRightRows, keyColumns, nefList, options, inWhich=whichTypes.RIGHT)
+            rowIndices = [rowIndex for rowIndex, _rowIndex2 in rowPairs]
+        else:
+            # carry on and compare the common table
+            rowPairs = None
+            rowIndices = range(rowRange)
+
         for compName in dSet:
-            for rowIndex in range(rowRange):
+            values1 = loop1.getColumnValues(compName)
+            values2 = loop2.getColumnValues(compName)
+            if rowPairs is not None:
+                values1 = [values1[rowIndex] for rowIndex, _rowIndex2 in rowPairs]
+                values2 = [values2[rowIndex2] for _rowIndex, rowIndex2 in rowPairs]
+            else:
+                values1 += [None] * (rowRange - len(values1))
+                values2 += [None] * (rowRange - len(values2))
 
-                loopValue1 = loop1.data[rowIndex][compName] if rowIndex < len(loop1.data) else None
-                loopValue2 = loop2.data[rowIndex][compName] if rowIndex < len(loop2.data) else None
+            for ii in _compareColumnValues(values1, values2, options):
+                rowIndex = rowIndices[ii]
+                loopValue1 = values1[ii]
+                loopValue2 = values2[ii]
 
-                if _compareObjects(loopValue1, loopValue2, options) == options.identical:
-                    if not nefLoopItem:
-                        nefLoopItem = _createLoopItem(cItem, compName, loop1, loopValue1, loopValue2, nefList, rowIndex, options, inWhich=whichTypes.BOTH)
-                    else:
-                        _addLoopItem(nefLoopItem, compName, loop1, loopValue1, loopValue2, nefList, rowIndex, options, inWhich=whichTypes.BOTH)
+                if not nefLoopItem:
+                    nefLoopItem = _createLoopItem(cItem, compName, loop1, loopValue1, loopValue2, nefList, rowIndex, options, inWhich=whichTypes.BOTH)
+                else:
+                    _addLoopItem(nefLoopItem, compName, loop1, loopValue1, loopValue2, nefList, rowIndex, options, inWhich=whichTypes.BOTH)
 
         #TODO
         # need to add a further test here, could do a diff on the tables which would pick up
@@ -749,6 +905,22 @@ def compareLoops(loop1, loop2, options, cItem=None, nefList=None):
     return nefList
 
 
+#=========================================================================================
+# _createRowList
+#=========================================================================================
+
+def _createRowList(cItem, loop, rowList, keyColumns, nefList, options, inWhich):
+    """Create a new item in the nefList listing the rows that are only present in one loop
+    """
+    if rowList:
+        newItem = _createNewItem(cItem, loop, nefList, options, inWhich)
+        data = loop.data
+        newItem.warningList = ['<Row>: {} <Key>: {}'.format(rowIndex,
+                                                           ', '.join(str(data[rowIndex][col]) for col in keyColumns))
+                               for rowIndex in rowList]
+        return newItem
+
+
 #=========================================================================================
 # _createNewItem
 #=========================================================================================
@@ -852,6 +1024,10 @@ def compareSaveFrames(saveFrame1, saveFrame2, options, cItem=None, nefList=None)
     if nefList is None:
         nefList = []
 
+    if _identicalContents(saveFrame1, saveFrame2, options):
+        # nothing to list
+        return nefList
+
     lSet = [' ' if not isinstance(saveFrame1[bl], GenericStarParser.Loop) else saveFrame1[bl].name for bl in saveFrame1]
     rSet = [' ' if not isinstance(saveFrame2[bl], GenericStarParser.Loop) else saveFrame2[bl].name for bl in saveFrame2]
     inLeft = set(lSet).difference(rSet).difference({' '})
@@ -932,6 +1108,10 @@ def compareDataBlocks(dataBlock1, dataBlock2, options, cItem=None, nefList=None)
     if nefList is None:
         nefList = []
 
+    if _identicalContents(dataBlock1, dataBlock2, options):
+        # nothing to list
+        return nefList
+
     lSet = [dataBlock1[bl].name for bl in dataBlock1]
     rSet = [dataBlock2[bl].name for bl in dataBlock2]
     inLeft = set(lSet).difference(rSet)
@@ -976,6 +1156,10 @@ def compareDataExtents(dataExt1, dataExt2, options, cItem=None, nefList=None):
     if nefList is None:
         nefList = []
 
+    if _identicalContents(dataExt1, dataExt2, options):
+        # nothing to list
+        return nefList
+
     lSet = [dataExt1[bl].name for bl in dataExt1]
     rSet = [dataExt2[bl].name for bl in dataExt2]
     inLeft = set(lSet).difference(rSet)
@@ -1051,6 +1235,31 @@ def compareNefFiles(inFile1, inFile2, options, cItem=None, nefList=None):
     return nefList
 
 
+#=========================================================================================
+# quickCompareNefFiles
+#=========================================================================================
+
+def quickCompareNefFiles(inFile1, inFile2, options):
+    """Check whether two Nef files have identical contents, using only the content hashes
+    Values must be exactly equal; options.ignoreCase/almostEqual are not used
+
+    :param inFile1: name of the first file
+    :param inFile2: name of the second file
+    :param options: nameSpace holding the commandLineArguments
+    :return: True if the contents are identical
+    """
+    NefData1 = StarIo.parseNefFile(inFile1)
+    NefData2 = StarIo.parseNefFile(inFile2)
+
+    if options.ignoreBlockName is False:
+        return NefData1.contentHash() == NefData2.contentHash()
+    else:
+        # assumes that there is only one block in a file
+        dataBlocks1 = list(NefData1.values())
+        dataBlocks2 = list(NefData2.values())
+        return dataBlocks1[0].contentHash() == dataBlocks2[0].contentHash()
+
+
 #=========================================================================================
 # batchCompareNefFiles
 #=========================================================================================
@@ -1097,6 +1306,13 @@ def batchCompareNefFiles(inDir1, inDir2, outDir, options):
                     outLog.write('No common files found')
         return
 
+    jobs = getattr(options, 'jobs', None)
+    if jobs is not None and jobs > 1:
+        parallelCompareNefFiles(inDir1, inDir2, outDir, [fl for fl in inFileList if fl in outFileList], options,
+                                compareNefFiles, partial(printCompareList, options=options),
+                                replaceExisting=options.replaceExisting, output=printOutput)
+        return
+
     for fl in inFileList:
         if fl in outFileList:
 
@@ -1201,7 +1417,16 @@ def processArguments(options):
 
             if options.inFiles is not None:
 
-                if len(options.inFiles) == 2:
+                if len(options.inFiles) == 2 and getattr(options, 'quick', False):
+
+                    # compare the content hashes of the two files, and set the exit code only
+                    try:
+                        identical = quickCompareNefFiles(options.inFiles[0], options.inFiles[1], options)
+                    except Exception:
+                        sys.exit(2)
+                    sys.exit(0 if identical else 1)
+
+                elif len(options.inFiles) == 2:
 
                     # compare the two files
                     inFile0 = options.inFiles[0]
@@ -1256,6 +1481,17 @@ def processArguments(options):
             printOutput('Incorrect arguments, use nef -h')
 
 
+def processArgumentsProfiled(options):
+    """Process the command line arguments, and print the profile of the phases to stderr,
+    also if processing exits
+    """
+    with Profiling.profile(traceMemory=getattr(options, 'profileMemory', False)) as parseProfile:
+        try:
+            processArguments(options)
+        finally:
+            printOutput(parseProfile.report(), file=sys.stderr)
+
+
 #=========================================================================================
 # Test_Compare_Files
 #=========================================================================================
@@ -1493,6 +1729,10 @@ Command Line Usage:
         -s, --screen            Output batch processing to screen, default is to .txt files
                                 may be used with -d
 
+        -j N, --jobs N          Compare the files of a batch in N parallel processes,
+                                the output is written in the same order as for a
+                                single process
+
         -r, --replace           Replace existing .txt files. If false then files are
                                 appended with '(n)' before the extension, where n is
                                 the next available number
@@ -1504,12 +1744,32 @@ Command Line Usage:
         --same                  output similarities between Nef files
                                 default is differences
 
+        -q, --quick             No output, only compare the content hashes of the two
+                                files given with -f; the exit code is 0 if the contents
+                                are identical, 1 if different and 2 on error
+
         -a, --almostequal       Consider float/complex numbers to be equal if within the
                                 relative tolerance
                                 
         -p, --places            Specify the number of decimal places for the relative
                                 tolerance
 
+        -k, --keyalign          Align the rows of loops on the key columns defined in the
+                                Nef specification, rows are listed as present in only one
+                                file or compared with the matching row in the other file
+
+        --keys loop:column,column
+                                Align the rows of loop on the given key columns,
+                                takes precedence over --keyalign
+
+    --profile               Print the time spent in each phase - tokenise, build,
+                            preValidate, convert, validate, write - with the counts of
+                            tokens, loop rows and values, and saveframes, to stderr
+
+        --profilememory         Also trace the peak memory of each phase; this makes
+                                the processing considerably slower. Peaks within
+                                a phase need Python 3.9 or later
+
     --verify                Verify Nef files
 
                             Can be used with switches: -f, -d
@@ -1532,4 +1792,7 @@ if __name__ == '__main__':
     parser = defineArguments()
     commandLineArguments = parser.parse_args()
 
-    processArguments(commandLineArguments)
+    if commandLineArguments.profile:
+        processArgumentsProfiled(commandLineArguments)
+    else:
+        processArguments(commandLineArguments)
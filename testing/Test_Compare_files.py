@@ -63,6 +63,110 @@ if __name__ == '__main__' and __package__ is None:
 
 from .Paths import TEST_FILE_PATH
 from ..CompareNef import compareNefFiles, printCompareList, defineArguments
+from .. import nef, StarIo, LoopAlignment
+
+
+_keyedLoopText = """data_keyed
+save_nef_chemical_shift_list_1
+   _nef_chemical_shift_list.sf_category   nef_chemical_shift_list
+   _nef_chemical_shift_list.sf_framecode  nef_chemical_shift_list_1
+   loop_
+      _nef_chemical_shift.chain_code
+      _nef_chemical_shift.sequence_code
+      _nef_chemical_shift.residue_name
+      _nef_chemical_shift.atom_name
+      _nef_chemical_shift.value
+%s
+   stop_
+save_
+"""
+
+
+def test_key_aligned_compare():
+    rows = ['      A %s ALA HA %s' % (ii, 4.0 + ii / 100.0) for ii in range(1, 101)]
+    loop1 = StarIo.parseNef(_keyedLoopText % '\n'.join(rows))['keyed']['nef_chemical_shift_list_1']['nef_chemical_shift']
+    # insert a row near the start, remove the last and change one value
+    rows.insert(2, '      A 250 GLY HA2 3.9')
+    rows.pop()
+    rows[50] = '      A 50 ALA HA 4.55'
+    loop2 = StarIo.parseNef(_keyedLoopText % '\n'.join(rows))['keyed']['nef_chemical_shift_list_1']['nef_chemical_shift']
+
+    # positional compare reports every row after the insertion
+    options = nef.defineArguments().parse_args('-f file1 file2'.split())
+    nefList = nef.compareLoops(loop1, loop2, options)
+    assert sum(len(item.compareList) for item in nefList) > 150
+
+    options = nef.defineArguments().parse_args('-f file1 file2 -k'.split())
+    nefList = nef.compareLoops(loop1, loop2, options)
+    left = [item for item in nefList if item.inWhich == nef.whichTypes.LEFT]
+    right = [item for item in nefList if item.inWhich == nef.whichTypes.RIGHT]
+    both = [cmp for item in nefList if item.inWhich == nef.whichTypes.BOTH for cmp in item.compareList]
+    assert [item.warningList for item in left] == [['<Row>: 99 <Key>: A, 100, ALA, HA']]
+    assert [item.warningList for item in right] == [['<Row>: 2 <Key>: A, 250, GLY, HA2']]
+    assert [(cmp.attribute, cmp.row, cmp.thisValue, cmp.compareValue) for cmp in both] == [('value', 49, 4.5, 4.55)]
+
+    # user keys take precedence over the specification keys
+    options = nef.defineArguments().parse_args('-f file1 file2 -k --keys nef_chemical_shift:sequence_code'.split())
+    assert options.loopKeys == [('nef_chemical_shift', ('sequence_code',))]
+    assert LoopAlignment.getLoopKeyColumns(loop1, loop2, options) == ('sequence_code',)
+    rowPairs, inLeftRows, inRightRows = LoopAlignment.alignLoopRows(loop1, loop2, ('sequence_code',), options)
+    assert len(rowPairs) == 99 and inLeftRows == [99] and inRightRows == [2]
+
+
+
+def test_column_compare():
+    values1 = [1.0, 2.0, None, 4, 5.0, None, float('inf'), 1e-12, 100.0]
+    values2 = [1.0 + 1e-12, 2.1, None, 4.0, None, 6.0, float('inf'), 0.0, 100]
+    # int columns, including ints that do not convert exactly to float
+    ints1 = [1, 2 ** 53 + 1, None, 2 ** 62, -5, 2 ** 70]
+    ints2 = [1, 2 ** 53, None, 2 ** 62 + 1, -5, 2 ** 70 + 1]
+    for columns in ((values1, values2), (ints1, ints2), (ints1, [float(val) if val else val for val in ints2])):
+        for extra, places, almostEqual in (([], 10, True), (['--same'], 10, True), ([], 1, True), ([], 10, False)):
+            options = nef.defineArguments().parse_args(['-f', 'file1', 'file2'] + extra)
+            options.places = places
+            options.almostEqual = almostEqual
+            # cell-by-cell result from _compareObjects
+            expected = [ii for ii, (val1, val2) in enumerate(zip(*columns))
+                        if nef._compareObjects(val1, val2, options) == options.identical]
+            assert nef._compareColumnValues(*columns, options) == expected
+            assert nef._compareColumnValues(*(column[:5] for column in columns), options) == \
+                   [ii for ii in expected if ii < 5]
+
+    options = nef.defineArguments().parse_args(['-f', 'file1', 'file2'])
+    assert nef._compareColumnValues(values1, values2, options) == [1, 4, 5, 7]
+    assert nef._compareColumnValues(['a', "{'b': 1.0}", 'c'], ['a', "{'b': 1}", 'C'], options) == [2]
+
+
+def test_parallel_batch_compare(tmp_path):
+    inDir1, inDir2 = tmp_path / 'in1', tmp_path / 'in2'
+    inDir1.mkdir()
+    inDir2.mkdir()
+    for ii in range(3):
+        (inDir1 / ('file%s.nef' % ii)).write_text(open(os.path.join(TEST_FILE_PATH, 'Commented_Example.nef')).read())
+        (inDir2 / ('file%s.nef' % ii)).write_text(open(os.path.join(TEST_FILE_PATH, 'Commented_Example_Change.nef')).read())
+
+    outputs = []
+    for jobs in (None, 2):
+        outDir = tmp_path / ('out%s' % jobs)
+        options = nef.defineArguments().parse_args(['-d', str(inDir1), str(inDir2), '-c'])
+        options.jobs = jobs
+        nef.batchCompareNefFiles(str(inDir1), str(inDir2), str(outDir), options)
+        outputs.append(dict((path.name, path.read_text().replace(str(outDir), '')) for path in outDir.iterdir()))
+
+    assert sorted(outputs[0]) == ['file0.txt', 'file1.txt', 'file2.txt']
+    assert outputs[0] == outputs[1]
+
+
+def test_jobs_argument():
+    import pytest
+
+    # nef and CompareNef check -j/--jobs the same way
+    for parser in (nef.defineArguments(), defineArguments()):
+        assert parser.parse_args(['-j', '2', '-f', 'in1.nef', 'in2.nef']).jobs == 2
+
+        for jobs in ('-1', 'two'):
+            with pytest.raises(SystemExit):
+                parser.parse_args(['-j', jobs, '-f', 'in1.nef', 'in2.nef'])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,340 @@
+"""Module Documentation here
+
+"""
+#=========================================================================================
+# Licence, Reference and Credits
+#=========================================================================================
+__copyright__ = "Copyright (C) CCPN project (https://www.ccpn.ac.uk) 2014 - 2022"
+__credits__ = ("Ed Brooksbank, Joanna Fox, Victoria A Higman, Luca Mureddu, Eliza Płoskoń",
+               "Timothy J Ragan, Brian O Smith, Gary S Thompson & Geerten W Vuister")
+__licence__ = ("CCPN licence. See https://ccpn.ac.uk/software/licensing/")
+__reference__ = ("Skinner, S.P., Fogh, R.H., Boucher, W., Ragan, T.J., Mureddu, L.G., & Vuister, G.W.",
+                 "CcpNmr AnalysisAssign: a flexible platform for integrated NMR analysis",
+                 "J.Biomol.Nmr (2016), 66, 111-124, http://doi.org/10.1007/s10858-016-0060-y")
+#=========================================================================================
+# Last code modification
+#=========================================================================================
+__modifiedBy__ = "$modifiedBy: CCPN $"
+__dateModified__ = "$dateModified: 2022-03-01 12:00:00 +0000 (Tue, March 01, 2022) $"
+__version__ = "$Revision: 3.1.0 $"
+#=========================================================================================
+# Created
+#=========================================================================================
+__author__ = "$Author: CCPN $"
+__date__ = "$Date: 2022-03-01 12:00:00 +0000 (Tue, March 01, 2022) $"
+#=========================================================================================
+# Start of code
+#=========================================================================================
+
+import os
+import time
+import sys
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# this is a fix to get the import to work when running as a standalone
+# when importing into your own code, with PYTHON_PATH defined it can be safely removed
+
+def import_parents(level=1):
+    global __package__
+
+    import sys
+    from os import path
+    import importlib
+
+    # pathlib does all this a lot nicer, but don't think it's in python2.7
+    top = parent = path.dirname(path.abspath(__file__))
+    package = []
+    for t in range(level):
+        package.insert(0, os.path.basename(top))
+        top = path.dirname(top)
+
+    sys.path.append(str(top))
+    try:
+        sys.path.remove(str(parent))
+    except ValueError:  # already removed
+        pass
+
+    __package__ = str('.'.join(package))
+    importlib.import_module(__package__)
+
+
+if __name__ == '__main__' and __package__ is None:
+    import_parents(level=2)         # 2 because need to import with 2 dots below
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+
+import glob
+
+from .. import Specification, NefImporter, StarIo, Validator, GenericStarParser
+from .Paths import TEST_FILE_PATH
+
+
+def _timeConstruction(count=20):
+    t0 = time.time()
+    for ii in range(count):
+        NefImporter.NefImporter(errorLogging=NefImporter.el.NEF_SILENT)
+    return (time.time() - t0) / count
+
+
+def test_specification_registry():
+    Specification.clearSpecificationCache()
+    spec1 = Specification.getNefSpecification(NefImporter.NEF_DEFAULT_DICT, useDiskCache=False)
+    spec2 = Specification.getNefSpecification(NefImporter.NEF_DEFAULT_DICT, useDiskCache=False)
+    assert spec1 is spec2
+
+    importer = NefImporter.NefImporter(errorLogging=NefImporter.el.NEF_SILENT)
+    assert importer._validateNefDict is spec1
+
+
+def test_specification_disk_cache(tmp_path):
+    Specification.clearSpecificationCache()
+    oldDir = Specification.SPECIFICATION_CACHE_DIR
+    Specification.SPECIFICATION_CACHE_DIR = str(tmp_path)
+    try:
+        spec1 = Specification.getNefSpecification(NefImporter.NEF_DEFAULT_DICT)
+        assert len(os.listdir(str(tmp_path))) == 1
+
+        # a new process only sees the precompiled file
+        Specification.clearSpecificationCache()
+        spec2 = Specification.getNefSpecification(NefImporter.NEF_DEFAULT_DICT)
+        assert spec2 is not spec1
+        assert spec2.toString() == spec1.toString()
+
+        # concurrent writers of the same file do not interfere
+        import threading
+
+        cachePath = os.path.join(str(tmp_path), os.listdir(str(tmp_path))[0])
+        threads = [threading.Thread(target=lambda: [Specification._writeSpecificationCache(cachePath, spec1)
+                                                    for ii in range(10)]) for jj in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert os.listdir(str(tmp_path)) == [os.path.basename(cachePath)]
+        assert Specification._readSpecificationCache(cachePath).toString() == spec1.toString()
+    finally:
+        Specification.SPECIFICATION_CACHE_DIR = oldDir
+        Specification.clearSpecificationCache()
+
+
+def test_typed_conversion():
+    specification = Specification.getNefSpecification(NefImporter.NEF_DEFAULT_DICT, useDiskCache=False)
+    valueTypes = StarIo.getSpecificationValueTypes(specification)
+    assert valueTypes[('nef_chemical_shift', 'value')] is float
+    assert valueTypes[('nef_sequence', 'index')] is int
+    assert valueTypes[('nef_chemical_shift', 'sequence_code')] is str
+
+    usePath = os.path.join(TEST_FILE_PATH, 'CCPN_Commented_Example.nef')
+    entry = StarIo.parseNefFile(usePath)
+    typedEntry = StarIo.parseNefFile(usePath, specification=specification)
+
+    dataBlock = list(entry.values())[0]
+    typedDataBlock = list(typedEntry.values())[0]
+    for name, saveFrame in typedDataBlock.items():
+        for tag, value in saveFrame.items():
+            oldValue = dataBlock[name][tag]
+            if isinstance(value, StarIo.NmrLoop):
+                for row, oldRow in zip(value.data, oldValue.data):
+                    for column, val in row.items():
+                        valueType = valueTypes.get((value.category, column))
+                        if valueType is not None and val is not None and not isinstance(val, bool):
+                            assert isinstance(val, valueType), (value.category, column, val)
+                        assert val == oldRow[column] or valueType is str, (value.category, column, val)
+            else:
+                assert value == oldValue or valueTypes.get((saveFrame.category, tag)) is str
+
+
+def test_construction_benchmark():
+    # cost of parsing the .dic file for every NefImporter, as before the registry
+    t0 = time.time()
+    with open(NefImporter.NEF_DEFAULT_DICT) as fp:
+        Specification.CifDicConverter(fp.read(), logger=lambda *args: None).convertToNef()
+    uncached = time.time() - t0
+
+    Specification.clearSpecificationCache()
+    Specification.getNefSpecification(NefImporter.NEF_DEFAULT_DICT)
+    cached = _timeConstruction()
+    print("NefImporter construction: parse dictionary %.5fs, registry lookup %.5fs" % (uncached, cached))
+
+
+def test_validation_plans():
+    specification = Specification.getNefSpecification(NefImporter.NEF_DEFAULT_DICT)
+    plans = Validator.getValidationPlans(specification)
+    assert Validator.getValidationPlans(specification) is plans
+
+    plan = plans['nef_chemical_shift_list']
+    assert 'nef_chemical_shift' in plan.loopNames
+    assert 'sf_category' in plan.mandatoryFields
+    assert 'value' in plan.loopPlans['nef_chemical_shift'].allowedFields
+    assert not any(category.startswith(Validator.CCPN_PREFIX) for category in plans)
+
+
+def test_loop_consistency():
+    validator = Validator.Validator()
+    loop = GenericStarParser.Loop('test', ['a', 'b', 'c'])
+    for ii in range(4):
+        loop.newRow([ii, ii, ii])
+    assert validator._loop_inconsistent_rows(loop, label='test') == []
+
+    del loop.data[1]['b']
+    loop.data[2]['d'] = 2
+    assert validator._loop_inconsistent_rows(loop, label='test') == [
+        'test item 0: missing d label.',
+        'test item 1: missing b label.',
+        'test item 1: missing d label.',
+        'test item 3: missing d label.',
+    ]
+
+    columnarLoop = GenericStarParser.ColumnarLoop('test', ['a', 'b', 'c'])
+    columnarLoop.newRow([1, 2, 3])
+    assert validator._loop_inconsistent_rows(columnarLoop, label='test') == []
+
+
+def test_column_types():
+    specification = Specification.getNefSpecification(NefImporter.NEF_DEFAULT_DICT)
+    columnTypes = Validator.getValidationPlans(specification)['nef_chemical_shift_list'].loopPlans['nef_chemical_shift'].columnTypes
+    assert columnTypes['value'].typeCode == 'float'
+
+    validator = Validator.Validator()
+    for loopClass in (GenericStarParser.Loop, GenericStarParser.ColumnarLoop):
+        loop = loopClass('nef_chemical_shift', ['chain_code', 'sequence_code', 'residue_name', 'atom_name', 'value'])
+        for ii in range(1000):
+            loop.newRow(['A', str(ii), 'ALA', 'HA', 4.1 if ii % 3 else None])
+        assert validator._loop_type_errors(loop, columnTypes, label='test') == []
+
+        for ii in range(0, 700, 100):
+            loop.data[ii]['value'] = 'high'
+        loop.data[5]['atom_name'] = 'H A'
+        loop.data[6]['atom_name'] = True
+        assert validator._loop_type_errors(loop, columnTypes, label='test') == [
+            "test: column atom_name has 1 value(s) not of type 'word': item 5 'H A'.",
+            "test: column value has 7 value(s) not of type 'float': "
+            "item 0 'high', item 100 'high', item 200 'high', item 300 'high', item 400 'high' and 2 more."
+        ]
+
+
+def test_integrity_errors():
+    specification = Specification.getNefSpecification(NefImporter.NEF_DEFAULT_DICT)
+    validator = Validator.Validator()
+
+    dataBlock = list(StarIo.parseNefFile(os.path.join(TEST_FILE_PATH, 'Commented_Example.nef')).values())[0]
+    errors = validator.integrityErrors(dataBlock, specification)
+    assert [(error.errorType, error.loop, error.row, error.values) for error in errors] == [
+        (Validator.MISSING_RESIDUE, 'nef_distance_restraint', 6, ('E', '6B'))
+    ]
+
+    dataBlock = list(StarIo.parseNefFile(os.path.join(TEST_FILE_PATH, 'Commented_Example_Change.nef')).values())[0]
+    errors = validator.integrityErrors(dataBlock, specification)
+    assert set(error.errorType for error in errors) >= {Validator.DUPLICATE_KEY, Validator.MISSING_ROW}
+    duplicate = [error for error in errors if error.errorType == Validator.DUPLICATE_KEY][0]
+    assert duplicate.loop == 'nef_peak_restraint_link' and duplicate.row == 1
+    assert duplicate.values == ('nef_nmr_spectrum_cnoesy1', 1, 'nef_distance_restraint_list_L1', 9)
+
+    # break the references from the spectrum and to nef_sequence
+    dataBlock = list(StarIo.parseNefFile(os.path.join(TEST_FILE_PATH, 'Commented_Example.nef')).values())[0]
+    spectrum = dataBlock['nef_nmr_spectrum_cnoesy1']
+    spectrum['chemical_shift_list'] = 'nef_chemical_shift_list_missing'
+    dataBlock['nef_chemical_shift_list_1']['nef_chemical_shift'].data[2]['sequence_code'] = '999'
+    errors = validator.integrityErrors(dataBlock, specification)
+    errors = [(error.errorType, error.saveFrame, error.row) for error in errors]
+    assert (Validator.MISSING_RESIDUE, 'nef_chemical_shift_list_1', 2) in errors
+    assert (Validator.MISSING_SAVEFRAME, 'nef_nmr_spectrum_cnoesy1', None) in errors
+
+    # offset and uncertain sequence codes, e.g. '28-1' and '108?', are not nef_sequence references
+    for fileName in ('CCPN_Sec5Part3.nef', 'CCPN_1nk2_docr.nef'):
+        dataBlock = list(StarIo.parseNefFile(os.path.join(TEST_FILE_PATH, fileName)).values())[0]
+        assert validator.integrityErrors(dataBlock, specification) == []
+    assert not Validator._isUnassigned('A', '-5') and not Validator._isUnassigned('A', 12)
+    assert all(Validator._isUnassigned(*residue) for residue in (('A', '28-1'), ('A', '28+1'), ('A', '108?'),
+                                                                    ('C?', '152'), ('@1', '5'), ('A', '@5')))
+
+
+def test_incremental_validation():
+    specification = Specification.getNefSpecification(NefImporter.NEF_DEFAULT_DICT)
+    dataBlock = list(StarIo.parseNefFile(os.path.join(TEST_FILE_PATH, 'CCPN_Sec5Part3.nef')).values())[0]
+
+    validator = Validator.Validator()
+    validated = []
+    validateSaveFrame = validator._validate_saveframe
+
+    def _validate_saveframe(sf_name, saveframe, plans):
+        validated.append(sf_name)
+        return validateSaveFrame(sf_name, saveframe, plans)
+
+    validator._validate_saveframe = _validate_saveframe
+    assert validator.isValid(dataBlock, specification)
+    assert len(validated) == len(dataBlock)
+
+    del validated[:]
+    assert validator.isValid(dataBlock, specification)
+    assert validated == []
+
+    # loop and item changes are detected
+    shiftList = dataBlock['nef_chemical_shift_list_default']
+    shiftList['nef_chemical_shift'].data[0]['value'] = 'high'
+    assert not validator.isValid(dataBlock, specification)
+    assert validated == ['nef_chemical_shift_list_default']
+
+    del validated[:]
+    shiftList['nef_chemical_shift'].data[0]['value'] = 1.0
+    del dataBlock['nef_molecular_system']['nef_sequence']
+    assert not validator.isValid(dataBlock, specification)
+    assert validated == ['nef_molecular_system', 'nef_chemical_shift_list_default']
+
+    # results match a full validation
+    fullValidator = Validator.Validator()
+    fullValidator.isValid(dataBlock, specification)
+    assert validator.validationErrors == fullValidator.validationErrors
+
+    # in-place row changes through the importer
+    importer = NefImporter.NefImporter(errorLogging=NefImporter.el.NEF_SILENT)
+    importer.loadFile(os.path.join(TEST_FILE_PATH, 'CCPN_2kko_docr.nef'))
+    assert importer.validate()
+    shifts = [saveFrame for saveFrame in importer.data.values()
+              if saveFrame['sf_category'] == 'nef_chemical_shift_list'][0]['nef_chemical_shift']
+    shifts.data[0]['value'] = 'not-a-number'
+    del shifts.data[1]['atom_name']
+    assert not importer.validate()
+    errors = str(importer.validErrorLog)
+    assert 'not-a-number' in errors and 'atom_name' in errors
+
+
+def test_parallel_validation():
+    specification = Specification.getNefSpecification(NefImporter.NEF_DEFAULT_DICT)
+    dataBlock = list(StarIo.parseNefFile(os.path.join(TEST_FILE_PATH, 'CCPN_2mqq_docr.nef')).values())[0]
+    restraintLists = [saveFrame for saveFrame in dataBlock.values()
+                      if saveFrame['sf_category'] == 'nef_distance_restraint_list']
+    restraintLists[0]['nef_distance_restraint'].data[3]['upper_limit'] = 'far'
+    del restraintLists[1]['nef_distance_restraint'].data[0]['weight']
+
+    serialValidator = Validator.Validator()
+    serialValidator.isValid(dataBlock, specification)
+    assert serialValidator.validationErrors['nef_distance_restraint_list']
+
+    oldMinRows = Validator.PARALLEL_MIN_ROWS
+    try:
+        Validator.PARALLEL_MIN_ROWS = 10
+        parallelValidator = Validator.Validator(jobs=2)
+        parallelValidator.isValid(dataBlock, specification)
+    finally:
+        Validator.PARALLEL_MIN_ROWS = oldMinRows
+    assert parallelValidator.validationErrors == serialValidator.validationErrors
+
+
+def test_validation_benchmark():
+    specification = Specification.getNefSpecification(NefImporter.NEF_DEFAULT_DICT)
+    validator = Validator.Validator()
+    total = 0.0
+    for usePath in sorted(glob.glob(os.path.join(TEST_FILE_PATH, '*.nef'))):
+        dataBlock = list(StarIo.parseNefFile(usePath).values())[0]
+        t0 = time.time()
+        validator.isValid(dataBlock, specification)
+        validationTime = time.time() - t0
+        total += validationTime
+        print('%-40s validation %.5fs' % (os.path.basename(usePath), validationTime))
+    print('Total validation time %.5fs' % total)
+
+
+if __name__ == '__main__':
+    test_construction_benchmark()
+    test_validation_benchmark()
@@ -27,6 +27,7 @@ __date__ = "$Date: 2017-04-07 10:28:41 +0000 (Fri, April 07, 2017) $"
 
 import os
 import time
+import pickle
 import sys
 
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
@@ -62,7 +63,7 @@ if __name__ == '__main__' and __package__ is None:
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
 
-from .. import GenericStarParser, StarIo
+from .. import GenericStarParser, StarIo, StarTokeniser, ParseCache, NefImporter
 from .Paths import TEST_FILE_PATH
 
 
@@ -113,6 +114,565 @@ def test_nef_commented_example():
     _loadNefFile('CCPN_Commented_Example.nef')
 
 
+def test_event_stream():
+    usePath = os.path.join(TEST_FILE_PATH, 'CCPN_Commented_Example.nef')
+    with open(usePath) as fp:
+        text = fp.read()
+
+    class _RowCounter(GenericStarParser.StarEventHandler):
+        def __init__(self):
+            self.saveFrames = []
+            self.rows = {}
+
+        def startSaveFrame(self, name):
+            self.saveFrames.append(name)
+
+        def loopHeader(self, columns):
+            self.loopKey = (self.saveFrames[-1], columns[0])
+            self.rows[self.loopKey] = 0
+
+        def loopRow(self, values):
+            self.rows[self.loopKey] += 1
+
+    # push and pull interfaces must match the tree
+    dataExtent = GenericStarParser.parse(text)
+    handler = GenericStarParser.parseEvents(text, _RowCounter())
+    dataBlock = list(dataExtent.values())[0]
+    assert handler.saveFrames == list(dataBlock.keys())
+    for saveFrame in dataBlock.values():
+        for tag, loop in saveFrame.items():
+            if isinstance(loop, GenericStarParser.Loop) and tag == loop.name:
+                assert handler.rows[(saveFrame.name, loop.name)] == len(loop.data)
+
+    events = list(GenericStarParser.iterEvents(text))
+    assert events[0] == (GenericStarParser.EVENT_START_DATABLOCK, dataBlock.name)
+    assert events[-1] == (GenericStarParser.EVENT_END_DATABLOCK, dataBlock.name)
+
+
+def test_single_pass_nef():
+    usePath = os.path.join(TEST_FILE_PATH, 'CCPN_Commented_Example.nef')
+    with open(usePath) as fp:
+        text = fp.read()
+
+    converter = StarIo._StarDataConverter(GenericStarParser.parse(text), fileType='nef')
+    converter.preValidate()
+    twoPass = converter.convert()
+    singlePass = StarIo.parseNef(text)
+    assert singlePass.toString() == twoPass.toString()
+
+    # Validation errors are the same as for the two-pass conversion
+    text = 'data_x\nsave_nef_b\n_nef_a.sf_category nef_a\n_nef_a.sf_framecode nef_a\nsave_\n'
+    try:
+        StarIo.parseNef(text)
+        assert False, 'StarValidationError not raised'
+    except StarIo.StarValidationError as ex:
+        assert 'does not match sf_framecode' in str(ex)
+
+
+def test_mmap_parse():
+    usePath = os.path.join(TEST_FILE_PATH, 'CCPN_Commented_Example.nef')
+    entry = StarIo.parseNefFile(usePath, useMmap=True)
+    assert entry.toString() == StarIo.parseNefFile(usePath).toString()
+    assert (GenericStarParser.parseFile(usePath, useMmap=True).toString()
+            == GenericStarParser.parseFile(usePath).toString())
+
+    with open(usePath) as fp:
+        text = fp.read()
+    tokens = list(StarTokeniser.getBytesTokenIterator(text.replace('\n', '\r\n').encode('utf-8')))
+    assert [tk[:2] for tk in tokens] == [tk[:2] for tk in StarTokeniser.getTokenIterator(text)]
+
+
+def test_numpy_export():
+    import numpy as np
+
+    usePath = os.path.join(TEST_FILE_PATH, 'CCPN_Commented_Example.nef')
+    entry = StarIo.parseNefFile(usePath)
+    dataBlock = list(entry.values())[0]
+    spectrum = [x for x in dataBlock.values() if x.category == 'nef_nmr_spectrum'][0]
+    peakLoop = spectrum['nef_peak']
+
+    positions = spectrum.getPeakPositions()
+    assert positions.shape == (len(peakLoop.data), spectrum['num_dimensions'])
+    assert positions[0, 1] == peakLoop.data[0]['position_2']
+    assert np.array_equal(positions, peakLoop.toNumpy('position'))
+
+    heights = peakLoop.toNumpy('height')
+    assert heights.shape == (len(peakLoop.data),)
+
+    array = peakLoop.toStructuredArray()
+    assert array['peak_id'].dtype == np.dtype('int64')
+    assert list(array['peak_id']) == peakLoop.getColumnValues('peak_id')
+
+    # nulls: NaN for floats, error or mask otherwise
+    peakLoop.data[0]['height'] = None
+    assert np.isnan(peakLoop.toNumpy('height')[0])
+    try:
+        peakLoop.toNumpy('height', dtype=int)
+        assert False, 'ValueError not raised'
+    except ValueError:
+        pass
+    masked = peakLoop.toNumpy('height', dtype=int, masked=True)
+    assert masked.mask[0] and not masked.mask[1]
+
+
+def test_lazy_nef():
+    usePath = os.path.join(TEST_FILE_PATH, 'CCPN_Commented_Example.nef')
+    entry = StarIo.parseNefFile(usePath)
+    lazyEntry = StarIo.parseNefFile(usePath, lazy=True)
+
+    dataBlock = list(entry.values())[0]
+    lazyDataBlock = list(lazyEntry.values())[0]
+    assert isinstance(lazyDataBlock, StarIo.LazyNmrDataBlock)
+    assert lazyDataBlock.name == dataBlock.name
+    assert lazyDataBlock.saveFrameNames() == dataBlock.saveFrameNames()
+    assert 'nef_molecular_system' in lazyDataBlock
+    assert not any(lazyDataBlock.isLoaded(x) for x in lazyDataBlock)
+
+    saveFrame = lazyDataBlock['nef_molecular_system']
+    assert saveFrame.toString() == dataBlock['nef_molecular_system'].toString()
+    assert lazyDataBlock.isLoaded('nef_molecular_system')
+    assert not lazyDataBlock.isLoaded('nef_nmr_meta_data')
+
+    assert lazyEntry.toString() == entry.toString()
+
+    # Mixed-case saveframe names give the same keys as for normal loading
+    with open(usePath) as fp:
+        text = fp.read().replace('save_nef_nmr_meta_data', 'save_NEF_Nmr_Meta_Data', 1)
+    lazyDataBlock = list(StarIo.parseNef(text, lazy=True).values())[0]
+    assert isinstance(lazyDataBlock, StarIo.LazyNmrDataBlock)
+    assert lazyDataBlock.saveFrameNames() == list(StarIo.parseNef(text).values())[0].saveFrameNames()
+    assert lazyDataBlock['nef_nmr_meta_data'].name == 'nef_nmr_meta_data'
+
+    # Texts that cannot be indexed are parsed normally
+    text = 'data_x\n_nef_a.b 1\n'
+    assert StarIo._indexSaveFrames(text) is None
+
+
+def test_columnar_loops():
+    usePath = os.path.join(TEST_FILE_PATH, 'CCPN_Commented_Example.nef')
+    entry = StarIo.parseNefFile(usePath)
+    columnarEntry = StarIo.parseNefFile(usePath, columnar=True)
+
+    assert columnarEntry.toString() == entry.toString()
+
+    for dataBlock in columnarEntry.values():
+        for saveFrame in dataBlock.values():
+            for tag, loop in saveFrame.items():
+                if isinstance(loop, StarIo.NmrLoop):
+                    assert isinstance(loop, StarIo.ColumnarNmrLoop)
+                    oldLoop = entry[dataBlock.name][saveFrame.name][tag]
+                    assert len(loop.data) == len(oldLoop.data)
+                    for row, oldRow in zip(loop.data, oldLoop.data):
+                        assert list(row.items()) == list(oldRow.items())
+
+    loop = GenericStarParser.ColumnarLoop('_x.a', ['_x.a', '_x.b'])
+    row = loop.newRow(['1'])
+    loop.newRow({'_x.b': '4'})
+    row['_x.b'] = '2'
+    assert loop.data[-1]['_x.b'] == '4'
+    assert loop.getColumnValues('_x.b') == ['2', '4']
+    loop.addColumn('_x.c', paddingValue=None)
+    del loop.data[0]
+    assert list(loop.data[0].values()) == [None, '4', None]
+
+    # rows can be copied between columnar and row-based loops
+    rowLoop = GenericStarParser.Loop('_x.a', ['_x.a', '_x.b', '_x.c'])
+    rowLoop.newRow(loop.data[0])
+    assert list(rowLoop.data[0].items()) == [('_x.a', None), ('_x.b', '4'), ('_x.c', None)]
+    rowLoop.data[0]['_x.a'] = '3'
+    loop.newRow(rowLoop.data[0])
+    assert list(loop.data[-1].items()) == [('_x.a', '3'), ('_x.b', '4'), ('_x.c', None)]
+    loop.newRow(loop.data[0])
+    assert list(loop.data[-1].values()) == [None, '4', None]
+    assert rowLoop.getRowValues() == [['3', '4', None]]
+    assert loop.getRowValues() == [[None, '4', None], ['3', '4', None], [None, '4', None]]
+
+
+def test_content_hash():
+    usePath = os.path.join(TEST_FILE_PATH, 'CCPN_Commented_Example.nef')
+    entry = StarIo.parseNefFile(usePath)
+    contentHash = entry.contentHash()
+
+    assert StarIo.parseNefFile(usePath, columnar=True).contentHash() == contentHash
+    assert StarIo.parseNefFile(usePath, lazy=True).contentHash() == contentHash
+
+    # changes through the loop functions reset the cached hash
+    dataBlock = list(entry.values())[0]
+    saveFrame = dataBlock['nef_chemical_shift_list_1']
+    loop = saveFrame['nef_chemical_shift']
+    blockHash = dataBlock.contentHash()
+    loopHash = loop.contentHash()
+    row = loop.newRow()
+    assert loop.contentHash() != loopHash
+    assert dataBlock.contentHash() != blockHash
+    loop.data.remove(row)
+    assert loop.contentHash() == loopHash
+    assert entry.contentHash() == contentHash
+
+    # as do changes made directly to loop.data and its rows
+    row = loop.data[0]
+    value = row['value']
+    row['value'] = 'changed'
+    assert loop.contentHash() != loopHash
+    row['value'] = value
+    assert loop.contentHash() == loopHash
+    items = list(row.items())
+    del row['value']
+    assert loop.contentHash() != loopHash
+    row.clear()
+    row.update(items)
+    assert loop.contentHash() == loopHash
+    loop.data.insert(0, loop.data.pop(0).copy())
+    assert loop.contentHash() == loopHash
+    loop.data.append(loop.data[0].copy())
+    assert loop.contentHash() != loopHash
+    del loop.data[-1]
+    assert loop.contentHash() == loopHash
+    loop.data[0]['value'] = 'changed'
+    assert loop.contentHash() != loopHash
+    loop.data[0]['value'] = value
+    assert loop.contentHash() == loopHash
+    copiedLoop = pickle.loads(pickle.dumps(loop))
+    assert copiedLoop.contentHash() == loopHash
+    copiedLoop.data[0]['value'] = 'changed'
+    assert copiedLoop.contentHash() != loopHash
+    assert loop.contentHash() == loopHash
+    stamp = loop.modificationStamp()
+    loop.data[1]['value'] = 'changed'
+    assert loop.modificationStamp() != stamp
+    loop.data[1]['value'] = value
+    assert entry.contentHash() == contentHash
+
+    # changes to rows that are not LoopRows are not tracked, so the hash is not cached
+    listLoop = GenericStarParser.Loop('_x', ['_x.a', '_x.b'])
+    listLoop.data = [['1', '2']]
+    listHash = listLoop.contentHash()
+    listLoop.data[0][1] = '3'
+    assert listLoop.contentHash() != listHash
+    assert listLoop.modificationStamp() != listLoop.modificationStamp()
+
+    saveFrame['sf_extra'] = 1
+    assert entry.contentHash() != contentHash
+
+    loop = GenericStarParser.ColumnarLoop('_x.a', ['_x.a', '_x.b'])
+    loop.newRow(['1', '2'])
+    loopHash = loop.contentHash()
+    loop.data[0]['_x.b'] = '3'
+    assert loop.contentHash() != loopHash
+    loop.data[0]['_x.b'] = '2'
+    assert loop.contentHash() == loopHash
+
+
+def test_parse_cache(tmp_path):
+    oldDir, oldSize = ParseCache.PARSE_CACHE_DIR, ParseCache.PARSE_CACHE_MAX_SIZE
+    ParseCache.PARSE_CACHE_DIR = str(tmp_path / 'cache')
+    ParseCache.clearParseCache()
+    try:
+        usePath = str(tmp_path / 'example.nef')
+        with open(os.path.join(TEST_FILE_PATH, 'CCPN_Commented_Example.nef')) as fp:
+            text = fp.read()
+        with open(usePath, 'w') as fp:
+            fp.write(text)
+        entry = StarIo.parseNefFile(usePath)
+
+        entry1 = StarIo.parseNefFile(usePath, useCache=True)
+        entry2 = StarIo.parseNefFile(usePath, useCache=True)
+        assert entry2 is not entry1
+        assert entry1.toString() == entry2.toString() == entry.toString()
+        assert GenericStarParser.parseFile(usePath, useCache=True).toString() == GenericStarParser.parseFile(usePath).toString()
+        statistics = ParseCache.parseCacheStatistics()
+        assert (statistics['hits'], statistics['misses'], statistics['files']) == (1, 2, 2)
+
+        # changed content is a new cache entry
+        with open(usePath, 'w') as fp:
+            fp.write(text.replace('nef_my_nmr_project_1', 'nef_my_nmr_project_2'))
+        assert list(StarIo.parseNefFile(usePath, useCache=True).keys()) == ['nef_my_nmr_project_2']
+
+        # eviction of least recently used files
+        ParseCache.PARSE_CACHE_MAX_SIZE = statistics['size']
+        StarIo.parseNefFile(usePath, useCache=True, columnar=True)
+        statistics = ParseCache.parseCacheStatistics()
+        assert statistics['evictions'] > 0 and statistics['size'] <= ParseCache.PARSE_CACHE_MAX_SIZE
+
+        ParseCache.clearParseCache()
+        assert ParseCache.parseCacheStatistics()['files'] == 0
+    finally:
+        ParseCache.PARSE_CACHE_DIR, ParseCache.PARSE_CACHE_MAX_SIZE = oldDir, oldSize
+        ParseCache.clearParseCache(removeFiles=False)
+
+
+def test_parse_cache_concurrent_writers(tmp_path):
+    import threading
+
+    oldDir = ParseCache.PARSE_CACHE_DIR
+    ParseCache.PARSE_CACHE_DIR = str(tmp_path / 'cache')
+    try:
+        cachePath = ParseCache._parseCachePath('0' * 40, ('concurrent',))
+        trees = [list(range(ii, ii + 100000)) for ii in range(2)]
+        results = [[], []]
+
+        def _write(index):
+            for ii in range(30):
+                results[index].append(ParseCache._writeParseCache(cachePath, trees[index]))
+                assert ParseCache._readParseCache(cachePath) in trees
+
+        threads = [threading.Thread(target=_write, args=(index,)) for index in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert results == [[True] * 30, [True] * 30]
+        assert ParseCache._readParseCache(cachePath) in trees
+        assert os.listdir(ParseCache.PARSE_CACHE_DIR) == [os.path.basename(cachePath)]
+    finally:
+        ParseCache.PARSE_CACHE_DIR = oldDir
+
+
+def test_write(tmp_path):
+    import io
+    import glob
+    import pytest
+
+    for path in sorted(glob.glob(os.path.join(TEST_FILE_PATH, '*.nef'))):
+        if os.path.getsize(path) > 200000:
+            continue
+        for columnar in (False, True):
+            entry = StarIo.parseNefFile(path, columnar=columnar)
+            fp = io.StringIO()
+            entry.write(fp, chunkSize=7)
+            assert fp.getvalue() == entry.toString(), path
+            for dataBlock in entry.values():
+                fp = io.StringIO()
+                dataBlock.write(fp, chunkSize=1)
+                assert fp.getvalue() == dataBlock.toString(), path
+
+    # rows of different length format as for toString
+    loop = GenericStarParser.Loop('_x', ['a', 'b'])
+    loop.data.extend([['1', 'two'], ['three', '4', 'x']])
+    fp = io.StringIO()
+    loop.write(fp, chunkSize=1)
+    assert fp.getvalue() == loop.toString()
+
+    usePath = os.path.join(TEST_FILE_PATH, 'CCPN_Commented_Example.nef')
+    entry = StarIo.parseNefFile(usePath)
+    fileName = str(tmp_path / 'written.nef')
+    GenericStarParser.writeFile(entry, fileName)
+    with open(fileName) as fp:
+        assert fp.read() == entry.toString()
+
+    # atomic write keeps the permissions, and leaves no temporary files
+    os.chmod(fileName, 0o640)
+    dataBlock = list(entry.values())[0]
+    GenericStarParser.writeFile(dataBlock, fileName, atomic=True)
+    with open(fileName) as fp:
+        assert fp.read() == dataBlock.toString()
+    assert os.stat(fileName).st_mode & 0o777 == 0o640
+    assert os.listdir(str(tmp_path)) == ['written.nef']
+
+    # failed atomic write leaves the original file
+    text = dataBlock.toString()
+    dataBlock['nef_nmr_meta_data']['nef_program_script'].data.append(None)
+    with pytest.raises(Exception):
+        GenericStarParser.writeFile(dataBlock, fileName, atomic=True)
+    assert os.listdir(str(tmp_path)) == ['written.nef']
+    with open(fileName) as fp:
+        assert fp.read() == text
+
+    # files of other writers in the directory are left alone
+    otherTempName = str(tmp_path / ('written.nef.%s.tmp' % os.getpid()))
+    with open(otherTempName, 'w') as fp:
+        fp.write('other')
+    with pytest.raises(Exception):
+        GenericStarParser.writeFile(dataBlock, fileName, atomic=True)
+    assert sorted(os.listdir(str(tmp_path))) == ['written.nef', os.path.basename(otherTempName)]
+    os.remove(otherTempName)
+
+    # new files get the permissions open() would give
+    del dataBlock['nef_nmr_meta_data']['nef_program_script'].data[-1]
+    umask = os.umask(0o027)
+    try:
+        GenericStarParser.writeFile(dataBlock, str(tmp_path / 'new.nef'), atomic=True)
+    finally:
+        os.umask(umask)
+    assert os.stat(str(tmp_path / 'new.nef')).st_mode & 0o777 == 0o640
+
+
+def test_column_formatting():
+    # bulk converted columns match conversion value by value
+    UnquotedValue = GenericStarParser.UnquotedValue
+    columns = [
+        [1.5, None, 0.0, 1e300, -2.25e-7],
+        [float('nan'), 1.0, None, float('-inf'), 2.0],
+        [1, None, -7, 0, 10 ** 20],
+        ['ALA', None, 'HA', "it's", 'x'],
+        ['ALA', 'a b', '_x', 'true', 'save_1'],
+        [UnquotedValue('.'), None, UnquotedValue('u v'), UnquotedValue('?'), UnquotedValue('x')],
+        [None] * 5,
+        [True, 'A', 2, 3.5, None],
+        ]
+    for values in columns + [[0, None, 0], [-12, 5, None], [UnquotedValue('abc'), None]]:
+        assert GenericStarParser._columnToStarStrings(values) == [GenericStarParser.valueToStarString(x)
+                                                                 for x in values]
+        # widths, as used for chunked writing
+        assert GenericStarParser._columnStarWidth(values) == max(map(len, GenericStarParser._columnToStarStrings(values)))
+
+    loop = GenericStarParser.ColumnarLoop('_x', ['a', 'b', 'c', 'd'])
+    for ii in range(100000):
+        loop.newRow([ii, 'ALA', 'HA', 4.5 + ii * 1.0e-6])
+    text = loop.toString()
+    assert text.splitlines()[-2] == '      99999  ALA  HA  4.599999'
+
+
+def test_error_location():
+    import pytest
+
+    # error line and column are found directly from the token offset, also in large files
+    text = ('data_x\nsave_a\nloop_\n_a.b\n_a.c\n' + 'ALA  1\n' * 50000
+            + 'stop_\nsave_\nsave_b\n  _b.c  \u00e9  loop_x\nsave_\n')
+    for useText in (text, text.encode('utf-8')):
+        with pytest.raises(GenericStarParser.StarSyntaxError) as error:
+            GenericStarParser.parse(useText)
+        assert 'line: 50009, column: 12' in str(error.value)
+
+    parser = GenericStarParser.GeneralStarParser('data_x\n\n  _a.b  1\n')
+    assert list(parser.iterEvents())[-2] == (GenericStarParser.EVENT_ITEM, '_a.b', '1')
+    assert parser.location() == (3, 9)
+    assert parser.location(0) == (1, 1)
+    assert parser.location(7) == (2, 1)
+
+
+def test_string_interning():
+    text = 'data_x\nsave_a\nloop_\n_a.b\n_a.c\n_a.d\n' + 'ALA  1  "ALA"\nGLY  2  "ALA"\n' * 10 + 'stop_\nsave_\n'
+    loop = GenericStarParser.parse(text)['data_x']['save_a']['_a.b']
+    values = loop.getColumnValues('_a.b')
+    assert len(set(map(id, values))) == 2
+    assert all(x is values[0] for x in values[::2])
+    # quoted values are not merged with unquoted values
+    assert type(loop.data[0]['_a.d']) is str
+
+    oldMaxSize = GenericStarParser.MAX_INTERNED_VALUES
+    GenericStarParser.MAX_INTERNED_VALUES = 1
+    try:
+        values = GenericStarParser.parse(text)['data_x']['save_a']['_a.c'].getColumnValues('_a.c')
+        assert values[0] is values[2] and values[1] is not values[3]
+    finally:
+        GenericStarParser.MAX_INTERNED_VALUES = oldMaxSize
+
+    # converted values are shared as well
+    usePath = os.path.join(TEST_FILE_PATH, 'CCPN_1nk2_docr.nef')
+    for columnar in (False, True):
+        entry = StarIo.parseNefFile(usePath, columnar=columnar)
+        loop = list(entry.values())[0]['nef_chemical_shift_list_4141_protein']['nef_chemical_shift']
+        for column in ('chain_code', 'sequence_code', 'atom_name'):
+            values = loop.getColumnValues(column)
+            assert len(set(map(id, values))) == len(set(values))
+
+
+def test_category_filter():
+    usePath = os.path.join(TEST_FILE_PATH, 'CCPN_1nk2_docr.nef')
+    dataBlock = list(StarIo.parseNefFile(usePath).values())[0]
+
+    entry = StarIo.parseNefFile(usePath, includeCategories=['nef_molecular_system', 'nef_chemical_shift_list'])
+    filtered = list(entry.values())[0]
+    assert list(filtered.keys()) == [key for key, saveFrame in dataBlock.items()
+                                     if saveFrame.category in ('nef_molecular_system', 'nef_chemical_shift_list')]
+    assert all(filtered[key].toString() == dataBlock[key].toString() for key in filtered)
+
+    filtered = list(StarIo.parseNefFile(usePath, useMmap=True,
+                                        excludeCategories=['nef_distance_restraint_list']).values())[0]
+    assert [saveFrame.category for saveFrame in filtered.values()] == [
+        saveFrame.category for saveFrame in dataBlock.values() if saveFrame.category != 'nef_distance_restraint_list']
+
+    # column projection
+    loopColumns = {'nef_chemical_shift': ['chain_code', 'sequence_code', 'atom_name', 'value']}
+    for columnar in (False, True):
+        filtered = list(StarIo.parseNefFile(usePath, columnar=columnar, loopColumns=loopColumns).values())[0]
+        loop = filtered['nef_chemical_shift_list_4141_protein']['nef_chemical_shift']
+        fullLoop = dataBlock['nef_chemical_shift_list_4141_protein']['nef_chemical_shift']
+        assert loop.columns == ('chain_code', 'sequence_code', 'atom_name', 'value')
+        assert loop.getColumnValues('value') == fullLoop.getColumnValues('value')
+
+    # SaveFrames that cannot be jumped over are skipped token by token
+    text = """data_x
+save_a_1
+   _a.sf_category a
+   _a.text
+;
+save_
+;
+   _a.b 'data_ save_'
+save_
+save_b_1
+   _b.sf_category b
+   loop_
+      _c.x _c.y _c.z
+      1 2 3
+      4 5 6
+   stop_
+save_
+save_a_2
+   _a.sf_category a
+save_
+"""
+    result = GenericStarParser.parse(text, includeCategories=['B'], loopColumns={'c': ['z', 'x']})
+    assert list(result['data_x'].keys()) == ['save_b_1']
+    loop = result['data_x']['save_b_1']['_c.x']
+    assert loop.columns == ('_c.x', '_c.z') and loop.data[1] == {'_c.x': '4', '_c.z': '6'}
+    result = GenericStarParser.parse(text, excludeCategories=['b'], loopColumns={'c': ['w']})
+    assert list(result['data_x'].keys()) == ['save_a_1', 'save_a_2']
+    assert list(GenericStarParser.parse(text, loopColumns={'c': ['w']})['data_x']['save_b_1'].keys()) == [
+        '_b.sf_category']
+
+    importer = NefImporter.NefImporter(errorLogging=NefImporter.el.NEF_STANDARD, hidePrefix=True)
+    importer.loadFile(usePath, includeCategories=['nef_molecular_system'])
+    assert importer.getSaveFrameNames() == ('molecular_system',)
+    assert not importer.isValid
+
+
+def test_profiling(tmp_path):
+    from .. import Profiling
+
+    usePath = os.path.join(TEST_FILE_PATH, 'CCPN_Sec5Part3.nef')
+    with Profiling.profile(traceMemory=True) as parseProfile:
+        importer = NefImporter.NefImporter(errorLogging=NefImporter.el.NEF_SILENT)
+        importer.loadFile(usePath)
+        importer.saveFile(str(tmp_path / 'written.nef'))
+        StarIo._StarDataConverter(GenericStarParser.parseFile(usePath), fileType='nef').preValidate()
+    print(parseProfile.report())
+    assert Profiling.activeProfile() is None
+
+    phases = parseProfile.asDict()
+    assert list(phases) == list(Profiling.PHASES)
+    dataBlock = importer.data
+    saveFrameCount = len(dataBlock)
+    rowCount = sum(len(loop.data) for saveFrame in dataBlock.values() for loop in saveFrame.values()
+                   if isinstance(loop, StarIo.NmrLoop))
+    assert phases['tokenise']['calls'] == 2 and phases['tokenise']['counts']['tokens'] > 0
+    assert phases['build']['counts']['rows'] == 2 * rowCount
+    assert phases['convert']['counts']['saveFrames'] == saveFrameCount
+    assert phases['preValidate']['calls'] == saveFrameCount + 1
+    assert phases['validate']['counts']['saveFrames'] == saveFrameCount
+    with open(str(tmp_path / 'written.nef')) as fp:
+        assert phases['write']['counts']['characters'] == len(fp.read())
+    assert all(phase['time'] >= 0 and phase['peakMemory'] > 0 for name, phase in phases.items()
+               if name != 'tokenise')
+
+    # nothing is recorded outside the profile
+    importer.loadFile(usePath)
+    assert parseProfile.asDict() == phases
+
+    # without tracemalloc.reset_peak (Python < 3.9) the memory at the phase boundaries is used
+    resetPeak = Profiling._resetPeak
+    try:
+        Profiling._resetPeak = None
+        with Profiling.profile(traceMemory=True) as parseProfile:
+            StarIo.parseNefFile(usePath)
+    finally:
+        Profiling._resetPeak = resetPeak
+    assert parseProfile.asDict()['build']['peakMemory'] > 0
+
+
 def test_nef_2l9r_Paris_155():
     print('\n\n', '# Paris_155_nef', '#' * 60, '\n')
     _loadGeneralFile('CCPN_2l9r_Paris_155.nef')